@@ -0,0 +1,44 @@
+"""
+Image derivative rendering for generated images and AI avatars.
+
+Kept out of server.py on purpose: these functions run inside a process pool and
+the worker processes should only need Pillow, not the whole API module.
+"""
+from io import BytesIO
+
+from PIL import Image, ImageOps, features
+
+THUMBNAIL_SIZE = 256
+VARIANT_WIDTHS = (320, 640, 1024)
+WEBP_QUALITY = 80
+AVIF_QUALITY = 60
+
+def _encode(image: Image.Image, fmt: str, quality: int) -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, format=fmt, quality=quality)
+    return buffer.getvalue()
+
+def render_image_variants(data: bytes) -> list:
+    """Render a square thumbnail plus width variants.
+
+    Returns a list of (name, bytes, mime_type). Width variants are only produced
+    when they are smaller than the original.
+    """
+    with Image.open(BytesIO(data)) as source:
+        image = ImageOps.exif_transpose(source)
+        image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+
+    variants = []
+    thumbnail = ImageOps.fit(image, (THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.LANCZOS)
+    variants.append(("thumb_webp", _encode(thumbnail, "WEBP", WEBP_QUALITY), "image/webp"))
+    if features.check("avif"):
+        variants.append(("thumb_avif", _encode(thumbnail, "AVIF", AVIF_QUALITY), "image/avif"))
+
+    for width in VARIANT_WIDTHS:
+        if width >= image.width:
+            break
+        height = round(image.height * width / image.width)
+        resized = image.resize((width, height), Image.LANCZOS)
+        variants.append((f"w{width}_webp", _encode(resized, "WEBP", WEBP_QUALITY), "image/webp"))
+
+    return variants
@@ -0,0 +1,225 @@
+"""
+Single entry point for text, image and speech model calls.
+
+Routes call the gateway instead of building LlmChat / OpenAITextToSpeech per
+request. It owns the pooled HTTP client litellm sends through (LlmChat uses
+litellm underneath), one shared TTS client, and a semaphore plus timeout per
+model so each worker caps its own upstream concurrency. The router takes the
+semaphore slot before it starts timing an attempt, so our own cap never shows
+up as provider slowness. LlmChat objects still
+get built per call because they carry conversation state, but they are thin
+wrappers; the connections behind them are reused.
+
+Which model answers is decided by an LLMRouter (see llm_router.py): every
+call names a route ("chat", "image", "tts") with its own fallback chain,
+timeout and optional hedge delay, configurable through LLM_<ROUTE>_* env vars.
+"""
+import asyncio
+import logging
+import os
+import uuid
+
+import httpx
+import litellm
+from emergentintegrations.llm.chat import LlmChat, UserMessage
+from emergentintegrations.llm.openai import OpenAITextToSpeech
+
+from llm_router import LLMRouter
+
+# route -> (per-worker concurrency, per-call timeout in seconds); LLM_<ROUTE>_CONCURRENCY / _TIMEOUT override
+ROUTE_LIMITS = {
+    "chat": ("32", "60"),
+    "image": ("4", "120"),
+    "tts": ("8", "60"),
+}
+
+def model_limits(routes: dict) -> dict:
+    """Per-worker concurrency and per-call timeout (seconds) by model name.
+
+    Every model on a route's chain, fallbacks included, gets that route's limits.
+    Read at gateway construction rather than import so .env has been loaded.
+    """
+    limits = {}
+    for route, (concurrency, timeout) in ROUTE_LIMITS.items():
+        prefix = f"LLM_{route.upper()}"
+        limit = {
+            "concurrency": int(os.getenv(f"{prefix}_CONCURRENCY", concurrency)),
+            "timeout": float(os.getenv(f"{prefix}_TIMEOUT", timeout)),
+        }
+        for _, name in routes.get(route, {}).get("chain", []):
+            limits.setdefault(name, limit)
+    return limits
+
+DEFAULT_LIMITS = {"concurrency": 16, "timeout": 60.0}
+
+def parse_models(value: str) -> list:
+    """"gemini/gemini-3-flash-preview,gemini/gemini-2.5-flash" -> [("gemini", "gemini-3-flash-preview"), ...]"""
+    return [tuple(item.strip().split("/", 1)) for item in value.split(",") if "/" in item]
+
+def route_config(route: str, chain: str, timeout: str, hedge_after: str = "") -> dict:
+    prefix = f"LLM_{route.upper()}"
+    hedge = os.getenv(f"{prefix}_HEDGE_AFTER", hedge_after)
+    return {
+        "chain": parse_models(os.getenv(f"{prefix}_CHAIN", chain)),
+        "timeout": float(os.getenv(f"{prefix}_ROUTE_TIMEOUT", timeout)),
+        "hedge_after": float(hedge) if hedge else None,
+    }
+
+def llm_routes() -> dict:
+    """Fallback chains per route. Hedging is off unless LLM_<ROUTE>_HEDGE_AFTER (seconds) is set."""
+    return {
+        "chat": route_config("chat", "gemini/gemini-3-flash-preview,gemini/gemini-2.5-flash", "45"),
+        "image": route_config("image", "gemini/gemini-3-pro-image-preview,gemini/gemini-2.5-flash-image-preview", "150"),
+        "tts": route_config("tts", "openai/tts-1", "60"),
+    }
+
+class NoImageGenerated(Exception):
+    """The model answered without an image; counts as a failure so the route falls back"""
+
+class LLMGateway:
+    def __init__(self, api_key: str, stream_api_base: str = None, limits: dict = None, routes: dict = None):
+        self.api_key = api_key
+        self.stream_api_base = stream_api_base
+        routes = routes or llm_routes()
+        self.limits = limits or model_limits(routes)
+        self.router = LLMRouter(
+            routes,
+            failure_threshold=int(os.getenv('LLM_BREAKER_FAILURES', '5')),
+            cooldown=float(os.getenv('LLM_BREAKER_COOLDOWN', '30'))
+        )
+        self.semaphores = {}
+        self.counters = {}
+        self.http = None
+        self.tts = OpenAITextToSpeech(api_key=api_key)
+
+    async def start(self):
+        max_connections = int(os.getenv('LLM_MAX_CONNECTIONS', '64'))
+        self.http = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(max(limit["timeout"] for limit in self.limits.values()), connect=10.0),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+        if hasattr(litellm, "aclient_session"):
+            litellm.aclient_session = self.http
+
+    async def close(self):
+        if self.http is None:
+            return
+        if getattr(litellm, "aclient_session", None) is self.http:
+            litellm.aclient_session = None
+        await self.http.aclose()
+        self.http = None
+
+    def limit(self, model: str) -> dict:
+        return self.limits.get(model, DEFAULT_LIMITS)
+
+    def semaphore(self, model: str) -> asyncio.Semaphore:
+        if model not in self.semaphores:
+            self.semaphores[model] = asyncio.Semaphore(self.limit(model)["concurrency"])
+            self.counters[model] = {"calls": 0, "errors": 0, "timeouts": 0, "stream_errors": 0}
+        return self.semaphores[model]
+
+    def admit(self, model: tuple) -> asyncio.Semaphore:
+        """The concurrency slot the router holds while an attempt on `model` runs"""
+        return self.semaphore(model[1])
+
+    async def call(self, model: str, make_call):
+        """Run `make_call()` under the model's timeout; the router already holds its slot"""
+        self.semaphore(model)
+        counters = self.counters[model]
+        counters["calls"] += 1
+        try:
+            return await asyncio.wait_for(make_call(), self.limit(model)["timeout"])
+        except asyncio.TimeoutError:
+            counters["timeouts"] += 1
+            raise
+        except Exception:
+            counters["errors"] += 1
+            raise
+
+    def chat(self, model: tuple, system_message: str, session_id: str = None) -> LlmChat:
+        chat = LlmChat(
+            api_key=self.api_key,
+            session_id=session_id or f"gateway_{uuid.uuid4()}",
+            system_message=system_message
+        )
+        return chat.with_model(*model)
+
+    async def complete(self, system_message: str, text: str, route: str = "chat", session_id: str = None) -> str:
+        async def attempt(model):
+            async def make_call():
+                return await self.chat(model, system_message, session_id).send_message(UserMessage(text=text))
+            return await self.call(model[1], make_call)
+        return await self.router.run(route, attempt, admit=self.admit)
+
+    async def stream(self, system_message: str, text: str, route: str = "chat", session_id: str = None):
+        """Yield reply text as the provider produces it.
+
+        Streams from the first model on the route while its circuit is closed. If
+        the stream cannot be opened the full reply is fetched with complete(),
+        which walks the whole fallback chain, and yielded as a single chunk.
+        Stream-open failures are logged and counted but never fed to the circuit
+        breaker: they usually mean the stream path is misconfigured (e.g. no
+        stream_api_base for a proxy key), not that the model is down, and
+        complete() records the model's real health.
+        """
+        model = next(iter(self.router.available(route)), None)
+        stream = None
+        if model and self.router.model_health(model).state == "closed":
+            provider, name = model
+            async with self.semaphore(name):
+                try:
+                    stream = await asyncio.wait_for(litellm.acompletion(
+                        model=f"{provider}/{name}",
+                        messages=[
+                            {"role": "system", "content": system_message},
+                            {"role": "user", "content": text}
+                        ],
+                        api_key=self.api_key,
+                        api_base=self.stream_api_base,
+                        # A stream API base is an OpenAI-compatible proxy that routes on "provider/model"
+                        custom_llm_provider="openai" if self.stream_api_base else None,
+                        stream=True
+                    ), self.limit(name)["timeout"])
+                except Exception as e:
+                    self.counters[name]["stream_errors"] += 1
+                    logging.warning(f"Streaming from {name} unavailable, falling back to a full completion: {e}")
+                if stream is not None:
+                    self.counters[name]["calls"] += 1
+                    async for part in stream:
+                        delta = part.choices[0].delta.content if part.choices else None
+                        if delta:
+                            yield delta
+                    return
+        # Outside the semaphore: complete() takes its own slot
+        yield await self.complete(system_message, text, route, session_id)
+
+    async def generate_images(self, prompt: str, system_message: str = "You are an AI image generator.", route: str = "image") -> list:
+        """Return the generated images as [{"data": base64, "mime_type": ...}], never empty"""
+        async def attempt(model):
+            async def make_call():
+                chat = self.chat(model, system_message).with_params(modalities=["image", "text"])
+                _, images = await chat.send_message_multimodal_response(UserMessage(text=prompt))
+                if not images:
+                    raise NoImageGenerated(model[1])
+                return images
+            return await self.call(model[1], make_call)
+        return await self.router.run(route, attempt, admit=self.admit)
+
+    async def speech(self, text: str, voice: str, route: str = "tts") -> bytes:
+        async def attempt(model):
+            return await self.call(model[1], lambda: self.tts.generate_speech(text=text, model=model[1], voice=voice))
+        return await self.router.run(route, attempt, admit=self.admit)
+
+    def stats(self) -> dict:
+        return {
+            "limits": {
+                model: {
+                    **self.counters[model],
+                    "in_flight": self.limit(model)["concurrency"] - semaphore._value,
+                    "concurrency": self.limit(model)["concurrency"],
+                }
+                for model, semaphore in self.semaphores.items()
+            },
+            "routing": self.router.stats(),
+        }
@@ -0,0 +1,211 @@
+"""
+Provider routing for model calls: fallback chains, hedging and circuit breaking.
+
+Each route (chat, image, ...) has an ordered chain of models, an overall
+timeout and an optional hedge delay. The router tries the chain in order,
+skipping models whose circuit is open; if the current attempt has not
+answered after the hedge delay, the next model is started alongside it and
+whichever succeeds first wins. Pure asyncio so it can be tested against stub
+providers without any SDK installed.
+
+Callers that cap their own concurrency pass `admit`, a factory returning the
+model's async context manager (e.g. a semaphore). Waiting for admission is our
+own queueing, not provider latency: the route clock and hedge timer start once
+the first attempt is admitted, and an attempt still queued at the deadline is
+released rather than recorded as a model failure.
+"""
+import asyncio
+import contextlib
+import time
+
+def model_name(model) -> str:
+    return "/".join(model) if isinstance(model, tuple) else str(model)
+
+class LLMUnavailable(Exception):
+    """Every model on a route failed, timed out or had its circuit open"""
+
+    def __init__(self, route: str, errors: list, retry_after: int = 5):
+        super().__init__(f"No model available for {route}: {'; '.join(errors) or 'all circuits open'}")
+        self.route = route
+        self.errors = errors
+        self.retry_after = retry_after
+
+class ModelHealth:
+    """Circuit breaker and latency tracking for one model.
+
+    closed -> open after `failure_threshold` consecutive failures; open rejects
+    calls for `cooldown` seconds, then half-open lets a single probe through,
+    whose outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.successes = 0
+        self.failures = 0
+        self.latency_ewma = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def retry_after(self) -> float:
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+
+    def record_success(self, latency: float):
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+
+    def record_failure(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.probing or self.consecutive_failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+    def release(self):
+        """An attempt was cancelled (lost a hedge race) before it could report"""
+        self.probing = False
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "successes": self.successes,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "latency_ms": round(self.latency_ewma * 1000) if self.latency_ewma is not None else None,
+        }
+
+class LLMRouter:
+    """Run a call over a route's fallback chain.
+
+    `routes` maps a route name to {"chain": [model, ...], "timeout": seconds,
+    "hedge_after": seconds or None}. Models are opaque hashable keys; `call`
+    is an async function (model) -> result that raises on failure.
+    """
+
+    def __init__(self, routes: dict, failure_threshold: int = 5, cooldown: float = 30.0):
+        self.routes = routes
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.health = {}
+        self.hedges = 0
+
+    def model_health(self, model) -> ModelHealth:
+        if model not in self.health:
+            self.health[model] = ModelHealth(self.failure_threshold, self.cooldown)
+        return self.health[model]
+
+    def available(self, route: str) -> list:
+        """Models on the route whose circuit currently admits a call, in chain order"""
+        return [model for model in self.routes[route]["chain"] if self.model_health(model).state != "open"]
+
+    async def attempt(self, model, call, admit=None, admitted: asyncio.Event = None):
+        health = self.model_health(model)
+        try:
+            async with admit(model) if admit else contextlib.nullcontext():
+                if admitted:
+                    admitted.set()
+                started = time.monotonic()
+                result = await call(model)
+        except asyncio.CancelledError:
+            health.release()
+            raise
+        except Exception:
+            health.record_failure()
+            raise
+        health.record_success(time.monotonic() - started)
+        return result
+
+    async def run(self, route: str, call, admit=None):
+        config = self.routes[route]
+        hedge_after = config.get("hedge_after")
+        loop = asyncio.get_running_loop()
+        queue = list(config["chain"])
+        pending = {}
+        admitted = {}
+        errors = []
+
+        def launch() -> bool:
+            while queue:
+                model = queue.pop(0)
+                if self.model_health(model).allow():
+                    task = asyncio.ensure_future(self.attempt(model, call, admit, admitted.setdefault(model, asyncio.Event())))
+                    pending[task] = model
+                    return True
+            return False
+
+        launch()
+        try:
+            if admit and pending:
+                # Queueing behind our own concurrency cap is bounded on its own and never hedged
+                first, model = next(iter(pending.items()))
+                waiter = asyncio.ensure_future(admitted[model].wait())
+                done, _ = await asyncio.wait({first, waiter}, timeout=config["timeout"], return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                if not done:
+                    errors.append(f"{model_name(model)}: no local slot within {config['timeout']}s")
+                    pending.clear()
+                    first.cancel()
+            deadline = loop.time() + config["timeout"]
+            while pending:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    errors.append(f"timed out after {config['timeout']}s")
+                    # Still running at the deadline counts against the model, unlike losing a hedge
+                    # or never getting a local slot
+                    for model in pending.values():
+                        if admitted[model].is_set():
+                            self.model_health(model).record_failure()
+                    break
+                can_hedge = hedge_after and queue and len(pending) == 1
+                done, _ = await asyncio.wait(
+                    pending,
+                    timeout=min(remaining, hedge_after) if can_hedge else remaining,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    if can_hedge and launch():
+                        self.hedges += 1
+                    continue
+                for task in done:
+                    model = pending.pop(task)
+                    if task.exception() is None:
+                        return task.result()
+                    errors.append(f"{model_name(model)}: {task.exception()!r}")
+                if not pending:
+                    launch()
+        finally:
+            for task in pending:
+                task.cancel()
+
+        # Suggest retrying when the first circuit is due to half-open, or shortly if none are open
+        waits = [self.model_health(model).retry_after() for model in config["chain"] if self.model_health(model).state == "open"]
+        raise LLMUnavailable(route, errors, retry_after=max(1, round(min(waits))) if waits else 5)
+
+    def stats(self) -> dict:
+        return {
+            "hedges": self.hedges,
+            "models": {model_name(model): health.stats() for model, health in self.health.items()},
+        }
@@ -1,12 +1,19 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Response as FastAPIResponse
-from fastapi.responses import Response, JSONResponse
+from fastapi.responses import Response, JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from bson import ObjectId
 import os
+import copy
 import logging
 import random
 from pathlib import Path
+from urllib.parse import urlparse
+from xml.sax.saxutils import escape as xml_escape
 from pydantic import BaseModel, Field, ConfigDict
 from typing import List, Optional, Dict
 import uuid
@@ -14,14 +21,21 @@ from datetime import datetime, timezone, timedelta
 import bcrypt
 import jwt
 import httpx
-from emergentintegrations.llm.chat import LlmChat, UserMessage
-from emergentintegrations.llm.openai import OpenAITextToSpeech
 import base64
+import hashlib
+import re
 import asyncio
 import json
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.interval import IntervalTrigger
-from pywebpush import webpush, WebPushException
+import math
+import time
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pywebpush import WebPusher
+from py_vapid import Vapid
+from image_variants import render_image_variants
+from llm_gateway import LLMGateway
+from llm_router import LLMUnavailable
 from emergentintegrations.payments.stripe.checkout import StripeCheckout, CheckoutSessionResponse, CheckoutStatusResponse, CheckoutSessionRequest
 
 ROOT_DIR = Path(__file__).parent
@@ -38,6 +52,18 @@ VAPID_PUBLIC_KEY = os.getenv('VAPID_PUBLIC_KEY', '')
 VAPID_PRIVATE_KEY = os.getenv('VAPID_PRIVATE_KEY', '')
 VAPID_CLAIMS_EMAIL = os.getenv('VAPID_CLAIMS_EMAIL', 'admin@example.com')
 STRIPE_API_KEY = os.getenv('STRIPE_API_KEY', '')
+# Public origin of this API, used to build absolute blob URLs (empty = same origin as the frontend)
+API_PUBLIC_URL = os.getenv('API_PUBLIC_URL', '').rstrip('/')
+# Streaming goes through litellm directly rather than LlmChat. Emergent keys are proxy keys,
+# so by default streams go to the same OpenAI-compatible proxy LlmChat sends through;
+# LLM_STREAM_API_BASE overrides it (e.g. another proxy). Provider keys stream directly.
+EMERGENT_PROXY_URL = os.getenv('INTEGRATION_PROXY_URL', 'https://integrations.emergentagent.com').rstrip('/')
+LLM_PROXY_KEY = (EMERGENT_LLM_KEY or '').startswith('sk-emergent-')
+LLM_STREAM_API_BASE = os.getenv('LLM_STREAM_API_BASE') or (f"{EMERGENT_PROXY_URL}/llm" if LLM_PROXY_KEY else None)
+# When off (LLM_STREAMING=false, or no key) /chat/stream answers 503 and clients use /chat/send
+LLM_STREAMING_ENABLED = bool(EMERGENT_LLM_KEY) and os.getenv('LLM_STREAMING', 'true').lower() == 'true'
+
+llm_gateway = LLMGateway(EMERGENT_LLM_KEY, stream_api_base=LLM_STREAM_API_BASE)
 
 # Define subscription plans (amounts in USD - MUST be float format)
 SUBSCRIPTION_PLANS = {
@@ -71,15 +97,22 @@ SUBSCRIPTION_PLANS = {
     }
 }
 
-# Initialize scheduler
-scheduler = AsyncIOScheduler()
-
 # Create the main app without a prefix
 app = FastAPI()
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
+@app.exception_handler(LLMUnavailable)
+async def llm_unavailable_handler(request: Request, exc: LLMUnavailable):
+    # Every model on the route failed or has its circuit open: ask clients to back off
+    logging.warning(str(exc))
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "The AI service is busy right now, please try again shortly"},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
 # Define Models
 class User(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -113,6 +146,8 @@ class Message(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     chat_id: str
+    user_id: Optional[str] = None
+    character_id: Optional[str] = None
     sender: str  # 'user' or 'ai'
     content: str
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -129,6 +164,7 @@ class VoiceGenerateRequest(BaseModel):
 class ImageGenerateRequest(BaseModel):
     prompt: str
     character_id: str
+    user_id: Optional[str] = None
 
 class GoogleSessionRequest(BaseModel):
     session_id: str
@@ -276,35 +312,215 @@ class AdminUpdateCredentials(BaseModel):
     new_username: Optional[str] = None
     new_password: Optional[str] = None
 
-# Helper function to hash passwords
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+# Password hashing. bcrypt takes ~100-250ms of CPU per call, so it runs on a small
+# dedicated pool instead of the event loop. When more than PASSWORD_QUEUE_LIMIT
+# operations are in flight, new ones are shed with 429 + Retry-After.
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', '12'))
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', str(min(4, os.cpu_count() or 1))))
+PASSWORD_QUEUE_LIMIT = int(os.getenv('PASSWORD_QUEUE_LIMIT', '64'))
+PASSWORD_OP_SECONDS = 0.25  # rough upper bound per bcrypt call, used for Retry-After
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+password_ops_pending = 0
+
+async def run_password_op(func, *args):
+    global password_ops_pending
+    if password_ops_pending >= PASSWORD_QUEUE_LIMIT:
+        retry_after = max(1, math.ceil(password_ops_pending / PASSWORD_HASH_WORKERS * PASSWORD_OP_SECONDS))
+        raise HTTPException(
+            status_code=429,
+            detail="Too many sign-in attempts right now, please retry shortly",
+            headers={"Retry-After": str(retry_after)}
+        )
+    password_ops_pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_executor, func, *args)
+    finally:
+        password_ops_pending -= 1
+
+def _hash_password(password: str) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode('utf-8')
 
-def verify_password(password: str, hashed: str) -> bool:
+def _verify_password(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
+async def hash_password(password: str) -> str:
+    return await run_password_op(_hash_password, password)
+
+async def verify_password(password: str, hashed: str) -> bool:
+    return await run_password_op(_verify_password, password, hashed)
+
+def password_needs_rehash(hashed: str) -> bool:
+    """True when a stored bcrypt hash was made with a different cost than BCRYPT_ROUNDS"""
+    try:
+        return int(hashed.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return False
+
+async def rehash_password(collection, record_id: str, password: str):
+    """Upgrade a stored hash after a successful login; best effort, runs in the background"""
+    try:
+        new_hash = await hash_password(password)
+        await collection.update_one({"id": record_id}, {"$set": {"password_hash": new_hash}})
+    except Exception as e:
+        logging.warning(f"Password rehash skipped for {record_id}: {e}")
+
 def create_token(user_id: str) -> str:
     return jwt.encode({"user_id": user_id}, JWT_SECRET, algorithm="HS256")
 
 def create_admin_token(admin_id: str) -> str:
     return jwt.encode({"admin_id": admin_id, "is_admin": True}, JWT_SECRET, algorithm="HS256")
 
-def verify_token(token: str) -> dict:
-    """Verify user JWT token and return payload"""
+def token_digest(token: str) -> str:
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+# Tokens carry no expiry, so a decoded payload stays valid; the LRU only bounds memory.
+# Rejections live in their own smaller LRU so a stream of garbage tokens costs one
+# decode each without evicting valid sessions.
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', '4096'))
+REJECTED_TOKEN_CACHE_SIZE = int(os.getenv('REJECTED_TOKEN_CACHE_SIZE', '1024'))
+ADMIN_CACHE_TTL = 30
+decoded_tokens = OrderedDict()  # token digest -> payload
+rejected_tokens = OrderedDict()  # token digest -> None
+admin_cache = {}  # admin id -> (admin document, expires_at)
+
+def remember_token(cache: OrderedDict, max_entries: int, key: str, payload: Optional[dict]):
+    cache[key] = payload
+    while len(cache) > max_entries:
+        cache.popitem(last=False)
+
+def decode_token(token: str) -> Optional[dict]:
+    key = token_digest(token)
+    if key in decoded_tokens:
+        decoded_tokens.move_to_end(key)
+        return decoded_tokens[key]
+    if key in rejected_tokens:
+        rejected_tokens.move_to_end(key)
+        return None
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
-        return payload
-    except:
+    except jwt.PyJWTError:
+        remember_token(rejected_tokens, REJECTED_TOKEN_CACHE_SIZE, key, None)
         return None
+    remember_token(decoded_tokens, TOKEN_CACHE_SIZE, key, payload)
+    return payload
+
+def verify_token(token: str) -> dict:
+    """Verify user JWT token and return payload"""
+    return decode_token(token)
 
 def verify_admin_token(token: str) -> dict:
-    try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
-        if payload.get("is_admin"):
-            return payload
-        return None
-    except:
+    payload = decode_token(token)
+    if payload and payload.get("is_admin"):
+        return payload
+    return None
+
+def bearer_token(request: Request) -> Optional[str]:
+    auth_header = request.headers.get("Authorization")
+    if not auth_header or not auth_header.startswith("Bearer "):
         return None
+    return auth_header.split(" ")[1]
+
+async def get_user_from_token(request: Request) -> dict:
+    """Auth dependency for user routes; returns the verified token payload"""
+    token = bearer_token(request)
+    if not token:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    payload = verify_token(token)
+    if not payload or not payload.get("user_id"):
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return payload
+
+async def get_admin_from_token(request: Request) -> dict:
+    """Auth dependency for admin routes; returns the admin record (without password hash)"""
+    token = bearer_token(request)
+    if not token:
+        raise HTTPException(status_code=401, detail="No token provided")
+    payload = verify_admin_token(token)
+    if not payload:
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+    
+    cached = admin_cache.get(payload['admin_id'])
+    if cached and cached[1] > time.monotonic():
+        return dict(cached[0])
+    
+    admin = await db.admins.find_one({"id": payload['admin_id']}, {"_id": 0, "password_hash": 0})
+    if not admin:
+        raise HTTPException(status_code=401, detail="Admin not found")
+    
+    # Convert datetime objects to strings
+    result = {}
+    for key, value in admin.items():
+        if isinstance(value, datetime):
+            result[key] = value.isoformat()
+        else:
+            result[key] = value
+    
+    admin_cache[payload['admin_id']] = (result, time.monotonic() + ADMIN_CACHE_TTL)
+    return dict(result)
+
+def invalidate_admin(admin_id: str):
+    admin_cache.pop(admin_id, None)
+
+def make_chat_id(user_id: str, character_id: str) -> str:
+    return f"{user_id}_{character_id}"
+
+def split_chat_id(chat_id: str):
+    """Split a chat_id into (user_id, character_id).
+
+    Character ids are UUIDs and never contain underscores, while Google user ids
+    look like ``user_abc123``, so the split has to happen on the last underscore.
+    """
+    user_id, _, character_id = chat_id.rpartition("_")
+    return user_id, character_id
+
+def encode_cursor(values: list) -> str:
+    """Opaque keyset cursor for the last row of a page"""
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(",", ":")).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, size: int) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def keyset_filter(fields: list, values: list, descending: bool = True) -> dict:
+    """Rows strictly after (values) in a (field1, field2, ...) sort, e.g. (last_timestamp, id)"""
+    op = "$lt" if descending else "$gt"
+    clauses = []
+    for i, field in enumerate(fields):
+        clause = {prev: values[j] for j, prev in enumerate(fields[:i])}
+        clause[field] = {op: values[i]}
+        clauses.append(clause)
+    return {"$or": clauses}
+
+MAX_PAGE_SIZE = 100
+
+async def keyset_page(collection, query: dict, sort_fields: list, limit: int, cursor: Optional[str] = None, projection: Optional[dict] = None):
+    """One page sorted descending on sort_fields (the last one must be unique).
+    
+    Returns (docs, next_cursor); next_cursor is None on the last page.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    if cursor:
+        after = keyset_filter(sort_fields, decode_cursor(cursor, len(sort_fields)))
+        query = {"$and": [query, after]} if query else after
+    docs = await collection.find(query, projection or {"_id": 0}).sort(
+        [(field, -1) for field in sort_fields]
+    ).limit(limit).to_list(limit)
+    next_cursor = encode_cursor([docs[-1].get(field) for field in sort_fields]) if len(docs) == limit else None
+    return docs, next_cursor
+
+# Keep references to fire-and-forget tasks so they are not garbage collected mid-run
+background_tasks = set()
+
+def spawn_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
 
 # Initialize default admin account
 async def init_admin():
@@ -314,7 +530,7 @@ async def init_admin():
             "id": str(uuid.uuid4()),
             "email": "admin@admin.com",
             "username": "Administrator",
-            "password_hash": hash_password("admin123"),
+            "password_hash": await hash_password("admin123"),
             "is_super_admin": True,
             "created_at": datetime.now(timezone.utc),
             "last_login": None
@@ -611,8 +827,999 @@ async def init_characters():
         await db.characters.insert_many(default_characters)
         logging.info(f"Initialized {len(default_characters)} default characters")
 
+# ============ DATA MIGRATIONS ============
+# Each migration is recorded in db.migrations with its status and a resume cursor,
+# so an interrupted run picks up where it left off instead of starting over.
+
+MIGRATION_BATCH_SIZE = 1000
+
+async def save_migration_cursor(migration_id: str, cursor):
+    await db.migrations.update_one(
+        {"id": migration_id},
+        {"$set": {"cursor": cursor, "updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+
+async def migrate_message_owner_fields(migration_id: str, cursor):
+    """Backfill user_id/character_id on messages that only carry a chat_id"""
+    updated = 0
+    while True:
+        query = {"user_id": {"$exists": False}}
+        if cursor is not None:
+            query["_id"] = {"$gt": cursor}
+        batch = await db.messages.find(query, {"_id": 1, "chat_id": 1}).sort("_id", 1).limit(MIGRATION_BATCH_SIZE).to_list(MIGRATION_BATCH_SIZE)
+        if not batch:
+            break
+        
+        operations = []
+        for doc in batch:
+            user_id, character_id = split_chat_id(doc.get("chat_id", ""))
+            operations.append(UpdateOne(
+                {"_id": doc["_id"]},
+                {"$set": {"user_id": user_id, "character_id": character_id}}
+            ))
+        await db.messages.bulk_write(operations, ordered=False)
+        
+        updated += len(operations)
+        cursor = batch[-1]["_id"]
+        await save_migration_cursor(migration_id, cursor)
+    
+    logging.info(f"Migration {migration_id}: backfilled {updated} messages")
+
+async def migrate_generated_images_to_blobs(migration_id: str, cursor):
+    """Move base64 image_data out of generated_images into the blob store"""
+    moved = 0
+    while True:
+        query = {"image_data": {"$exists": True}}
+        if cursor is not None:
+            query["_id"] = {"$gt": cursor}
+        batch = await db.generated_images.find(query, {"_id": 1, "image_data": 1, "mime_type": 1}).sort("_id", 1).limit(100).to_list(100)
+        if not batch:
+            break
+        
+        for doc in batch:
+            digest = await store_blob(base64.b64decode(doc["image_data"]), doc.get("mime_type") or "image/png")
+            await db.generated_images.update_one(
+                {"_id": doc["_id"]},
+                {"$set": {"image_blob": digest, "image_url": blob_url(digest)}, "$unset": {"image_data": ""}}
+            )
+            moved += 1
+        
+        cursor = batch[-1]["_id"]
+        await save_migration_cursor(migration_id, cursor)
+    
+    logging.info(f"Migration {migration_id}: moved {moved} images to the blob store")
+
+async def migrate_custom_avatars_to_blobs(migration_id: str, cursor):
+    """Replace data: URL avatars on custom characters with blob URLs"""
+    moved = 0
+    while True:
+        query = {"avatar_url": {"$regex": "^data:"}}
+        if cursor is not None:
+            query["_id"] = {"$gt": cursor}
+        batch = await db.custom_characters.find(query, {"_id": 1, "id": 1, "avatar_url": 1}).sort("_id", 1).limit(100).to_list(100)
+        if not batch:
+            break
+        
+        for doc in batch:
+            data, mime_type = parse_data_url(doc["avatar_url"])
+            digest = await store_blob(data, mime_type)
+            await db.custom_characters.update_one(
+                {"_id": doc["_id"]},
+                {"$set": {"avatar_blob": digest, "avatar_url": blob_url(digest)}}
+            )
+            character_repository.invalidate_custom(doc.get("id"))
+            moved += 1
+        
+        cursor = batch[-1]["_id"]
+        await save_migration_cursor(migration_id, cursor)
+    
+    logging.info(f"Migration {migration_id}: moved {moved} avatars to the blob store")
+
+async def migrate_image_variants(migration_id: str, cursor):
+    """Render thumbnails for blob-backed images and avatars created before variants existed"""
+    for collection, blob_field, variants_field, attach in (
+        (db.generated_images, "image_blob", "variants", attach_generated_image_variants),
+        (db.custom_characters, "avatar_blob", "avatar_variants", attach_avatar_variants),
+    ):
+        while True:
+            query = {blob_field: {"$type": "string"}, variants_field: {"$exists": False}}
+            batch = await collection.find(query, {"_id": 0, "id": 1, blob_field: 1}).limit(50).to_list(50)
+            if not batch:
+                break
+            for doc in batch:
+                await attach(doc["id"], doc[blob_field])
+            # Failed renders keep the document eligible; mark them so the loop ends
+            await collection.update_many(
+                {"id": {"$in": [doc["id"] for doc in batch]}, variants_field: {"$exists": False}},
+                {"$set": {variants_field: {}}}
+            )
+
+async def migrate_build_chat_index(migration_id: str, cursor):
+    """Build db.chats from the messages collection.
+    
+    Live writes keep updating db.chats while this runs, so an existing summary is
+    merged rather than replaced: counters keep the larger value, the newer last
+    message wins and denormalized names are left alone.
+    """
+    await db.chats.create_index([("id", 1)], name="chats_id", unique=True)
+    await db.messages.aggregate([
+        {"$match": {"user_id": {"$exists": True}}},
+        {"$sort": {"chat_id": 1, "timestamp": 1}},
+        {"$group": {
+            "_id": "$chat_id",
+            "user_id": {"$first": "$user_id"},
+            "character_id": {"$first": "$character_id"},
+            "message_count": {"$sum": 1},
+            "last_message": {"$last": "$content"},
+            "last_timestamp": {"$last": "$timestamp"},
+            "created_at": {"$first": "$timestamp"}
+        }},
+        {"$project": {
+            "_id": 0, "id": "$_id", "user_id": 1, "character_id": 1, "message_count": 1,
+            "last_message": 1, "last_timestamp": 1, "created_at": 1
+        }},
+        {"$merge": {"into": "chats", "on": "id", "whenMatched": [{"$set": {
+            "user_id": {"$ifNull": ["$user_id", "$$new.user_id"]},
+            "character_id": {"$ifNull": ["$character_id", "$$new.character_id"]},
+            "message_count": {"$max": ["$message_count", "$$new.message_count"]},
+            "last_message": {"$cond": [
+                {"$gt": ["$$new.last_timestamp", "$last_timestamp"]}, "$$new.last_message", "$last_message"
+            ]},
+            "last_timestamp": {"$max": ["$last_timestamp", "$$new.last_timestamp"]},
+            "created_at": {"$min": ["$created_at", "$$new.created_at"]}
+        }}], "whenNotMatched": "insert"}}
+    ], allowDiskUse=True).to_list(None)
+    
+    while True:
+        batch = await db.chats.find(
+            {"user_name": {"$exists": False}}, {"_id": 0, "id": 1, "user_id": 1, "character_id": 1}
+        ).limit(500).to_list(500)
+        if not batch:
+            break
+        await fill_chat_names(batch)
+
+MIGRATIONS = [
+    ("0001_message_owner_fields", migrate_message_owner_fields),
+    ("0002_generated_images_to_blobs", migrate_generated_images_to_blobs),
+    ("0003_custom_avatars_to_blobs", migrate_custom_avatars_to_blobs),
+    ("0004_image_variants", migrate_image_variants),
+    ("0005_chat_index", migrate_build_chat_index),
+]
+
+async def run_migrations():
+    """Run every migration that has not completed yet, in order"""
+    for migration_id, migration in MIGRATIONS:
+        state = await db.migrations.find_one({"id": migration_id}, {"_id": 0})
+        if state and state.get("status") == "completed":
+            continue
+        
+        await db.migrations.update_one(
+            {"id": migration_id},
+            {"$set": {"status": "running", "started_at": datetime.now(timezone.utc).isoformat()}},
+            upsert=True
+        )
+        try:
+            await migration(migration_id, state.get("cursor") if state else None)
+        except Exception as e:
+            logging.error(f"Migration {migration_id} failed: {e}")
+            await db.migrations.update_one({"id": migration_id}, {"$set": {"status": "failed", "error": str(e)}})
+            return
+        
+        await db.migrations.update_one(
+            {"id": migration_id},
+            {"$set": {"status": "completed", "completed_at": datetime.now(timezone.utc).isoformat()}}
+        )
+        logging.info(f"Migration {migration_id} completed")
+
+# ============ DATABASE INDEXES ============
+# Declarative registry of every index the API relies on. ensure_indexes() creates
+# the missing ones at startup and reports drift between what is declared here and
+# what actually exists. `python server.py indexes --dry-run` only reports.
+
+INDEX_REGISTRY = {
+    "users": [
+        {"name": "users_email", "keys": [("email", 1)], "unique": True},
+        {"name": "users_id", "keys": [("id", 1)]},
+        {"name": "users_user_id", "keys": [("user_id", 1)], "sparse": True},
+        {"name": "users_last_active", "keys": [("last_active", 1)]},
+        {"name": "users_created_id", "keys": [("created_at", -1), ("id", -1)]},
+    ],
+    "user_sessions": [
+        {"name": "user_sessions_token", "keys": [("session_token", 1)], "unique": True},
+        {"name": "user_sessions_user", "keys": [("user_id", 1)]},
+    ],
+    "characters": [
+        {"name": "characters_id", "keys": [("id", 1)], "unique": True},
+        {"name": "characters_category", "keys": [("category", 1)]},
+    ],
+    "custom_characters": [
+        {"name": "custom_characters_id", "keys": [("id", 1)], "unique": True},
+        {"name": "custom_characters_user_created", "keys": [("user_id", 1), ("created_at", -1)]},
+    ],
+    "messages": [
+        {"name": "messages_id", "keys": [("id", 1)]},
+        {"name": "messages_chat_timestamp", "keys": [("chat_id", 1), ("timestamp", 1)]},
+        {"name": "messages_user_timestamp", "keys": [("user_id", 1), ("timestamp", -1)]},
+        {"name": "messages_user_character", "keys": [("user_id", 1), ("character_id", 1)]},
+        {"name": "messages_timestamp", "keys": [("timestamp", 1)]},
+    ],
+    "chats": [
+        {"name": "chats_id", "keys": [("id", 1)], "unique": True},
+        {"name": "chats_user_recent", "keys": [("user_id", 1), ("last_timestamp", -1), ("id", -1)]},
+        {"name": "chats_recent", "keys": [("last_timestamp", -1), ("id", -1)]},
+        {"name": "chats_character", "keys": [("character_id", 1)]},
+    ],
+    "chat_memories": [
+        {"name": "chat_memories_chat", "keys": [("chat_id", 1)], "unique": True},
+        {"name": "chat_memories_user", "keys": [("user_id", 1)]},
+    ],
+    "favorites": [
+        {"name": "favorites_user_character", "keys": [("user_id", 1), ("character_id", 1)], "unique": True},
+        {"name": "favorites_character", "keys": [("character_id", 1)]},
+    ],
+    "generated_images": [
+        {"name": "generated_images_user_created", "keys": [("user_id", 1), ("created_at", -1)]},
+        {"name": "generated_images_id", "keys": [("id", 1)]},
+    ],
+    "push_subscriptions": [
+        {"name": "push_subscriptions_user", "keys": [("user_id", 1)]},
+        {"name": "push_subscriptions_endpoint", "keys": [("endpoint", 1)]},
+        {"name": "push_subscriptions_active", "keys": [("is_active", 1), ("user_id", 1)]},
+    ],
+    "notification_preferences": [
+        {"name": "notification_preferences_user", "keys": [("user_id", 1)], "unique": True},
+    ],
+    "sent_notifications": [
+        {"name": "sent_notifications_user_date_type", "keys": [("user_id", 1), ("date", 1), ("type", 1)]},
+        {"name": "sent_notifications_dedupe_key", "keys": [("dedupe_key", 1)], "unique": True, "sparse": True},
+        {"name": "sent_notifications_user_timestamp", "keys": [("user_id", 1), ("timestamp", -1)]},
+    ],
+    "notifications": [
+        {"name": "notifications_user_created", "keys": [("user_id", 1), ("created_at", -1)]},
+        {"name": "notifications_id", "keys": [("id", 1)]},
+    ],
+    "admins": [
+        {"name": "admins_email", "keys": [("email", 1)], "unique": True},
+        {"name": "admins_id", "keys": [("id", 1)], "unique": True},
+    ],
+    "admin_activity_logs": [
+        {"name": "admin_activity_logs_timestamp_id", "keys": [("timestamp", -1), ("id", -1)]},
+        {"name": "admin_activity_logs_action_timestamp_id", "keys": [("action", 1), ("timestamp", -1), ("id", -1)]},
+        {"name": "admin_activity_logs_admin_timestamp_id", "keys": [("admin_id", 1), ("timestamp", -1), ("id", -1)]},
+    ],
+    "announcements": [
+        {"name": "announcements_active_created", "keys": [("is_active", 1), ("created_at", -1)]},
+        {"name": "announcements_id", "keys": [("id", 1)]},
+    ],
+    "chat_flags": [
+        {"name": "chat_flags_status_created", "keys": [("status", 1), ("created_at", -1)]},
+        {"name": "chat_flags_id", "keys": [("id", 1)]},
+    ],
+    "blog_posts": [
+        {"name": "blog_posts_slug", "keys": [("slug", 1)], "unique": True},
+        {"name": "blog_posts_id", "keys": [("id", 1)], "unique": True},
+        {"name": "blog_posts_status_published_id", "keys": [("status", 1), ("published_at", -1), ("id", -1)]},
+        {"name": "blog_posts_created_id", "keys": [("created_at", -1), ("id", -1)]},
+    ],
+    "payment_transactions": [
+        {"name": "payment_transactions_session", "keys": [("session_id", 1)], "unique": True},
+        {"name": "payment_transactions_user_created", "keys": [("user_id", 1), ("created_at", -1)]},
+    ],
+    "migrations": [
+        {"name": "migrations_id", "keys": [("id", 1)], "unique": True},
+    ],
+    "blobs": [
+        {"name": "blobs_hash", "keys": [("hash", 1)], "unique": True},
+    ],
+    "analytics_rollups": [
+        {"name": "analytics_rollups_metric_bucket", "keys": [("metric", 1), ("granularity", 1), ("bucket", 1)]},
+    ],
+    "analytics_totals": [
+        {"name": "analytics_totals_kind_messages", "keys": [("kind", 1), ("messages", -1)]},
+    ],
+    "jobs": [
+        {"name": "jobs_id", "keys": [("id", 1)], "unique": True},
+        {"name": "jobs_type_slot", "keys": [("type", 1), ("slot", 1)], "unique": True},
+        {"name": "jobs_status_run_at", "keys": [("status", 1), ("run_at", 1)]},
+    ],
+    "greeting_pool": [
+        {"name": "greeting_pool_character_version_created", "keys": [("character_id", 1), ("version", 1), ("created_at", 1)]},
+    ],
+    "opener_cache": [
+        {"name": "opener_cache_character_last_hit", "keys": [("character_id", 1), ("last_hit_at", 1)]},
+        {"name": "opener_cache_expires", "keys": [("expires_at", 1)], "expireAfterSeconds": 0},
+    ],
+}
+
+INDEX_OPTIONS = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression")
+
+def normalize_index_keys(keys):
+    return [(field, int(direction) if isinstance(direction, (int, float)) else direction) for field, direction in keys]
+
+async def ensure_indexes(dry_run: bool = False) -> dict:
+    """Create missing indexes from INDEX_REGISTRY and report drift.
+
+    Existing indexes are never dropped or rebuilt automatically; mismatches and
+    undeclared indexes are only reported so they can be fixed deliberately.
+    """
+    report = {"created": [], "missing": [], "mismatched": [], "undeclared": [], "errors": []}
+    
+    for collection_name, specs in INDEX_REGISTRY.items():
+        collection = db[collection_name]
+        existing = await collection.index_information()
+        existing_by_keys = {tuple(normalize_index_keys(info["key"])): name for name, info in existing.items()}
+        declared_names = set()
+        
+        for spec in specs:
+            name = spec["name"]
+            keys = normalize_index_keys(spec["keys"])
+            options = {option: spec[option] for option in INDEX_OPTIONS if option in spec}
+            declared_names.add(name)
+            label = f"{collection_name}.{name}"
+            
+            current = existing.get(name)
+            if current is None:
+                other_name = existing_by_keys.get(tuple(keys))
+                if other_name:
+                    report["mismatched"].append({"index": label, "reason": f"same keys exist as '{other_name}'"})
+                    declared_names.add(other_name)
+                    continue
+                
+                report["missing"].append(label)
+                if dry_run:
+                    continue
+                try:
+                    await collection.create_index(keys, name=name, background=True, **options)
+                    report["created"].append(label)
+                except Exception as e:
+                    report["errors"].append({"index": label, "error": str(e)})
+                continue
+            
+            if normalize_index_keys(current["key"]) != keys:
+                report["mismatched"].append({"index": label, "reason": f"keys {current['key']} != {keys}"})
+                continue
+            for option in INDEX_OPTIONS:
+                if current.get(option) != spec.get(option):
+                    report["mismatched"].append({"index": label, "reason": f"{option}={current.get(option)!r}, declared {spec.get(option)!r}"})
+        
+        for name in existing:
+            if name != "_id_" and name not in declared_names:
+                report["undeclared"].append(f"{collection_name}.{name}")
+    
+    if report["created"]:
+        logging.info(f"Created indexes: {', '.join(report['created'])}")
+    if report["mismatched"] or report["undeclared"]:
+        logging.warning(f"Index drift detected: mismatched={report['mismatched']} undeclared={report['undeclared']}")
+    for error in report["errors"]:
+        logging.error(f"Index creation failed for {error['index']}: {error['error']}")
+    
+    return report
+
+# ============ CHARACTER CACHE ============
+# The built-in catalog is ~25 rows that almost never change, so it is kept fully in
+# memory and indexed by id. Custom characters go through a bounded LRU with a TTL.
+# Writes through the API invalidate the cache directly; with several workers the
+# optional change stream lets every worker see the others' writes.
+
+DEFAULT_CHARACTER_CACHE_TTL = 3600  # seconds, safety net for out-of-band edits
+CUSTOM_CHARACTER_CACHE_TTL = 300
+CUSTOM_CHARACTER_CACHE_SIZE = int(os.getenv('CUSTOM_CHARACTER_CACHE_SIZE', '256'))
+CHARACTER_CACHE_CHANGE_STREAM = os.getenv('CHARACTER_CACHE_CHANGE_STREAM', '').lower() in ('1', 'true', 'yes')
+
+class CharacterRepository:
+    """Cached character lookups. Returned documents are deep copies and safe to mutate, nested lists included."""
+    
+    def __init__(self):
+        self.defaults = None  # id -> document, in catalog order
+        self.defaults_loaded_at = 0.0
+        self.defaults_lock = asyncio.Lock()
+        self.custom = OrderedDict()  # id -> (document or None, expires_at)
+    
+    async def _default_map(self) -> dict:
+        if self.defaults is None or time.monotonic() - self.defaults_loaded_at > DEFAULT_CHARACTER_CACHE_TTL:
+            async with self.defaults_lock:
+                if self.defaults is None or time.monotonic() - self.defaults_loaded_at > DEFAULT_CHARACTER_CACHE_TTL:
+                    docs = await db.characters.find({}, {"_id": 0}).to_list(1000)
+                    self.defaults = {doc["id"]: doc for doc in docs}
+                    self.defaults_loaded_at = time.monotonic()
+        return self.defaults
+    
+    async def list_defaults(self, category: Optional[str] = None) -> list:
+        defaults = await self._default_map()
+        return [copy.deepcopy(doc) for doc in defaults.values() if not category or doc.get("category") == category]
+    
+    async def get_default(self, character_id: str) -> Optional[dict]:
+        doc = (await self._default_map()).get(character_id)
+        return copy.deepcopy(doc) if doc else None
+    
+    async def get_custom(self, character_id: str) -> Optional[dict]:
+        cached = self.custom.get(character_id)
+        if cached and cached[1] > time.monotonic():
+            self.custom.move_to_end(character_id)
+            return copy.deepcopy(cached[0]) if cached[0] else None
+        
+        doc = await db.custom_characters.find_one({"id": character_id}, {"_id": 0})
+        self.custom[character_id] = (doc, time.monotonic() + CUSTOM_CHARACTER_CACHE_TTL)
+        self.custom.move_to_end(character_id)
+        while len(self.custom) > CUSTOM_CHARACTER_CACHE_SIZE:
+            self.custom.popitem(last=False)
+        return copy.deepcopy(doc) if doc else None
+    
+    async def get(self, character_id: str) -> Optional[dict]:
+        """Look up a built-in character first, then a custom one"""
+        return await self.get_default(character_id) or await self.get_custom(character_id)
+    
+    async def get_many(self, character_ids: list) -> dict:
+        """Resolve many ids at once: built-ins from memory, cache misses with one $in query"""
+        defaults = await self._default_map()
+        now = time.monotonic()
+        found, missing = {}, []
+        for character_id in set(character_ids):
+            if character_id in defaults:
+                found[character_id] = copy.deepcopy(defaults[character_id])
+                continue
+            cached = self.custom.get(character_id)
+            if cached and cached[1] > now:
+                if cached[0]:
+                    found[character_id] = copy.deepcopy(cached[0])
+            else:
+                missing.append(character_id)
+        
+        if missing:
+            docs = {doc["id"]: doc async for doc in db.custom_characters.find({"id": {"$in": missing}}, {"_id": 0})}
+            for character_id in missing:
+                doc = docs.get(character_id)
+                self.custom[character_id] = (doc, now + CUSTOM_CHARACTER_CACHE_TTL)
+                if doc:
+                    found[character_id] = copy.deepcopy(doc)
+            while len(self.custom) > CUSTOM_CHARACTER_CACHE_SIZE:
+                self.custom.popitem(last=False)
+        return found
+    
+    async def random_default(self) -> Optional[dict]:
+        defaults = await self.list_defaults()
+        return random.choice(defaults) if defaults else None
+    
+    def invalidate_defaults(self):
+        self.defaults = None
+    
+    def invalidate_custom(self, character_id: Optional[str] = None):
+        if character_id is None:
+            self.custom.clear()
+        else:
+            self.custom.pop(character_id, None)
+
+character_repository = CharacterRepository()
+
+async def watch_character_changes():
+    """Invalidate the character cache on writes made by other workers (replica sets only)"""
+    pipeline = [{"$match": {"ns.coll": {"$in": ["characters", "custom_characters"]}}}]
+    while True:
+        try:
+            async with db.watch(pipeline, full_document="default") as stream:
+                async for change in stream:
+                    if change["ns"]["coll"] == "characters":
+                        character_repository.invalidate_defaults()
+                        response_cache.drop("characters")
+                    else:
+                        # Deletes carry no document, so drop every custom entry
+                        character_id = (change.get("fullDocument") or {}).get("id")
+                        character_repository.invalidate_custom(character_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if "replica set" in str(e).lower() or "only supported" in str(e).lower():
+                logging.warning(f"Character cache change stream unavailable: {e}")
+                return
+            logging.error(f"Character cache change stream error, retrying: {e}")
+            await asyncio.sleep(5)
+
+# ============ SESSION CACHE ============
+# /auth/me is called on every page load. Verified sessions are cached per worker,
+# keyed by a digest of the session token, for at most SESSION_CACHE_TTL and never
+# past the session's own expiry. Unknown tokens are negatively cached briefly.
+# Logout, account deletion and google_session invalidate entries on the worker
+# that handled them; other workers converge within the TTL.
+
+SESSION_CACHE_TTL = int(os.getenv('SESSION_CACHE_TTL', '60'))
+SESSION_NEGATIVE_TTL = 10
+SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', '10000'))
+
+class SessionCache:
+    """token digest -> (user document or None, user_id, expires_at monotonic)"""
+    
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+    
+    def get(self, token: str):
+        """Returns (found, user_doc). user_doc is None for a cached rejection."""
+        key = token_digest(token)
+        entry = self.entries.get(key)
+        if not entry or entry[2] <= time.monotonic():
+            self.entries.pop(key, None)
+            self.misses += 1
+            return False, None
+        self.entries.move_to_end(key)
+        if entry[0] is None:
+            self.negative_hits += 1
+            return True, None
+        self.hits += 1
+        return True, dict(entry[0])
+    
+    def put(self, token: str, user_doc: dict, session_expires_at: datetime):
+        remaining = (session_expires_at - datetime.now(timezone.utc)).total_seconds()
+        ttl = min(SESSION_CACHE_TTL, remaining)
+        if ttl > 0:
+            user_id = user_doc.get("id") or user_doc.get("user_id")
+            self._store(token_digest(token), (dict(user_doc), user_id, time.monotonic() + ttl))
+    
+    def put_negative(self, token: str):
+        self._store(token_digest(token), (None, None, time.monotonic() + SESSION_NEGATIVE_TTL))
+    
+    def _store(self, key: str, entry: tuple):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+    
+    def invalidate(self, token: str):
+        self.entries.pop(token_digest(token), None)
+    
+    def invalidate_user(self, user_id: str):
+        stale = [key for key, entry in self.entries.items() if entry[1] == user_id]
+        for key in stale:
+            del self.entries[key]
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.negative_hits) / lookups, 4) if lookups else 0.0
+        }
+
+session_cache = SessionCache(SESSION_CACHE_SIZE)
+
+# ============ RESPONSE CACHE ============
+# Rendered bodies of public, rarely-changing GET endpoints, per worker. Each route
+# picks a namespace and TTL; admin writes invalidate their namespace by bumping a
+# generation counter in db.cache_generations, which every worker polls, so entries
+# built before the write stop being served everywhere within a few seconds.
+# Responses carry a strong ETag (If-None-Match -> 304) and Cache-Control so a CDN
+# can serve them too.
+
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '2048'))
+RESPONSE_CACHE_SYNC_SECONDS = float(os.getenv('RESPONSE_CACHE_SYNC_SECONDS', '2'))
+
+class ResponseCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (body, etag, media_type, expires_at, namespace, generation)
+        self.generations = {}  # namespace -> latest generation seen in db.cache_generations
+        self.inflight = {}  # key -> future, so concurrent misses build once
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+    
+    @staticmethod
+    def cache_key(namespace: str, request: Request, params: tuple = ()) -> str:
+        """Key on the path plus only the query params the route reads, so junk params cannot fragment the cache"""
+        query = "&".join(f"{name}={request.query_params[name]}" for name in sorted(params) if name in request.query_params)
+        return f"{namespace}:{request.url.path}?{query}"
+    
+    async def serve(self, request: Request, namespace: str, ttl: int, build, media_type: str = "application/json", params: tuple = ()):
+        """Return a cached Response for this request, building the body with `build()` on a miss.
+        
+        `build` returns bytes, or any JSON-serializable value for application/json.
+        `params` lists the query parameters that change the body.
+        """
+        key = self.cache_key(namespace, request, params)
+        entry = self.lookup(key)
+        if entry is None:
+            entry = await self._build(key, namespace, ttl, build, media_type)
+        return self.respond(request, entry, ttl)
+    
+    async def serve_stream(self, request: Request, namespace: str, ttl: int, chunks, media_type: str, params: tuple = ()):
+        """Like serve(), but for large bodies produced by `chunks()`, an async generator of bytes.
+        
+        A miss streams straight to the client and is stored once the generator
+        finishes, so the next request gets an ETag. Misses are not single-flighted.
+        """
+        key = self.cache_key(namespace, request, params)
+        entry = self.lookup(key)
+        if entry is not None:
+            return self.respond(request, entry, ttl)
+        generation = self.generations.get(namespace, 0)
+        
+        async def body():
+            parts = []
+            async for chunk in chunks():
+                parts.append(chunk)
+                yield chunk
+            self.store(key, namespace, ttl, b"".join(parts), media_type, generation)
+        
+        return StreamingResponse(body(), media_type=media_type, headers={"Cache-Control": f"public, max-age={ttl}"})
+    
+    def lookup(self, key: str):
+        entry = self.entries.get(key)
+        if entry and entry[3] > time.monotonic() and entry[5] == self.generations.get(entry[4], 0):
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+    
+    def respond(self, request: Request, entry: tuple, ttl: int) -> Response:
+        body, etag, media_type = entry[:3]
+        headers = {"ETag": etag, "Cache-Control": f"public, max-age={ttl}, stale-while-revalidate={ttl}"}
+        if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+            self.not_modified += 1
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type=media_type, headers=headers)
+    
+    def store(self, key: str, namespace: str, ttl: int, body: bytes, media_type: str, generation: int) -> tuple:
+        etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        entry = (body, etag, media_type, time.monotonic() + ttl, namespace, generation)
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry
+    
+    async def _build(self, key: str, namespace: str, ttl: int, build, media_type: str):
+        if key in self.inflight:
+            return await asyncio.shield(self.inflight[key])
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        # Tag the entry with the generation the build started under, so an invalidation
+        # that lands mid-build leaves it stale instead of cached for the whole TTL
+        generation = self.generations.get(namespace, 0)
+        try:
+            value = await build()
+            body = value if isinstance(value, bytes) else json.dumps(jsonable_encoder(value), separators=(",", ":")).encode()
+            entry = self.store(key, namespace, ttl, body, media_type, generation)
+            future.set_result(entry)
+            return entry
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved when nobody else was waiting
+            raise
+        finally:
+            del self.inflight[key]
+    
+    async def invalidate(self, *namespaces: str):
+        """Drop the namespaces here and bump their generation so every other worker drops them too"""
+        for namespace in namespaces:
+            doc = await db.cache_generations.find_one_and_update(
+                {"_id": namespace},
+                {"$inc": {"generation": 1}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            self.advance(namespace, doc["generation"])
+    
+    def advance(self, namespace: str, generation: int):
+        if generation <= self.generations.get(namespace, 0):
+            return
+        self.generations[namespace] = generation
+        stale = [key for key, entry in self.entries.items() if entry[4] == namespace]
+        for key in stale:
+            del self.entries[key]
+    
+    def drop(self, *namespaces: str):
+        """Local-only invalidation, for callers that already hear about the write on every worker"""
+        stale = [key for key, entry in self.entries.items() if entry[4] in namespaces]
+        for key in stale:
+            del self.entries[key]
+    
+    async def watch_generations(self):
+        """Poll db.cache_generations and drop namespaces other workers invalidated"""
+        while True:
+            try:
+                async for doc in db.cache_generations.find({}):
+                    self.advance(doc["_id"], doc["generation"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Response cache generation sync error: {e}")
+            await asyncio.sleep(RESPONSE_CACHE_SYNC_SECONDS)
+    
+    def stats(self) -> dict:
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+            "generations": dict(self.generations),
+        }
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE)
+
+# ============ BULK ENRICHMENT ============
+# Helpers for decorating a page of rows: gather the ids on the page, resolve each
+# collection with one $in query or one grouped aggregation, join in memory.
+
+async def count_by(collection, field: str, ids: list, sum_field: Optional[str] = None) -> dict:
+    """{id: count} for documents whose `field` is in ids (or the sum of `sum_field`)"""
+    if not ids:
+        return {}
+    pipeline = [
+        {"$match": {field: {"$in": list(set(ids))}}},
+        {"$group": {"_id": f"${field}", "count": {"$sum": f"${sum_field}" if sum_field else 1}}}
+    ]
+    return {row["_id"]: row["count"] async for row in collection.aggregate(pipeline)}
+
+async def users_by_id(user_ids: list, projection: Optional[dict] = None) -> dict:
+    """Users keyed by id; matches both the `id` and legacy `user_id` fields"""
+    if not user_ids:
+        return {}
+    user_ids = list(set(user_ids))
+    fields = {"_id": 0, "id": 1, "user_id": 1, **(projection or {"username": 1, "email": 1})}
+    users = {}
+    async for user in db.users.find({"$or": [{"id": {"$in": user_ids}}, {"user_id": {"$in": user_ids}}]}, fields):
+        users[user.get("id") or user.get("user_id")] = user
+    return users
+
+# ============ BLOB STORE ============
+# Image bytes live outside MongoDB, addressed by their SHA-256. Documents only keep
+# the hash and a URL pointing at GET /api/blobs/{hash}; db.blobs holds the metadata.
+
+BLOB_STORE_BACKEND = os.getenv('BLOB_STORE_BACKEND', 'local')  # local or s3
+BLOB_STORE_PATH = Path(os.getenv('BLOB_STORE_PATH', str(ROOT_DIR / 'blobs')))
+BLOB_S3_BUCKET = os.getenv('BLOB_S3_BUCKET', '')
+BLOB_S3_PREFIX = os.getenv('BLOB_S3_PREFIX', 'blobs/')
+BLOB_S3_ENDPOINT_URL = os.getenv('BLOB_S3_ENDPOINT_URL') or None
+BLOB_CHUNK_SIZE = 64 * 1024
+BLOB_HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+class LocalBlobStore:
+    """Blobs on the local filesystem, sharded by the first two hex digits"""
+    
+    def __init__(self, root: Path):
+        self.root = root
+    
+    def _path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest
+    
+    def _write(self, digest: str, data: bytes):
+        path = self._path(digest)
+        if path.exists():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+    
+    async def put(self, digest: str, data: bytes):
+        await asyncio.to_thread(self._write, digest, data)
+    
+    async def iter_range(self, digest: str, start: int, end: int):
+        """Yield bytes start..end (inclusive)"""
+        handle = await asyncio.to_thread(open, self._path(digest), "rb")
+        try:
+            await asyncio.to_thread(handle.seek, start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = await asyncio.to_thread(handle.read, min(BLOB_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            await asyncio.to_thread(handle.close)
+    
+    async def delete(self, digest: str):
+        await asyncio.to_thread(self._path(digest).unlink, True)
+
+class S3BlobStore:
+    """Blobs in an S3-compatible bucket (AWS, R2, MinIO...) through boto3"""
+    
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: Optional[str] = None):
+        import boto3
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.bucket = bucket
+        self.prefix = prefix
+    
+    def _key(self, digest: str) -> str:
+        return f"{self.prefix}{digest}"
+    
+    async def put(self, digest: str, data: bytes):
+        await asyncio.to_thread(self.client.put_object, Bucket=self.bucket, Key=self._key(digest), Body=data)
+    
+    async def iter_range(self, digest: str, start: int, end: int):
+        response = await asyncio.to_thread(
+            self.client.get_object, Bucket=self.bucket, Key=self._key(digest), Range=f"bytes={start}-{end}"
+        )
+        body = response["Body"]
+        try:
+            while True:
+                chunk = await asyncio.to_thread(body.read, BLOB_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            body.close()
+    
+    async def delete(self, digest: str):
+        await asyncio.to_thread(self.client.delete_object, Bucket=self.bucket, Key=self._key(digest))
+
+if BLOB_STORE_BACKEND == "s3":
+    blob_store = S3BlobStore(BLOB_S3_BUCKET, BLOB_S3_PREFIX, BLOB_S3_ENDPOINT_URL)
+else:
+    blob_store = LocalBlobStore(BLOB_STORE_PATH)
+
+def blob_url(digest: str) -> str:
+    return f"{API_PUBLIC_URL}/api/blobs/{digest}"
+
+async def store_blob(data: bytes, mime_type: str) -> str:
+    """Store bytes once per content hash and return the hash"""
+    digest = hashlib.sha256(data).hexdigest()
+    if not await db.blobs.find_one({"hash": digest}, {"_id": 1}):
+        await blob_store.put(digest, data)
+        await db.blobs.update_one(
+            {"hash": digest},
+            {"$setOnInsert": {
+                "hash": digest,
+                "mime_type": mime_type,
+                "size": len(data),
+                "created_at": datetime.now(timezone.utc).isoformat()
+            }},
+            upsert=True
+        )
+    return digest
+
+async def read_blob(digest: str) -> bytes:
+    meta = await db.blobs.find_one({"hash": digest}, {"_id": 0, "size": 1})
+    if not meta:
+        raise KeyError(digest)
+    chunks = [chunk async for chunk in blob_store.iter_range(digest, 0, meta["size"] - 1)]
+    return b"".join(chunks)
+
+def parse_data_url(data_url: str):
+    """Split a base64 data: URL into (bytes, mime_type)"""
+    header, _, payload = data_url.partition(",")
+    mime_type = header[len("data:"):].split(";")[0] or "application/octet-stream"
+    return base64.b64decode(payload), mime_type
+
+# ============ IMAGE VARIANTS ============
+# Thumbnails and width variants are rendered with Pillow in a process pool so the
+# event loop never blocks on image encoding. Each variant is stored as its own blob
+# and recorded on the owning document as {name: hash}.
+
+IMAGE_VARIANT_WORKERS = int(os.getenv('IMAGE_VARIANT_WORKERS', '2'))
+image_variant_executor = None
+
+def get_image_variant_executor() -> ProcessPoolExecutor:
+    global image_variant_executor
+    if image_variant_executor is None:
+        # spawn keeps the workers clear of the event loop and driver threads of this process
+        image_variant_executor = ProcessPoolExecutor(
+            max_workers=IMAGE_VARIANT_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return image_variant_executor
+
+async def build_image_variants(digest: str) -> dict:
+    """Render and store every variant of a blob, returning {variant name: blob hash}"""
+    data = await read_blob(digest)
+    loop = asyncio.get_running_loop()
+    rendered = await loop.run_in_executor(get_image_variant_executor(), render_image_variants, data)
+    variants = {}
+    for name, variant_data, mime_type in rendered:
+        variants[name] = await store_blob(variant_data, mime_type)
+    return variants
+
+def variant_urls(variants: Optional[dict]) -> dict:
+    return {name: blob_url(digest) for name, digest in (variants or {}).items()}
+
+async def attach_generated_image_variants(image_id: str, digest: str):
+    try:
+        variants = await build_image_variants(digest)
+        await db.generated_images.update_one(
+            {"id": image_id},
+            {"$set": {"variants": variants, "thumbnail_url": blob_url(variants["thumb_webp"])}}
+        )
+    except Exception as e:
+        logging.error(f"Image variant generation failed for image {image_id}: {e}")
+
+async def attach_avatar_variants(character_id: str, digest: str):
+    try:
+        variants = await build_image_variants(digest)
+        await db.custom_characters.update_one(
+            {"id": character_id},
+            {"$set": {"avatar_variants": variants, "avatar_thumb_url": blob_url(variants["thumb_webp"])}}
+        )
+        character_repository.invalidate_custom(character_id)
+    except Exception as e:
+        logging.error(f"Avatar variant generation failed for character {character_id}: {e}")
+
 # ============ NOTIFICATION SCHEDULER ============
 
+NOTIFICATION_BATCH_SIZE = 500
+PUSH_CONCURRENCY = int(os.getenv('PUSH_CONCURRENCY', '64'))
+PUSH_PER_HOST_CONCURRENCY = int(os.getenv('PUSH_PER_HOST_CONCURRENCY', '16'))
+MAX_DAILY_NOTIFICATIONS = {"low": 2, "medium": 5, "high": 8}
+
+def in_quiet_hours(prefs: Optional[dict], hour: int) -> bool:
+    quiet_start = prefs.get("quiet_hours_start", 22) if prefs else 22
+    quiet_end = prefs.get("quiet_hours_end", 8) if prefs else 8
+    if quiet_start > quiet_end:  # Overnight quiet hours (e.g., 22:00 - 08:00)
+        return hour >= quiet_start or hour < quiet_end
+    return quiet_start <= hour < quiet_end
+
+def max_daily_notifications(prefs: Optional[dict]) -> int:
+    frequency = prefs.get("frequency", "medium") if prefs else "medium"
+    return MAX_DAILY_NOTIFICATIONS.get(frequency, 5)
+
+VAPID_TOKEN_TTL = 12 * 3600
+VAPID_REFRESH_MARGIN = 300
+PUSH_TTL = os.getenv('PUSH_TTL', '0')
+
+class WebPushClient:
+    """Async Web Push sender.
+
+    One pooled HTTP/2 client is shared by every push: httpx keeps connections
+    per origin, so FCM, Mozilla and Apple each get their own multiplexed pool.
+    Signed VAPID headers are cached per audience until shortly before expiry.
+    """
+    
+    def __init__(self, private_key: str, claims_email: str):
+        if os.path.isfile(private_key):
+            self.vapid = Vapid.from_file(private_key_file=private_key)
+        else:
+            self.vapid = Vapid.from_string(private_key=private_key)
+        self.claims_email = claims_email
+        self.vapid_headers = {}
+        self.http = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(10.0, connect=5.0),
+            limits=httpx.Limits(max_connections=PUSH_CONCURRENCY, max_keepalive_connections=PUSH_CONCURRENCY)
+        )
+    
+    def authorization_headers(self, endpoint: str) -> dict:
+        parsed = urlparse(endpoint)
+        audience = f"{parsed.scheme}://{parsed.netloc}"
+        now = time.time()
+        cached = self.vapid_headers.get(audience)
+        if cached and cached[1] - VAPID_REFRESH_MARGIN > now:
+            return cached[0]
+        
+        expires_at = int(now) + VAPID_TOKEN_TTL
+        headers = self.vapid.sign({"sub": f"mailto:{self.claims_email}", "aud": audience, "exp": expires_at})
+        self.vapid_headers[audience] = (headers, expires_at)
+        return headers
+    
+    async def send(self, subscription_info: dict, data: str) -> httpx.Response:
+        # ECDH + AES-GCM is CPU work, keep it off the event loop
+        encoded = await asyncio.to_thread(WebPusher(subscription_info).encode, data, "aes128gcm")
+        headers = {
+            **self.authorization_headers(subscription_info["endpoint"]),
+            "Content-Encoding": "aes128gcm",
+            "Content-Type": "application/octet-stream",
+            "TTL": PUSH_TTL
+        }
+        return await self.http.post(subscription_info["endpoint"], content=encoded["body"], headers=headers)
+    
+    async def close(self):
+        await self.http.aclose()
+
+web_push_client = None
+
+def get_web_push_client() -> WebPushClient:
+    global web_push_client
+    if web_push_client is None:
+        web_push_client = WebPushClient(VAPID_PRIVATE_KEY, VAPID_CLAIMS_EMAIL)
+    return web_push_client
+
 async def send_push_notification(subscription_info, notification_data):
     """Send a push notification to a user"""
     try:
@@ -621,17 +1828,13 @@ async def send_push_notification(subscription_info, notification_data):
             logging.info(f"Push notification skipped (no VAPID keys): {notification_data.get('title')}")
             return False
         
-        webpush(
-            subscription_info=subscription_info,
-            data=json.dumps(notification_data),
-            vapid_private_key=VAPID_PRIVATE_KEY,
-            vapid_claims={"sub": f"mailto:{VAPID_CLAIMS_EMAIL}"}
-        )
-        return True
-    except WebPushException as e:
-        logging.error(f"Push notification failed: {e}")
+        response = await get_web_push_client().send(subscription_info, json.dumps(notification_data))
+        if response.status_code < 400:
+            return True
+        
+        logging.error(f"Push notification failed: {response.status_code} {response.text[:200]}")
         # If subscription is invalid, mark it inactive
-        if e.response and e.response.status_code in [404, 410]:
+        if response.status_code in [404, 410]:
             await db.push_subscriptions.update_one(
                 {"endpoint": subscription_info.get("endpoint")},
                 {"$set": {"is_active": False}}
@@ -641,232 +1844,1230 @@ async def send_push_notification(subscription_info, notification_data):
         logging.error(f"Push notification error: {e}")
         return False
 
-async def send_random_notifications():
-    """Send random notifications to subscribed users (runs every 2 hours)"""
-    logging.info("Running random notification job...")
+class PushDispatcher:
+    """Sends pushes concurrently with a global cap and a cap per push service host"""
+    
+    def __init__(self, concurrency: int, per_host: int):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.per_host = per_host
+        self.host_semaphores = {}
+    
+    def _host_semaphore(self, endpoint: str) -> asyncio.Semaphore:
+        host = urlparse(endpoint or "").netloc
+        if host not in self.host_semaphores:
+            self.host_semaphores[host] = asyncio.Semaphore(self.per_host)
+        return self.host_semaphores[host]
+    
+    async def send(self, subscription_info: dict, notification_data: dict) -> bool:
+        async with self.semaphore, self._host_semaphore(subscription_info.get("endpoint")):
+            return await send_push_notification(subscription_info, notification_data)
+    
+    async def send_all(self, jobs: list) -> list:
+        return await asyncio.gather(*(self.send(sub, data) for sub, data in jobs))
+
+push_dispatcher = None
+
+def get_push_dispatcher() -> PushDispatcher:
+    # Created lazily so its semaphores bind to the running event loop
+    global push_dispatcher
+    if push_dispatcher is None:
+        push_dispatcher = PushDispatcher(PUSH_CONCURRENCY, PUSH_PER_HOST_CONCURRENCY)
+    return push_dispatcher
+
+async def load_notification_context(user_ids: list, today: str):
+    """Bulk-load preferences, today's sent counts per type and chatted characters for a batch of users"""
+    prefs_by_user = {
+        prefs["user_id"]: prefs
+        async for prefs in db.notification_preferences.find({"user_id": {"$in": user_ids}}, {"_id": 0})
+    }
+    
+    counts_by_user = {}
+    async for row in db.sent_notifications.aggregate([
+        {"$match": {"user_id": {"$in": user_ids}, "date": today}},
+        {"$group": {"_id": {"user_id": "$user_id", "type": "$type"}, "count": {"$sum": 1}}}
+    ]):
+        counts_by_user.setdefault(row["_id"]["user_id"], {})[row["_id"]["type"]] = row["count"]
     
+    chatted_by_user = {}
+    async for row in db.messages.aggregate([
+        {"$match": {"user_id": {"$in": user_ids}}},
+        {"$group": {"_id": "$user_id", "character_ids": {"$addToSet": "$character_id"}}}
+    ]):
+        chatted_by_user[row["_id"]] = row["character_ids"]
+    
+    return prefs_by_user, counts_by_user, chatted_by_user
+
+async def pick_notification_character(chatted_ids: list) -> Optional[dict]:
+    """Pick a character the user has chatted with, or a random one"""
+    character = None
+    if chatted_ids:
+        character = await character_repository.get_default(random.choice(chatted_ids))
+    if not character:
+        character = await character_repository.random_default()
+    return character
+
+def build_push_payload(character: dict, message: str, notification_type: str) -> dict:
+    data = {
+        "url": f"/chat/{character.get('id')}",
+        "character_id": character.get("id")
+    }
+    if notification_type == "inactivity":
+        data["type"] = "inactivity"
+    return {
+        "title": character.get("name"),
+        "body": message,
+        "icon": character.get("avatar_url"),
+        "tag": f"{'inactivity' if notification_type == 'inactivity' else 'lonely'}-{character.get('id')}",
+        "data": data
+    }
+
+async def reserve_notifications(records: list) -> set:
+    """Insert pending sent_notifications rows; returns the indexes of the records this worker now owns"""
     try:
-        # Get all active subscriptions
-        subscriptions = await db.push_subscriptions.find({"is_active": True}).to_list(1000)
-        
-        # Randomly select ~30% of users to send notifications to
-        selected = random.sample(subscriptions, min(len(subscriptions), max(1, len(subscriptions) // 3)))
+        await db.sent_notifications.insert_many(records, ordered=False)
+        return set(range(len(records)))
+    except BulkWriteError as e:
+        failed = {error["index"] for error in e.details.get("writeErrors", [])}
+        non_duplicate = [error for error in e.details.get("writeErrors", []) if error.get("code") != 11000]
+        if non_duplicate:
+            logging.error(f"Notification reservation errors: {non_duplicate[:3]}")
+        return set(range(len(records))) - failed
+
+async def fan_out_notifications(subscriptions: list, notification_type: str, slot: Optional[str] = None) -> int:
+    """Filter a batch of subscriptions, send their pushes concurrently and record deliveries.
+    
+    Every push is reserved in sent_notifications under a unique dedupe key before it
+    is sent, so a retried or duplicated job never notifies the same user twice.
+    """
+    now = datetime.now(timezone.utc)
+    today = now.date().isoformat()
+    user_ids = [sub.get("user_id") for sub in subscriptions]
+    prefs_by_user, counts_by_user, chatted_by_user = await load_notification_context(user_ids, today)
+    
+    jobs, records = [], []
+    targeted = set()
+    for sub in subscriptions:
+        user_id = sub.get("user_id")
+        # The dedupe key is per user, so each user gets one push through a single subscription
+        if user_id in targeted or not sub.get("endpoint"):
+            continue
+        prefs = prefs_by_user.get(user_id)
+        if prefs and not prefs.get("enabled", True):
+            continue
         
-        sent_count = 0
-        for sub in selected:
-            user_id = sub.get("user_id")
-            
-            # Check preferences and limits
-            prefs = await db.notification_preferences.find_one({"user_id": user_id})
-            if prefs and not prefs.get("enabled", True):
+        counts = counts_by_user.get(user_id, {})
+        if notification_type == "inactivity":
+            # At most one inactivity notification per day
+            if counts.get("inactivity"):
                 continue
-            
-            # Check quiet hours
-            current_hour = datetime.now(timezone.utc).hour
-            quiet_start = prefs.get("quiet_hours_start", 22) if prefs else 22
-            quiet_end = prefs.get("quiet_hours_end", 8) if prefs else 8
-            
-            if quiet_start > quiet_end:
-                if current_hour >= quiet_start or current_hour < quiet_end:
-                    continue
-            else:
-                if quiet_start <= current_hour < quiet_end:
-                    continue
-            
-            # Check daily limit
-            today = datetime.now(timezone.utc).date().isoformat()
-            daily_count = await db.sent_notifications.count_documents({
-                "user_id": user_id,
-                "date": today
-            })
-            
-            frequency = prefs.get("frequency", "medium") if prefs else "medium"
-            max_daily = {"low": 2, "medium": 5, "high": 8}.get(frequency, 5)
-            
-            if daily_count >= max_daily:
+        else:
+            if in_quiet_hours(prefs, now.hour):
                 continue
-            
-            # Generate notification
-            # Pick a character the user has chatted with or random
-            character = None
-            recent_chats = await db.messages.aggregate([
-                {"$match": {"chat_id": {"$regex": f"^{user_id}_"}}},
-                {"$group": {"_id": {"$arrayElemAt": [{"$split": ["$chat_id", "_"]}, 1]}}},
-                {"$sample": {"size": 1}}
-            ]).to_list(1)
-            
-            if recent_chats:
-                char_id = recent_chats[0]["_id"]
-                character = await db.characters.find_one({"id": char_id}, {"_id": 0})
-            
-            if not character:
-                chars = await db.characters.aggregate([{"$sample": {"size": 1}}]).to_list(1)
-                if chars:
-                    character = chars[0]
-                    character.pop("_id", None)
-            
-            if not character:
+            if sum(counts.values()) >= max_daily_notifications(prefs):
                 continue
-            
-            message = random.choice(LONELY_MESSAGES)
-            
-            notification_data = {
-                "title": character.get("name"),
-                "body": message,
-                "icon": character.get("avatar_url"),
-                "tag": f"lonely-{character.get('id')}",
-                "data": {
-                    "url": f"/chat/{character.get('id')}",
-                    "character_id": character.get("id")
-                }
-            }
-            
-            # Send push notification
-            subscription_info = {
-                "endpoint": sub.get("endpoint"),
-                "keys": sub.get("keys", {})
-            }
-            
-            success = await send_push_notification(subscription_info, notification_data)
-            
-            if success:
-                # Record the notification
-                await db.sent_notifications.insert_one({
-                    "user_id": user_id,
-                    "character_id": character.get("id"),
-                    "message": message,
-                    "date": today,
-                    "timestamp": datetime.now(timezone.utc).isoformat(),
-                    "type": "random",
-                    "delivered": True
-                })
-                sent_count += 1
         
-        logging.info(f"Random notifications sent: {sent_count}/{len(selected)}")
-    except Exception as e:
-        logging.error(f"Random notification job error: {e}")
+        character = await pick_notification_character(chatted_by_user.get(user_id, []))
+        if not character:
+            continue
+        
+        message = random.choice(INACTIVITY_MESSAGES if notification_type == "inactivity" else LONELY_MESSAGES)
+        targeted.add(user_id)
+        jobs.append((
+            {"endpoint": sub.get("endpoint"), "keys": sub.get("keys", {})},
+            build_push_payload(character, message, notification_type)
+        ))
+        records.append({
+            "user_id": user_id,
+            "character_id": character.get("id"),
+            "message": message,
+            "date": today,
+            "timestamp": now.isoformat(),
+            "type": notification_type,
+            "delivered": False,
+            "dedupe_key": f"{user_id}:{notification_type}:{today}" + (f":{slot}" if slot else "")
+        })
+    
+    if not jobs:
+        return 0
+    
+    reserved = await reserve_notifications(records)
+    pending = [(job, record) for i, (job, record) in enumerate(zip(jobs, records)) if i in reserved]
+    if not pending:
+        return 0
+    
+    # Resolve each reservation by its own row (insert_many filled in _id) so one
+    # failed push can never release a row another push already delivered
+    results = await get_push_dispatcher().send_all([job for job, _ in pending])
+    delivered = [record["_id"] for (_, record), success in zip(pending, results) if success]
+    failed = [record["_id"] for (_, record), success in zip(pending, results) if not success]
+    if delivered:
+        await db.sent_notifications.update_many({"_id": {"$in": delivered}}, {"$set": {"delivered": True}})
+    if failed:
+        # Release the reservation so a later run can try again
+        await db.sent_notifications.delete_many({"_id": {"$in": failed}, "delivered": False})
+    return len(delivered)
+
+async def send_random_notifications(job: dict) -> dict:
+    """Send random notifications to subscribed users (every 2 hours)"""
+    stats = job.get("stats") or {"scanned": 0, "selected": 0, "sent": 0}
+    cursor = job.get("cursor")
+    
+    while True:
+        query = {"is_active": True}
+        if cursor is not None:
+            query["_id"] = {"$gt": cursor}
+        scanned = await db.push_subscriptions.find(
+            query, {"user_id": 1, "endpoint": 1, "keys": 1}
+        ).sort("_id", 1).limit(NOTIFICATION_BATCH_SIZE).to_list(NOTIFICATION_BATCH_SIZE)
+        if not scanned:
+            break
+        
+        # Randomly select ~30% of users to send notifications to
+        batch = [sub for sub in scanned if random.random() < 1 / 3]
+        if batch:
+            stats["sent"] += await fan_out_notifications(batch, "random", slot=job["slot"])
+        stats["scanned"] += len(scanned)
+        stats["selected"] += len(batch)
+        cursor = scanned[-1]["_id"]
+        await checkpoint_job(job, cursor, stats)
+    
+    logging.info(f"Random notifications sent: {stats['sent']}/{stats['selected']}")
+    return stats
+
+async def send_inactivity_notifications(job: dict) -> dict:
+    """Send notifications to users inactive for more than 6 hours (every 4 hours)"""
+    stats = job.get("stats") or {"scanned": 0, "sent": 0}
+    cursor = job.get("cursor")
+    threshold = datetime.fromisoformat(job["slot"]) - timedelta(hours=6)
+    
+    while True:
+        query = {"last_active": {"$lt": threshold.isoformat()}}
+        if cursor is not None:
+            query["_id"] = {"$gt": cursor}
+        users = await db.users.find(
+            query, {"id": 1, "user_id": 1}
+        ).sort("_id", 1).limit(NOTIFICATION_BATCH_SIZE).to_list(NOTIFICATION_BATCH_SIZE)
+        if not users:
+            break
+        
+        user_ids = [user.get("id") or user.get("user_id") for user in users]
+        subscriptions = await db.push_subscriptions.find(
+            {"user_id": {"$in": user_ids}, "is_active": True},
+            {"_id": 0, "user_id": 1, "endpoint": 1, "keys": 1}
+        ).to_list(len(user_ids))
+        if subscriptions:
+            stats["sent"] += await fan_out_notifications(subscriptions, "inactivity")
+        stats["scanned"] += len(users)
+        cursor = users[-1]["_id"]
+        await checkpoint_job(job, cursor, stats)
+    
+    logging.info(f"Inactivity notifications sent: {stats['sent']}/{stats['scanned']}")
+    return stats
+
+# ============ ANALYTICS ROLLUPS ============
+# Hourly and daily counters for the admin dashboard, kept in db.analytics_rollups
+# as one small document per (metric, granularity, bucket). Per-user and
+# per-character message totals live in db.analytics_totals for the leaderboards.
+# A catch-up job folds new documents in from a per-source _id watermark; it only
+# reads documents older than ROLLUP_LAG so late inserts with slightly older ids
+# are not skipped. Counters record creations, so later deletes do not lower them.
+# Before a batch is written its last _id is recorded on the watermark as
+# pending_last_id, and every counter document remembers the last batch folded
+# into it. After a crash between the counter writes and the watermark update the
+# next run replays exactly that _id range under the same batch id first, so the
+# counters it already reached are skipped instead of counted twice.
+
+ROLLUP_BATCH_SIZE = 5000
+ROLLUP_LAG = timedelta(seconds=60)
+ROLLUP_LOCK_SECONDS = 300
+
+# metric -> (source collection, timestamp field)
+ROLLUP_SOURCES = {
+    "messages": ("messages", "timestamp"),
+    "signups": ("users", "created_at"),
+    "images": ("generated_images", "created_at"),
+    "favorites": ("favorites", "created_at"),
+}
 
-async def send_inactivity_notifications():
-    """Send notifications to inactive users (runs every 4 hours)"""
-    logging.info("Running inactivity notification job...")
+def rollup_buckets(doc: dict, field: str):
+    """(hour bucket, day bucket) for a source document, e.g. ('2026-10-17T13', '2026-10-17')"""
+    value = doc.get(field)
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            value = None
+    if not isinstance(value, datetime):
+        value = doc["_id"].generation_time
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    value = value.astimezone(timezone.utc)
+    return value.strftime("%Y-%m-%dT%H"), value.strftime("%Y-%m-%d")
+
+def rollup_increment(filter_id: str, field: str, count: int, batch_last: ObjectId, fields: dict) -> UpdateOne:
+    """Upsert that adds `count` to `field` unless this batch was already folded into the document"""
+    applied = {"$lt": [{"$ifNull": ["$last_id", None]}, batch_last]}
+    return UpdateOne(
+        {"_id": filter_id},
+        [{"$set": {
+            field: {"$cond": [applied, {"$add": [{"$ifNull": [f"${field}", 0]}, count]}, f"${field}"]},
+            "last_id": {"$max": ["$last_id", batch_last]},
+            **{name: {"$literal": value} for name, value in fields.items()},
+        }}],
+        upsert=True
+    )
+
+async def catch_up_rollup(metric: str) -> int:
+    """Fold documents past the watermark for one metric into the rollups"""
+    collection_name, field = ROLLUP_SOURCES[metric]
+    collection = db[collection_name]
+    projection = {field: 1}
+    if metric == "messages":
+        projection.update({"user_id": 1, "character_id": 1, "chat_id": 1})
+    
+    watermark = await db.analytics_watermarks.find_one({"_id": metric}) or {}
+    last_id = watermark.get("last_id")
+    pending = watermark.get("pending_last_id")
+    upper = ObjectId.from_datetime(datetime.now(timezone.utc) - ROLLUP_LAG)
+    processed = 0
+    
+    while True:
+        # Renew the rollup lease before each batch; once it lapsed another worker owns the rollup
+        if not await acquire_lock("analytics_rollup", ROLLUP_LOCK_SECONDS):
+            logging.warning(f"Lost the analytics rollup lock, stopping {metric} catch-up at {last_id}")
+            break
+        if pending is not None:
+            # An interrupted batch: replay exactly its range under its original batch id
+            id_range = {"$lte": pending}
+            if last_id is not None:
+                id_range["$gt"] = last_id
+            docs = await collection.find({"_id": id_range}, projection).sort("_id", 1).to_list(None)
+            batch_last = pending
+        else:
+            id_range = {"$lt": upper}
+            if last_id is not None:
+                id_range["$gt"] = last_id
+            docs = await collection.find({"_id": id_range}, projection).sort("_id", 1).limit(ROLLUP_BATCH_SIZE).to_list(ROLLUP_BATCH_SIZE)
+            if not docs:
+                break
+            batch_last = docs[-1]["_id"]
+            await db.analytics_watermarks.update_one(
+                {"_id": metric}, {"$set": {"pending_last_id": batch_last}}, upsert=True
+            )
+        
+        counts = {}
+        totals = {}
+        for doc in docs:
+            hour, day = rollup_buckets(doc, field)
+            for granularity, bucket in (("hour", hour), ("day", day)):
+                counts[(granularity, bucket)] = counts.get((granularity, bucket), 0) + 1
+            if metric == "messages":
+                owner = {"user": doc.get("user_id"), "character": doc.get("character_id")}
+                if not all(owner.values()) and doc.get("chat_id"):
+                    # Migration 0001 may not have backfilled the owner fields on this message yet
+                    owner = dict(zip(("user", "character"), split_chat_id(doc["chat_id"])))
+                for kind, key in owner.items():
+                    if key:
+                        totals[(kind, key)] = totals.get((kind, key), 0) + 1
+        
+        if counts:
+            await db.analytics_rollups.bulk_write([
+                rollup_increment(
+                    f"{metric}:{granularity}:{bucket}", "count", count, batch_last,
+                    {"metric": metric, "granularity": granularity, "bucket": bucket}
+                )
+                for (granularity, bucket), count in counts.items()
+            ], ordered=False)
+        if totals:
+            await db.analytics_totals.bulk_write([
+                rollup_increment(f"{kind}:{key}", "messages", count, batch_last, {"kind": kind, "key": key})
+                for (kind, key), count in totals.items()
+            ], ordered=False)
+        
+        last_id, pending = batch_last, None
+        await db.analytics_watermarks.update_one(
+            {"_id": metric},
+            {"$set": {"last_id": last_id, "updated_at": datetime.now(timezone.utc).isoformat()}, "$unset": {"pending_last_id": ""}},
+            upsert=True
+        )
+        processed += len(docs)
     
+    return processed
+
+async def catch_up_rollups(metrics: Optional[list] = None) -> dict:
+    """Run the catch-up for every metric under a lock so the job and the CLI never overlap"""
+    if not await acquire_lock("analytics_rollup", ROLLUP_LOCK_SECONDS):
+        logging.info("Analytics rollup already running elsewhere, skipping")
+        return {"skipped": True}
     try:
-        # Find users inactive for more than 6 hours
-        threshold = datetime.now(timezone.utc) - timedelta(hours=6)
-        
-        inactive_users = await db.users.find({
-            "last_active": {"$lt": threshold.isoformat()}
-        }, {"_id": 0, "id": 1, "user_id": 1}).to_list(500)
+        return {metric: await catch_up_rollup(metric) for metric in (metrics or ROLLUP_SOURCES)}
+    finally:
+        await release_lock("analytics_rollup")
+
+async def rebuild_rollups(metrics: Optional[list] = None) -> dict:
+    """Drop and recompute rollups from scratch (backfills, drift repair)"""
+    metrics = metrics or list(ROLLUP_SOURCES)
+    if not await acquire_lock("analytics_rollup", ROLLUP_LOCK_SECONDS):
+        raise RuntimeError("Analytics rollup is running on another worker, retry later")
+    try:
+        await db.analytics_rollups.delete_many({"metric": {"$in": metrics}})
+        await db.analytics_watermarks.delete_many({"_id": {"$in": metrics}})
+        if "messages" in metrics:
+            await db.analytics_totals.delete_many({})
+    finally:
+        await release_lock("analytics_rollup")
+    return await catch_up_rollups(metrics)
+
+async def run_analytics_rollup_job(job: dict) -> dict:
+    return await catch_up_rollups()
+
+async def read_rollup_series(metric: str, granularity: str, buckets: list) -> list:
+    """Counts for the given buckets, in order, with 0 for buckets that have no document"""
+    docs = await db.analytics_rollups.find(
+        {"metric": metric, "granularity": granularity, "bucket": {"$in": buckets}},
+        {"_id": 0, "bucket": 1, "count": 1}
+    ).to_list(len(buckets))
+    counts = {doc["bucket"]: doc["count"] for doc in docs}
+    return [counts.get(bucket, 0) for bucket in buckets]
+
+def recent_day_buckets(days: int) -> list:
+    today = datetime.now(timezone.utc)
+    return [(today - timedelta(days=i)).strftime("%Y-%m-%d") for i in reversed(range(days))]
+
+def recent_hour_buckets(hours: int) -> list:
+    now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    return [now - timedelta(hours=i) for i in reversed(range(hours))]
+
+# ============ GREETING POOL ============
+# A greeting depends only on the character, so a few are generated ahead of time
+# per built-in character in db.greeting_pool. Opening a chat pops one; dropping
+# below the low-water mark enqueues a refill job. Custom characters are private to
+# one user, so they always generate live rather than paying for a pool nobody
+# shares. Entries carry a hash of the prompt they were generated from; after an
+# edit, entries from the old prompt (including ones an in-flight refill inserts
+# late) are never served and get swept on the next refill.
+
+GREETING_POOL_SIZE = int(os.getenv('GREETING_POOL_SIZE', '5'))
+GREETING_POOL_LOW_WATER = int(os.getenv('GREETING_POOL_LOW_WATER', '2'))
+
+def build_greeting_prompt(character: dict) -> str:
+    return f"""You are {character['name']}, age {character['age']}. {character['personality']}
+Your traits: {', '.join(character['traits'])}.
+
+Generate a fun, flirty greeting to someone who just started chatting with you. 
+- Be playful and warm
+- Add cute emojis like 😊 💕 🥰 😘 💖 ✨ 💋 😍 🌸 💗 😉 🙈 💓
+- Show excitement to meet them
+- NEVER use hyphens
+- Keep it 1-2 sentences max
+- Make them feel special and welcomed"""
+
+def greeting_version(character: dict) -> str:
+    return hashlib.sha256(build_greeting_prompt(character).encode()).hexdigest()[:16]
+
+async def generate_greeting(character: dict, session_id: Optional[str] = None) -> str:
+    greeting = await llm_gateway.complete(build_greeting_prompt(character), "Say hi to me!", session_id=session_id)
+    return strip_hyphens(greeting)
+
+async def pop_pooled_greeting(character: dict) -> Optional[str]:
+    """Take the oldest current pooled greeting for a built-in character, scheduling a refill when running low"""
+    if character.get("is_custom"):
+        return None
+    character_id = character["id"]
+    query = {"character_id": character_id, "version": greeting_version(character)}
+    doc = await db.greeting_pool.find_one_and_delete(query, sort=[("created_at", 1)])
+    remaining = await db.greeting_pool.count_documents(query, limit=GREETING_POOL_LOW_WATER)
+    if remaining < GREETING_POOL_LOW_WATER:
+        now = datetime.now(timezone.utc)
+        # At most one refill per character per minute across all workers
+        await enqueue_job("greeting_refill", f"{character_id}:{int(now.timestamp()) // 60}", now, {"character_id": character_id})
+    return doc["text"] if doc else None
+
+async def refill_greeting_pool(character_id: str) -> int:
+    character = await character_repository.get_default(character_id)
+    if not character:
+        return 0
+    version = greeting_version(character)
+    await db.greeting_pool.delete_many({"character_id": character_id, "version": {"$ne": version}})
+    missing = GREETING_POOL_SIZE - await db.greeting_pool.count_documents({"character_id": character_id, "version": version})
+    if missing <= 0:
+        return 0
+    
+    results = await asyncio.gather(*(generate_greeting(character) for _ in range(missing)), return_exceptions=True)
+    now = datetime.now(timezone.utc).isoformat()
+    docs = [
+        {"character_id": character_id, "version": version, "text": text, "created_at": now}
+        for text in results if isinstance(text, str) and text
+    ]
+    failures = [result for result in results if isinstance(result, Exception)]
+    if failures:
+        logging.warning(f"{len(failures)} greeting generations failed for {character_id}: {failures[0]}")
+    if docs:
+        await db.greeting_pool.insert_many(docs)
+    return len(docs)
+
+async def forget_generated_replies(character_id: str):
+    """Drop pooled greetings and cached openers after a character is edited or deleted"""
+    await db.greeting_pool.delete_many({"character_id": character_id})
+    await opener_cache.clear(character_id)
+
+async def run_greeting_refill_job(job: dict) -> dict:
+    return {"added": await refill_greeting_pool(job["payload"]["character_id"])}
+
+async def run_greeting_warm_job(job: dict) -> dict:
+    """Top up the pools of default characters that have run low"""
+    characters = await character_repository.list_defaults()
+    pipeline = [
+        {"$match": {"character_id": {"$in": [character["id"] for character in characters]}}},
+        {"$group": {"_id": {"character_id": "$character_id", "version": "$version"}, "count": {"$sum": 1}}}
+    ]
+    counts = {(row["_id"]["character_id"], row["_id"].get("version")): row["count"] async for row in db.greeting_pool.aggregate(pipeline)}
+    added = 0
+    for character in characters:
+        # Only greetings for the current prompt count; stale ones are swept by the refill
+        if counts.get((character["id"], greeting_version(character)), 0) < GREETING_POOL_LOW_WATER:
+            added += await refill_greeting_pool(character["id"])
+    return {"added": added}
+
+# ============ OPENER CACHE ============
+# Opt-in (OPENER_CACHE_ENABLED). Short first messages like "hi" or "how are you??"
+# to a character are answered from db.opener_cache, keyed on the character and
+# the normalized text. Each key holds up to OPENER_CACHE_VARIANTS replies and
+# only serves once it is full, picking one at random so replies don't repeat
+# verbatim. Anything sent after the user's first turn bypasses the cache.
+
+OPENER_CACHE_ENABLED = os.getenv('OPENER_CACHE_ENABLED', 'false').lower() == 'true'
+OPENER_CACHE_VARIANTS = int(os.getenv('OPENER_CACHE_VARIANTS', '5'))
+OPENER_CACHE_TTL = timedelta(hours=int(os.getenv('OPENER_CACHE_TTL_HOURS', '24')))
+OPENER_CACHE_PER_CHARACTER = int(os.getenv('OPENER_CACHE_PER_CHARACTER', '200'))
+OPENER_MAX_CHARS = 40
+
+class OpenerCache:
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+    
+    @staticmethod
+    def normalize(message: str) -> Optional[str]:
+        """Lowercase, drop punctuation, squeeze letter runs of 3+ ("heyyy!!" -> "hey"); None if not an opener.
         
-        sent_count = 0
-        for user in inactive_users:
-            user_id = user.get("id") or user.get("user_id")
-            
-            # Check if user has active push subscription
-            sub = await db.push_subscriptions.find_one({"user_id": user_id, "is_active": True})
-            if not sub:
-                continue
-            
-            # Check if we already sent an inactivity notification today
-            today = datetime.now(timezone.utc).date().isoformat()
-            existing = await db.sent_notifications.find_one({
-                "user_id": user_id,
-                "date": today,
-                "type": "inactivity"
-            })
-            if existing:
-                continue
-            
-            # Check preferences
-            prefs = await db.notification_preferences.find_one({"user_id": user_id})
-            if prefs and not prefs.get("enabled", True):
-                continue
-            
-            # Pick a character
-            character = None
-            recent_chats = await db.messages.aggregate([
-                {"$match": {"chat_id": {"$regex": f"^{user_id}_"}}},
-                {"$group": {"_id": {"$arrayElemAt": [{"$split": ["$chat_id", "_"]}, 1]}}},
-                {"$sample": {"size": 1}}
-            ]).to_list(1)
-            
-            if recent_chats:
-                char_id = recent_chats[0]["_id"]
-                character = await db.characters.find_one({"id": char_id}, {"_id": 0})
-            
-            if not character:
-                chars = await db.characters.aggregate([{"$sample": {"size": 1}}]).to_list(1)
-                if chars:
-                    character = chars[0]
-                    character.pop("_id", None)
-            
-            if not character:
+        Words in any script are kept. Emojis and other non-ASCII symbols carry
+        meaning the key would lose ("hi 😢" is not "hi"), so those messages bypass
+        the cache. Digits and genuine double letters ("hello", "2 good") are left alone.
+        """
+        text = message.lower()
+        if any(not char.isascii() for char in re.findall(r"[^\w'\s]", text)):
+            return None
+        text = re.sub(r"[^\w']+", " ", text)
+        text = re.sub(r"([^\W\d_])\1{2,}", r"\1", " ".join(text.split()))
+        if not text or len(text) > OPENER_MAX_CHARS:
+            return None
+        return text
+    
+    @staticmethod
+    def has_history(memory: dict) -> bool:
+        # The greeting is an AI turn; only a user turn or a summary counts as history
+        return bool(memory.get("summary")) or any(turn.get("sender") == "user" for turn in memory.get("turns", []))
+    
+    def cache_id(self, character_id: str, message: str, memory: dict) -> Optional[str]:
+        if not self.enabled:
+            return None
+        normalized = None if self.has_history(memory) else self.normalize(message)
+        if normalized is None:
+            self.bypassed += 1
+            return None
+        return f"{character_id}:{normalized}"
+    
+    async def get(self, character_id: str, message: str, memory: dict) -> Optional[str]:
+        cache_id = self.cache_id(character_id, message, memory)
+        if cache_id is None:
+            return None
+        now = datetime.now(timezone.utc)
+        doc = await db.opener_cache.find_one({"_id": cache_id, "expires_at": {"$gt": now}}, {"variants": 1})
+        if not doc or len(doc["variants"]) < OPENER_CACHE_VARIANTS:
+            self.misses += 1
+            return None
+        self.hits += 1
+        spawn_background(db.opener_cache.update_one({"_id": cache_id}, {"$inc": {"hits": 1}, "$set": {"last_hit_at": now}}))
+        return random.choice(doc["variants"])
+    
+    async def put(self, character_id: str, message: str, memory: dict, reply: str):
+        cache_id = self.cache_id(character_id, message, memory)
+        if cache_id is None:
+            return
+        now = datetime.now(timezone.utc)
+        try:
+            result = await db.opener_cache.update_one(
+                {"_id": cache_id, "expires_at": {"$gt": now}},
+                {
+                    "$push": {"variants": {"$each": [reply], "$slice": -OPENER_CACHE_VARIANTS}},
+                    "$set": {"last_hit_at": now},
+                    "$setOnInsert": {"character_id": character_id, "hits": 0, "expires_at": now + OPENER_CACHE_TTL}
+                },
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # An expired entry the TTL monitor hasn't removed yet; the next put recreates it
+            await db.opener_cache.delete_one({"_id": cache_id, "expires_at": {"$lte": now}})
+            return
+        if result.upserted_id is not None:
+            await self.trim(character_id)
+    
+    async def trim(self, character_id: str):
+        """Evict the least recently hit keys beyond the per-character cap"""
+        excess = await db.opener_cache.count_documents({"character_id": character_id}) - OPENER_CACHE_PER_CHARACTER
+        if excess <= 0:
+            return
+        stale = await db.opener_cache.find({"character_id": character_id}, {"_id": 1}).sort("last_hit_at", 1).limit(excess).to_list(excess)
+        await db.opener_cache.delete_many({"_id": {"$in": [doc["_id"] for doc in stale]}})
+    
+    async def clear(self, character_id: str):
+        await db.opener_cache.delete_many({"character_id": character_id})
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+opener_cache = OpenerCache(OPENER_CACHE_ENABLED)
+
+# ============ IMAGE JOBS ============
+# Image generation runs as jobs in db.jobs so the request returns a job id right
+# away. Each worker runs a few image consumers per plan tier that only claim that
+# tier's jobs, which caps concurrent generations per tier. Submissions are
+# deduplicated on the client's Idempotency-Key, and like every job they resume
+# after a restart once the lease lapses. Clients poll /images/jobs/{id}; users
+# with an active push subscription also get a push when the image is ready.
+
+IMAGE_JOB_TYPE = "image_generation"
+IMAGE_TIER_CONCURRENCY = {
+    "free": int(os.getenv('IMAGE_WORKERS_FREE', '1')),
+    "premium": int(os.getenv('IMAGE_WORKERS_PREMIUM', '3')),
+}
+IMAGE_JOB_POLL_SECONDS = 5
+IMAGE_JOB_SYSTEM_MESSAGES = {
+    "character": "You are an AI image generator.",
+    "standalone": "You are an AI image generator.",
+    "avatar": "You are an AI image generator specializing in character avatars.",
+}
+IMAGE_JOB_PROJECTION = {"_id": 0, "id": 1, "status": 1, "stats": 1, "error": 1, "attempts": 1, "run_at": 1}
+image_job_wakeup = None  # asyncio.Event set on submit so local consumers skip the poll wait
+
+async def user_plan_tier(user_id: Optional[str]) -> str:
+    if not user_id:
+        return "free"
+    user = await db.users.find_one({"$or": [{"id": user_id}, {"user_id": user_id}]}, {"_id": 0, "subscription": 1})
+    subscription = (user or {}).get("subscription") or {}
+    if subscription.get("status") == "active" and subscription.get("end_date", "") > datetime.now(timezone.utc).isoformat():
+        return "premium"
+    return "free"
+
+def image_job_response(job: dict) -> dict:
+    response = {"job_id": job["id"], "status": job["status"]}
+    if job["status"] == "done":
+        response["result"] = job.get("stats")
+    elif job.get("error"):
+        response["error"] = job["error"]
+    if job["status"] in ("pending", "running"):
+        # A pending job with attempts > 0 has a retry scheduled at run_at; clients keep polling until then
+        response.update({
+            "attempts": job.get("attempts", 0),
+            "max_attempts": JOB_ATTEMPT_LIMITS[IMAGE_JOB_TYPE],
+            "run_at": job.get("run_at"),
+        })
+    return response
+
+async def submit_image_job(request: Request, user_id: Optional[str], payload: dict) -> dict:
+    """Enqueue an image job, once per Idempotency-Key, and return the job"""
+    idempotency_key = request.headers.get("idempotency-key")
+    slot = f"{payload['kind']}:{user_id or 'anonymous'}:{idempotency_key}" if idempotency_key else str(uuid.uuid4())
+    tier = await user_plan_tier(user_id)
+    await enqueue_job(IMAGE_JOB_TYPE, slot, datetime.now(timezone.utc), {**payload, "user_id": user_id, "tier": tier})
+    if image_job_wakeup is not None:
+        image_job_wakeup.set()
+    return await db.jobs.find_one({"type": IMAGE_JOB_TYPE, "slot": slot}, IMAGE_JOB_PROJECTION)
+
+def image_job_accepted(job: dict) -> JSONResponse:
+    return JSONResponse(status_code=202, content={**image_job_response(job), "poll_url": f"/api/images/jobs/{job['id']}"})
+
+async def notify_image_ready(job: dict, result: dict):
+    user_id = job["payload"].get("user_id")
+    if not user_id:
+        return
+    subscriptions = await db.push_subscriptions.find(
+        {"user_id": user_id, "is_active": True}, {"_id": 0, "endpoint": 1, "keys": 1}
+    ).to_list(10)
+    if not subscriptions:
+        return
+    kind = job["payload"]["kind"]
+    url = f"/chat/{job['payload']['character_id']}" if kind in ("character", "avatar") else "/generate-image"
+    notification = {
+        "title": "Your avatar is ready ✨" if kind == "avatar" else "Your image is ready ✨",
+        "body": truncate_preview(job["payload"].get("user_prompt", job["payload"]["prompt"]), 80),
+        "icon": result["image_url"],
+        "tag": f"image-{job['id']}",  # a retried job replaces its notification instead of adding one
+        "data": {"url": url, "type": "image_ready", "job_id": job["id"]}
+    }
+    await get_push_dispatcher().send_all([(sub, notification) for sub in subscriptions])
+
+async def run_image_job(job: dict) -> dict:
+    payload = job["payload"]
+    kind = payload["kind"]
+    
+    # A reclaimed job whose image was already stored skips the model call
+    stored = job.get("cursor")
+    if not stored:
+        images = await llm_gateway.generate_images(payload["prompt"], system_message=IMAGE_JOB_SYSTEM_MESSAGES[kind])
+        digest = await store_blob(base64.b64decode(images[0]['data']), images[0]['mime_type'])
+        stored = {"blob": digest, "mime_type": images[0]['mime_type']}
+        await checkpoint_job(job, stored, None)
+    
+    digest, mime_type = stored["blob"], stored["mime_type"]
+    result = {"image_url": blob_url(digest), "mime_type": mime_type}
+    if kind == "standalone":
+        # Keyed on the job id so a re-run never saves the image twice
+        created = await db.generated_images.update_one(
+            {"id": job["id"]},
+            {"$setOnInsert": {
+                "id": job["id"],
+                "user_id": payload["user_id"],
+                "prompt": payload.get("user_prompt", payload["prompt"]),
+                "image_blob": digest,
+                "image_url": result["image_url"],
+                "mime_type": mime_type,
+                "style": payload.get("style"),
+                "created_at": datetime.now(timezone.utc).isoformat()
+            }},
+            upsert=True
+        )
+        if created.upserted_id is not None:
+            spawn_background(attach_generated_image_variants(job["id"], digest))
+        result["image_id"] = job["id"]
+    elif kind == "avatar":
+        character_id = payload["character_id"]
+        await db.custom_characters.update_one(
+            {"id": character_id},
+            {"$set": {"avatar_url": result["image_url"], "avatar_blob": digest}}
+        )
+        character_repository.invalidate_custom(character_id)
+        spawn_background(attach_avatar_variants(character_id, digest))
+        result["character_id"] = character_id
+    
+    await notify_image_ready(job, result)
+    return result
+
+async def image_worker_loop(tier: str):
+    """Claim and run image jobs of one plan tier"""
+    while True:
+        try:
+            job = await claim_job([IMAGE_JOB_TYPE], {"payload.tier": tier})
+            if job:
+                await run_job(job)
                 continue
-            
-            message = random.choice(INACTIVITY_MESSAGES)
-            
-            notification_data = {
-                "title": character.get("name"),
-                "body": message,
-                "icon": character.get("avatar_url"),
-                "tag": f"inactivity-{character.get('id')}",
-                "data": {
-                    "url": f"/chat/{character.get('id')}",
-                    "character_id": character.get("id"),
-                    "type": "inactivity"
-                }
-            }
-            
-            subscription_info = {
-                "endpoint": sub.get("endpoint"),
-                "keys": sub.get("keys", {})
-            }
-            
-            success = await send_push_notification(subscription_info, notification_data)
-            
-            if success:
-                await db.sent_notifications.insert_one({
-                    "user_id": user_id,
-                    "character_id": character.get("id"),
-                    "message": message,
-                    "date": today,
-                    "timestamp": datetime.now(timezone.utc).isoformat(),
-                    "type": "inactivity",
-                    "delivered": True
-                })
-                sent_count += 1
-        
-        logging.info(f"Inactivity notifications sent: {sent_count}/{len(inactive_users)}")
-    except Exception as e:
-        logging.error(f"Inactivity notification job error: {e}")
-
-def start_notification_scheduler():
-    """Initialize and start the notification scheduler"""
-    # Random notifications every 2 hours
-    scheduler.add_job(
-        send_random_notifications,
-        IntervalTrigger(hours=2),
-        id="random_notifications",
-        replace_existing=True
+        except Exception as e:
+            logging.error(f"Image worker error ({tier}): {e}")
+        try:
+            await asyncio.wait_for(image_job_wakeup.wait(), IMAGE_JOB_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        image_job_wakeup.clear()
+
+# ============ JOB QUEUE ============
+# Jobs live in db.jobs. One elected leader enqueues a job per schedule slot,
+# any worker may claim it. Claims are leases kept alive by heartbeats; a job
+# whose lease lapses (worker crashed or restarted) is reclaimed and resumes
+# from its saved cursor.
+
+WORKER_ID = f"{os.uname().nodename}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+JOB_LEASE_SECONDS = 120
+JOB_HEARTBEAT_SECONDS = 30
+JOB_POLL_SECONDS = 15
+JOB_MAX_ATTEMPTS = 5
+LEADER_LEASE_SECONDS = 60
+LEADER_TICK_SECONDS = 20
+JOB_RETENTION = timedelta(days=7)
+JOB_QUEUE_ENABLED = os.getenv('JOB_QUEUE_ENABLED', 'true').lower() == 'true'
+
+JOB_HANDLERS = {
+    "random_notifications": send_random_notifications,
+    "inactivity_notifications": send_inactivity_notifications,
+    "analytics_rollup": run_analytics_rollup_job,
+    "greeting_refill": run_greeting_refill_job,
+    "greeting_warm": run_greeting_warm_job,
+    IMAGE_JOB_TYPE: run_image_job,
+}
+
+# Claimed by dedicated consumers rather than the general job worker
+DEDICATED_JOB_TYPES = {IMAGE_JOB_TYPE}
+
+# Per-type attempt limits; users are waiting on image jobs, so give up sooner
+JOB_ATTEMPT_LIMITS = {IMAGE_JOB_TYPE: 3}
+
+# Recurring jobs enqueued by the leader: job type -> interval
+JOB_SCHEDULES = {
+    "random_notifications": timedelta(hours=2),
+    "inactivity_notifications": timedelta(hours=4),
+    "analytics_rollup": timedelta(minutes=5),
+    "greeting_warm": timedelta(hours=1),
+}
+
+class JobLeaseLost(Exception):
+    """Raised when a worker no longer owns the job it is running"""
+
+def lease_deadline(seconds: int) -> str:
+    return (datetime.now(timezone.utc) + timedelta(seconds=seconds)).isoformat()
+
+async def enqueue_job(job_type: str, slot: str, run_at: datetime, payload: Optional[dict] = None) -> bool:
+    """Enqueue a job once per (type, slot); returns False if it already exists"""
+    result = await db.jobs.update_one(
+        {"type": job_type, "slot": slot},
+        {"$setOnInsert": {
+            "id": str(uuid.uuid4()),
+            "type": job_type,
+            "slot": slot,
+            "payload": payload or {},
+            "status": "pending",
+            "run_at": run_at.isoformat(),
+            "attempts": 0,
+            "cursor": None,
+            "stats": None,
+            "created_at": datetime.now(timezone.utc).isoformat()
+        }},
+        upsert=True
     )
-    
-    # Inactivity notifications every 4 hours
-    scheduler.add_job(
-        send_inactivity_notifications,
-        IntervalTrigger(hours=4),
-        id="inactivity_notifications",
-        replace_existing=True
+    return result.upserted_id is not None
+
+async def claim_job(job_types: list, extra_filter: Optional[dict] = None) -> Optional[dict]:
+    now = datetime.now(timezone.utc).isoformat()
+    return await db.jobs.find_one_and_update(
+        {
+            "type": {"$in": job_types},
+            "run_at": {"$lte": now},
+            "$or": [
+                {"status": "pending"},
+                {"status": "running", "lease_expires_at": {"$lt": now}}
+            ],
+            **(extra_filter or {})
+        },
+        {
+            "$set": {"status": "running", "owner": WORKER_ID, "lease_expires_at": lease_deadline(JOB_LEASE_SECONDS), "heartbeat_at": now},
+            "$inc": {"attempts": 1}
+        },
+        sort=[("run_at", 1)],
+        return_document=ReturnDocument.AFTER
     )
-    
-    scheduler.start()
-    logging.info("Notification scheduler started")
+
+async def extend_job_lease(job: dict, extra: Optional[dict] = None):
+    now = datetime.now(timezone.utc).isoformat()
+    result = await db.jobs.update_one(
+        {"id": job["id"], "owner": WORKER_ID, "status": "running"},
+        {"$set": {"lease_expires_at": lease_deadline(JOB_LEASE_SECONDS), "heartbeat_at": now, **(extra or {})}}
+    )
+    if result.matched_count == 0:
+        raise JobLeaseLost(job["id"])
+
+async def checkpoint_job(job: dict, cursor, stats: dict):
+    """Persist a job's progress so a reclaimed job resumes where this one stopped"""
+    await extend_job_lease(job, {"cursor": cursor, "stats": stats})
+
+async def heartbeat_job(job: dict):
+    # Keeps the lease alive during long batches; a lost lease surfaces at the next checkpoint
+    try:
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+            await extend_job_lease(job)
+    except JobLeaseLost:
+        return
+    except Exception as e:
+        logging.error(f"Job heartbeat error: {e}")
+
+async def run_job(job: dict):
+    heartbeat = asyncio.create_task(heartbeat_job(job))
+    try:
+        stats = await JOB_HANDLERS[job["type"]](job)
+        await db.jobs.update_one(
+            {"id": job["id"], "owner": WORKER_ID},
+            {"$set": {"status": "done", "stats": stats, "finished_at": datetime.now(timezone.utc).isoformat()},
+             "$unset": {"lease_expires_at": ""}}
+        )
+    except JobLeaseLost:
+        logging.warning(f"Lost lease on job {job['id']} ({job['type']}), another worker will resume it")
+    except Exception as e:
+        logging.error(f"Job {job['id']} ({job['type']}) failed: {e}")
+        failed = job["attempts"] >= JOB_ATTEMPT_LIMITS.get(job["type"], JOB_MAX_ATTEMPTS)
+        retry_at = datetime.now(timezone.utc) + timedelta(seconds=30 * 2 ** job["attempts"])
+        await db.jobs.update_one(
+            {"id": job["id"], "owner": WORKER_ID},
+            {"$set": {"status": "failed" if failed else "pending", "error": str(e), "run_at": retry_at.isoformat()},
+             "$unset": {"lease_expires_at": ""}}
+        )
+    finally:
+        heartbeat.cancel()
+
+async def job_worker_loop():
+    """Claim and run due jobs. Runs on every worker."""
+    while True:
+        try:
+            job = await claim_job([job_type for job_type in JOB_HANDLERS if job_type not in DEDICATED_JOB_TYPES])
+            if job:
+                await run_job(job)
+                continue
+        except Exception as e:
+            logging.error(f"Job worker error: {e}")
+        await asyncio.sleep(JOB_POLL_SECONDS + random.uniform(0, 5))
+
+async def acquire_lock(lock_id: str, seconds: int) -> bool:
+    """Take or renew a named lease in db.job_locks"""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.job_locks.update_one(
+            {"_id": lock_id, "$or": [{"owner": WORKER_ID}, {"expires_at": {"$lt": now.isoformat()}}]},
+            {"$set": {"owner": WORKER_ID, "expires_at": lease_deadline(seconds)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # Another worker holds an unexpired lease
+        return False
+
+async def release_lock(lock_id: str):
+    await db.job_locks.delete_one({"_id": lock_id, "owner": WORKER_ID})
+
+async def acquire_leadership() -> bool:
+    return await acquire_lock("scheduler_leader", LEADER_LEASE_SECONDS)
+
+async def enqueue_scheduled_jobs():
+    now = datetime.now(timezone.utc)
+    for job_type, interval in JOB_SCHEDULES.items():
+        period = int(interval.total_seconds())
+        slot_start = datetime.fromtimestamp(int(now.timestamp()) // period * period, tz=timezone.utc)
+        if await enqueue_job(job_type, slot_start.isoformat(), slot_start):
+            logging.info(f"Enqueued {job_type} for slot {slot_start.isoformat()}")
+
+async def prune_finished_jobs():
+    cutoff = (datetime.now(timezone.utc) - JOB_RETENTION).isoformat()
+    await db.jobs.delete_many({"status": "done", "finished_at": {"$lt": cutoff}})
+
+async def job_leader_loop():
+    """Elect a single leader that enqueues recurring jobs"""
+    while True:
+        try:
+            if await acquire_leadership():
+                await enqueue_scheduled_jobs()
+                await prune_finished_jobs()
+        except Exception as e:
+            logging.error(f"Job leader error: {e}")
+        await asyncio.sleep(LEADER_TICK_SECONDS)
+
+def start_job_queue():
+    """Start the image consumers, plus leader election and the job worker unless disabled.
+    
+    Image consumers run even with JOB_QUEUE_ENABLED=false: the image routes only
+    enqueue, so without them submitted jobs would stay pending forever.
+    """
+    global image_job_wakeup
+    image_job_wakeup = asyncio.Event()
+    for tier, consumers in IMAGE_TIER_CONCURRENCY.items():
+        for _ in range(consumers):
+            spawn_background(image_worker_loop(tier))
+    if not JOB_QUEUE_ENABLED:
+        logging.info("Job queue disabled (JOB_QUEUE_ENABLED=false), running image consumers only")
+        return
+    spawn_background(job_leader_loop())
+    spawn_background(job_worker_loop())
+    logging.info(f"Job queue started on worker {WORKER_ID}")
 
 @app.on_event("startup")
 async def startup_event():
     await init_characters()
     await init_admin()
-    start_notification_scheduler()
-    logging.info("Application startup complete with notification scheduler")
+    spawn_background(ensure_indexes())
+    spawn_background(run_migrations())
+    if CHARACTER_CACHE_CHANGE_STREAM:
+        spawn_background(watch_character_changes())
+    spawn_background(blog_view_counter.run())
+    spawn_background(response_cache.watch_generations())
+    await llm_gateway.start()
+    start_job_queue()
+    logging.info("Application startup complete with job queue")
+
+# ============ CHAT INDEX ============
+# db.chats holds one summary per conversation (counts, last message, denormalized
+# user/character names) so chat listings are indexed queries instead of $group
+# passes over messages. Every message insert or delete goes through here.
+
+chat_index_ready = False
+
+async def chat_index_built() -> bool:
+    """Whether migration 0005 has finished filling db.chats; cached once it has"""
+    global chat_index_ready
+    if not chat_index_ready:
+        state = await db.migrations.find_one({"id": "0005_chat_index"}, {"_id": 0, "status": 1})
+        chat_index_ready = bool(state and state.get("status") == "completed")
+    return chat_index_ready
+
+async def list_chat_summaries(query: dict, limit: int, cursor: Optional[str] = None) -> list:
+    """Chat summaries sorted by (last_timestamp, id) descending.
+    
+    Reads db.chats once it is built; until then falls back to grouping messages
+    so listings are not empty while the migration runs.
+    """
+    after = keyset_filter(["last_timestamp", "id"], decode_cursor(cursor, 2)) if cursor else None
+    if await chat_index_built():
+        query = {"$and": [query, after]} if after else query
+        return await db.chats.find(query, {"_id": 0}).sort([("last_timestamp", -1), ("id", -1)]).limit(limit).to_list(limit)
+    
+    pipeline = [
+        {"$match": {"user_id": {"$exists": True}, **query}},
+        {"$sort": {"timestamp": 1}},
+        {"$group": {
+            "_id": "$chat_id",
+            "user_id": {"$first": "$user_id"},
+            "character_id": {"$first": "$character_id"},
+            "message_count": {"$sum": 1},
+            "last_message": {"$last": "$content"},
+            "last_timestamp": {"$last": "$timestamp"}
+        }},
+        {"$project": {
+            "_id": 0, "id": "$_id", "user_id": 1, "character_id": 1,
+            "message_count": 1, "last_message": 1, "last_timestamp": 1
+        }},
+    ]
+    if after:
+        pipeline.append({"$match": after})
+    pipeline += [{"$sort": {"last_timestamp": -1, "id": -1}}, {"$limit": limit}]
+    chats = await db.messages.aggregate(pipeline, allowDiskUse=True).to_list(limit)
+    
+    users = await users_by_id([chat["user_id"] for chat in chats])
+    characters = await character_repository.get_many([chat["character_id"] for chat in chats])
+    for chat in chats:
+        user = users.get(chat["user_id"]) or {}
+        character = characters.get(chat["character_id"]) or {}
+        chat.update({
+            "user_name": user.get("username") or "Unknown",
+            "user_email": user.get("email") or "Unknown",
+            "character_name": character.get("name") or "Unknown",
+            "character_avatar": character.get("avatar_url")
+        })
+    return chats
+
+async def count_chats() -> int:
+    if await chat_index_built():
+        return await db.chats.estimated_document_count()
+    counted = await db.messages.aggregate([
+        {"$group": {"_id": "$chat_id"}},
+        {"$count": "chats"}
+    ], allowDiskUse=True).to_list(1)
+    return counted[0]["chats"] if counted else 0
+
+async def fill_chat_names(chats: list):
+    """Denormalize user and character names onto chat summaries"""
+    users = await users_by_id([chat["user_id"] for chat in chats])
+    characters = await character_repository.get_many([chat["character_id"] for chat in chats])
+    
+    updates = []
+    for chat in chats:
+        user = users.get(chat["user_id"]) or {}
+        character = characters.get(chat["character_id"]) or {}
+        updates.append(UpdateOne({"id": chat["id"]}, {"$set": {
+            "user_name": user.get("username") or "Unknown",
+            "user_email": user.get("email") or "Unknown",
+            "character_name": character.get("name") or "Unknown",
+            "character_avatar": character.get("avatar_url")
+        }}))
+    if updates:
+        await db.chats.bulk_write(updates, ordered=False)
+
+async def record_chat_messages(chat_id: str, user_id: str, character_id: str, docs: list):
+    """Fold newly inserted messages into the chat summary"""
+    now = datetime.now(timezone.utc).isoformat()
+    result = await db.chats.update_one(
+        {"id": chat_id},
+        {
+            "$inc": {"message_count": len(docs)},
+            "$max": {"last_timestamp": docs[-1]["timestamp"]},
+            "$set": {"last_message": docs[-1]["content"]},
+            "$setOnInsert": {"user_id": user_id, "character_id": character_id, "created_at": now}
+        },
+        upsert=True
+    )
+    if result.upserted_id is not None:
+        await fill_chat_names([{"id": chat_id, "user_id": user_id, "character_id": character_id}])
+
+async def refresh_chat_summary(chat_id: str):
+    """Recompute a summary after messages were removed from the chat"""
+    latest = await db.messages.find_one({"chat_id": chat_id}, {"_id": 0, "content": 1, "timestamp": 1}, sort=[("timestamp", -1)])
+    if not latest:
+        await db.chats.delete_one({"id": chat_id})
+        return
+    count = await db.messages.count_documents({"chat_id": chat_id})
+    await db.chats.update_one({"id": chat_id}, {"$set": {
+        "message_count": count,
+        "last_message": latest["content"],
+        "last_timestamp": latest["timestamp"]
+    }})
+
+def truncate_preview(text: str, length: int) -> str:
+    return text[:length] + "..." if len(text) > length else text
+
+# ============ CHAT MEMORY ============
+# One document per chat in db.chat_memories holds a rolling summary, pinned facts
+# and the turns that have not been folded into the summary yet. /chat/send builds
+# its prompt from this document alone, so prompt size stays bounded no matter how
+# long the relationship gets. Compaction runs in the background once the turns
+# outgrow the window or the document crosses its token budget.
+
+CHAT_MEMORY_RECENT_WINDOW = 8  # turns kept verbatim while within budget
+CHAT_MEMORY_MIN_WINDOW = 2  # the latest exchange is never folded
+CHAT_MEMORY_TOKEN_BUDGET = 1500
+CHAT_MEMORY_MAX_FACTS = 20
+
+CHAT_MEMORY_SYSTEM_PROMPT = """You maintain the long-term memory of a companion chat.
+Given the previous summary, the pinned facts and new conversation turns, reply with JSON only:
+{"summary": "<updated summary, at most 150 words, written from the character's point of view>",
+ "facts": ["<short durable fact about the user: name, preferences, important events>", ...]}
+Keep facts that are still true, merge duplicates and keep at most 20 facts."""
+
+compacting_chats = set()
+
+def estimate_tokens(text: str) -> int:
+    # Roughly four characters per token is close enough for budgeting
+    return len(text) // 4 + 1
+
+def chat_memory_tokens(memory: dict) -> int:
+    text = memory.get("summary", "") + "".join(memory.get("facts", []))
+    text += "".join(turn.get("content", "") for turn in memory.get("turns", []))
+    return estimate_tokens(text)
+
+def turns_to_fold(memory: dict) -> list:
+    """Turns that compaction should fold into the summary.
+
+    Everything older than the recent window, plus older turns of the window itself
+    while it alone is over budget (a few very long messages), down to the minimum.
+    """
+    turns = memory.get("turns", [])
+    keep = min(len(turns), CHAT_MEMORY_RECENT_WINDOW)
+    fixed = memory.get("summary", "") + "".join(memory.get("facts", []))
+    while keep > CHAT_MEMORY_MIN_WINDOW and estimate_tokens(
+        fixed + "".join(turn.get("content", "") for turn in turns[len(turns) - keep:])
+    ) > CHAT_MEMORY_TOKEN_BUDGET:
+        keep -= 1
+    return turns[:len(turns) - keep]
+
+async def load_chat_memory(chat_id: str) -> dict:
+    """Fetch the memory document for a chat in a single indexed read"""
+    memory = await db.chat_memories.find_one({"chat_id": chat_id}, {"_id": 0})
+    if memory:
+        return memory
+    
+    # Chats that predate memory documents are seeded from their latest messages once
+    recent = await db.messages.find(
+        {"chat_id": chat_id},
+        {"_id": 0, "id": 1, "sender": 1, "content": 1}
+    ).sort("timestamp", -1).limit(CHAT_MEMORY_RECENT_WINDOW).to_list(CHAT_MEMORY_RECENT_WINDOW)
+    recent.reverse()
+    return {"chat_id": chat_id, "summary": "", "facts": [], "turns": recent, "is_new": True}
+
+def format_chat_turns(turns: list, character_name: str) -> str:
+    return "\n".join(
+        f"{character_name if turn.get('sender') == 'ai' else 'Them'}: {turn.get('content', '')}"
+        for turn in turns
+    )
+
+def build_memory_prompt(memory: dict, character_name: str) -> str:
+    sections = []
+    if memory.get("summary"):
+        sections.append(f"What you remember about them so far:\n{memory['summary']}")
+    if memory.get("facts"):
+        sections.append("Things you know about them:\n" + "\n".join(f"* {fact}" for fact in memory["facts"]))
+    if memory.get("turns"):
+        sections.append("Your recent conversation:\n" + format_chat_turns(memory["turns"], character_name))
+    return "\n\n".join(sections)
+
+async def record_chat_turns(chat_id: str, user_id: str, character_id: str, new_turns: list, memory: Optional[dict] = None):
+    """Append turns to the chat memory and schedule compaction when it grows too large"""
+    turns = list(new_turns)
+    if memory and memory.get("is_new"):
+        turns = memory.get("turns", []) + turns
+    
+    updated = await db.chat_memories.find_one_and_update(
+        {"chat_id": chat_id},
+        {
+            "$push": {"turns": {"$each": turns}},
+            "$set": {"updated_at": datetime.now(timezone.utc).isoformat()},
+            "$setOnInsert": {"user_id": user_id, "character_id": character_id, "summary": "", "facts": []}
+        },
+        upsert=True,
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    
+    over_limit = len(updated.get("turns", [])) > 2 * CHAT_MEMORY_RECENT_WINDOW or chat_memory_tokens(updated) > CHAT_MEMORY_TOKEN_BUDGET
+    # Nothing foldable means compaction could not shrink the document, so don't pay for it
+    if over_limit and turns_to_fold(updated):
+        schedule_memory_compaction(chat_id)
+
+def schedule_memory_compaction(chat_id: str):
+    if chat_id in compacting_chats:
+        return
+    compacting_chats.add(chat_id)
+    task = spawn_background(compact_chat_memory(chat_id))
+    task.add_done_callback(lambda _: compacting_chats.discard(chat_id))
+
+def parse_memory_update(raw: str, memory: dict):
+    text = raw.strip()
+    if text.startswith("```"):
+        text = text.strip("`")
+        if text.startswith("json"):
+            text = text[4:]
+    try:
+        data = json.loads(text)
+        summary = str(data.get("summary") or memory.get("summary", ""))
+        facts = [str(fact) for fact in data.get("facts", memory.get("facts", []))]
+    except (ValueError, AttributeError):
+        summary, facts = raw.strip(), memory.get("facts", [])
+    return summary, facts[:CHAT_MEMORY_MAX_FACTS]
+
+async def compact_chat_memory(chat_id: str):
+    """Fold everything but the recent window into the summary and pinned facts"""
+    try:
+        memory = await db.chat_memories.find_one({"chat_id": chat_id}, {"_id": 0})
+        if not memory:
+            return
+        folded = turns_to_fold(memory)
+        if not folded:
+            return
+        
+        character = await character_repository.get(memory.get("character_id"))
+        character_name = character["name"] if character else "You"
+        
+        facts = "\n".join(f"* {fact}" for fact in memory.get("facts", [])) or "(none)"
+        request_text = (
+            f"Previous summary:\n{memory.get('summary') or '(none)'}\n\n"
+            f"Pinned facts:\n{facts}\n\n"
+            f"New turns:\n{format_chat_turns(folded, character_name) or '(none)'}"
+        )
+        
+        raw = await llm_gateway.complete(CHAT_MEMORY_SYSTEM_PROMPT, request_text, session_id=f"memory_{chat_id}")
+        summary, facts = parse_memory_update(raw, memory)
+        
+        # Pull exactly the folded turns so turns appended meanwhile are kept
+        await db.chat_memories.update_one(
+            {"chat_id": chat_id},
+            {
+                "$set": {"summary": summary, "facts": facts, "compacted_at": datetime.now(timezone.utc).isoformat()},
+                "$pull": {"turns": {"id": {"$in": [turn.get("id") for turn in folded]}}}
+            }
+        )
+    except Exception as e:
+        logging.error(f"Chat memory compaction failed for {chat_id}: {e}")
 
 # Auth Routes
 @api_router.post("/auth/signup")
@@ -880,7 +3081,7 @@ async def signup(user_data: UserCreate):
         username=user_data.username
     )
     user_dict = user.model_dump()
-    user_dict['password_hash'] = hash_password(user_data.password)
+    user_dict['password_hash'] = await hash_password(user_data.password)
     user_dict['created_at'] = user_dict['created_at'].isoformat()
     
     await db.users.insert_one(user_dict)
@@ -894,9 +3095,12 @@ async def login(credentials: UserLogin):
     if not user_doc:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
-    if not verify_password(credentials.password, user_doc['password_hash']):
+    if not await verify_password(credentials.password, user_doc['password_hash']):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
+    if password_needs_rehash(user_doc['password_hash']):
+        spawn_background(rehash_password(db.users, user_doc['id'], credentials.password))
+    
     token = create_token(user_doc['id'])
     user_doc.pop('password_hash', None)
     return {"token": token, "user": user_doc}
@@ -955,6 +3159,8 @@ async def google_session(request: GoogleSessionRequest, response: FastAPIRespons
         # Store session in database
         expires_at = datetime.now(timezone.utc) + timedelta(days=7)
         await db.user_sessions.delete_many({"user_id": user_id})  # Remove old sessions
+        session_cache.invalidate_user(user_id)
+        session_cache.invalidate(session_token)
         await db.user_sessions.insert_one({
             "user_id": user_id,
             "session_token": session_token,
@@ -995,17 +3201,22 @@ async def get_current_user(request: Request):
     session_token = request.cookies.get("session_token")
     
     if not session_token:
-        auth_header = request.headers.get("Authorization")
-        if auth_header and auth_header.startswith("Bearer "):
-            session_token = auth_header.split(" ")[1]
+        session_token = bearer_token(request)
     
     if not session_token:
         raise HTTPException(status_code=401, detail="Not authenticated")
     
+    found, cached_user = session_cache.get(session_token)
+    if found:
+        if cached_user is None:
+            raise HTTPException(status_code=401, detail="Session not found")
+        return cached_user
+    
     # Find session in database
     session_doc = await db.user_sessions.find_one({"session_token": session_token}, {"_id": 0})
     
     if not session_doc:
+        session_cache.put_negative(session_token)
         raise HTTPException(status_code=401, detail="Session not found")
     
     # Check expiry with timezone awareness
@@ -1017,6 +3228,7 @@ async def get_current_user(request: Request):
     
     if expires_at < datetime.now(timezone.utc):
         await db.user_sessions.delete_one({"session_token": session_token})
+        session_cache.put_negative(session_token)
         raise HTTPException(status_code=401, detail="Session expired")
     
     # Get user
@@ -1029,6 +3241,7 @@ async def get_current_user(request: Request):
     if not user_doc:
         raise HTTPException(status_code=401, detail="User not found")
     
+    session_cache.put(session_token, user_doc, expires_at)
     return user_doc
 
 @api_router.post("/auth/logout")
@@ -1038,6 +3251,7 @@ async def logout(request: Request, response: FastAPIResponse):
     
     if session_token:
         await db.user_sessions.delete_one({"session_token": session_token})
+        session_cache.invalidate(session_token)
     
     response.delete_cookie(
         key="session_token",
@@ -1050,31 +3264,58 @@ async def logout(request: Request, response: FastAPIResponse):
 
 # Character Routes
 @api_router.get("/characters", response_model=List[Character])
-async def get_characters(category: Optional[str] = None):
-    query = {} if not category else {"category": category}
-    characters = await db.characters.find(query, {"_id": 0}).to_list(100)
-    return characters
+async def get_characters(request: Request, category: Optional[str] = None):
+    async def build():
+        return [Character(**doc) for doc in await character_repository.list_defaults(category)]
+    return await response_cache.serve(request, "characters", 300, build, params=("category",))
 
 @api_router.get("/characters/{character_id}", response_model=Character)
 async def get_character(character_id: str):
-    character = await db.characters.find_one({"id": character_id}, {"_id": 0})
+    character = await character_repository.get_default(character_id)
     if not character:
         raise HTTPException(status_code=404, detail="Character not found")
     return character
 
 # Chat Routes
-@api_router.post("/chat/send")
-async def send_message(request: ChatSendRequest):
+def strip_hyphens(text: str) -> str:
+    return text.replace(" - ", " ").replace("- ", "").replace(" -", "")
+
+class HyphenStreamFilter:
+    """Apply strip_hyphens to a reply that arrives in chunks.
+
+    The patterns only involve spaces and hyphens, so any trailing run of those
+    characters is held back until the next chunk shows what follows it.
+    """
+    
+    def __init__(self):
+        self.pending = ""
+    
+    def feed(self, chunk: str) -> str:
+        text = self.pending + chunk
+        cut = len(text.rstrip(" -"))
+        self.pending = text[cut:]
+        return strip_hyphens(text[:cut])
+    
+    def flush(self) -> str:
+        text, self.pending = self.pending, ""
+        return strip_hyphens(text)
+
+def typing_delay_ms() -> int:
+    # Pacing hint for the client so replies still feel typed (1.5-3 seconds)
+    return int(random.uniform(1.5, 3.0) * 1000)
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def prepare_chat_turn(request: ChatSendRequest):
+    """Resolve the character and memory for a chat turn and build the system prompt"""
     # Check both regular characters and custom characters
-    character = await db.characters.find_one({"id": request.character_id}, {"_id": 0})
-    if not character:
-        character = await db.custom_characters.find_one({"id": request.character_id}, {"_id": 0})
+    character = await character_repository.get(request.character_id)
     if not character:
         raise HTTPException(status_code=404, detail="Character not found")
     
-    chat_id = f"{request.user_id}_{request.character_id}"
-    messages = await db.messages.find({"chat_id": chat_id}, {"_id": 0}).sort("timestamp", -1).limit(10).to_list(10)
-    messages.reverse()
+    chat_id = make_chat_id(request.user_id, request.character_id)
+    memory = await load_chat_memory(chat_id)
     
     # Flirty and fun system prompt with emojis
     system_prompt = f"""You are {character['name']}, age {character['age']}. {character['personality']} 
@@ -1089,48 +3330,111 @@ IMPORTANT RULES:
 - Be affectionate and make the user feel special
 - Show genuine interest and excitement"""
     
-    chat = LlmChat(
-        api_key=EMERGENT_LLM_KEY,
-        session_id=chat_id,
-        system_message=system_prompt
+    memory_prompt = build_memory_prompt(memory, character['name'])
+    if memory_prompt:
+        system_prompt += f"\n\n{memory_prompt}"
+    
+    return character, chat_id, memory, system_prompt
+
+async def save_chat_exchange(request: ChatSendRequest, chat_id: str, memory: dict, user_msg: Message, ai_response: str) -> Message:
+    """Persist the user message and the reply in one bulk write and update the chat memory"""
+    ai_msg = Message(
+        chat_id=chat_id,
+        user_id=request.user_id,
+        character_id=request.character_id,
+        sender="ai",
+        content=ai_response
     )
-    chat.with_model("gemini", "gemini-3-flash-preview")
     
-    user_message = UserMessage(text=request.message)
-    ai_response = await chat.send_message(user_message)
+    docs = []
+    for msg in (user_msg, ai_msg):
+        msg_dict = msg.model_dump()
+        msg_dict['timestamp'] = msg_dict['timestamp'].isoformat()
+        docs.append(msg_dict)
+    await db.messages.insert_many(docs)
+    await record_chat_messages(chat_id, request.user_id, request.character_id, docs)
     
-    # Remove any hyphens from response
-    ai_response = ai_response.replace(" - ", " ").replace("- ", "").replace(" -", "")
+    await record_chat_turns(chat_id, request.user_id, request.character_id, [
+        {"id": user_msg.id, "sender": "user", "content": user_msg.content},
+        {"id": ai_msg.id, "sender": "ai", "content": ai_response}
+    ], memory)
     
-    # Add a small delay to make it feel more realistic (1.5-3 seconds)
-    import random
-    delay = random.uniform(1.5, 3.0)
-    await asyncio.sleep(delay)
+    return ai_msg
+
+@api_router.post("/chat/send")
+async def send_message(request: ChatSendRequest):
+    character, chat_id, memory, system_prompt = await prepare_chat_turn(request)
     
     user_msg = Message(
         chat_id=chat_id,
+        user_id=request.user_id,
+        character_id=request.character_id,
         sender="user",
         content=request.message
     )
-    user_msg_dict = user_msg.model_dump()
-    user_msg_dict['timestamp'] = user_msg_dict['timestamp'].isoformat()
-    await db.messages.insert_one(user_msg_dict)
     
-    ai_msg = Message(
+    ai_response = await opener_cache.get(request.character_id, request.message, memory)
+    if ai_response is None:
+        ai_response = await llm_gateway.complete(system_prompt, request.message, session_id=chat_id)
+        
+        # Remove any hyphens from response
+        ai_response = strip_hyphens(ai_response)
+        await opener_cache.put(request.character_id, request.message, memory, ai_response)
+    
+    ai_msg = await save_chat_exchange(request, chat_id, memory, user_msg, ai_response)
+    
+    # The typing delay is applied by the client instead of holding this request open
+    return {"response": ai_response, "message_id": ai_msg.id, "typing_delay_ms": typing_delay_ms()}
+
+@api_router.post("/chat/stream")
+async def stream_message(request: ChatSendRequest):
+    """Stream the reply as Server-Sent Events (meta, token..., done | error)"""
+    if not LLM_STREAMING_ENABLED:
+        raise HTTPException(status_code=503, detail="Streaming is not configured; use /chat/send")
+    character, chat_id, memory, system_prompt = await prepare_chat_turn(request)
+    
+    user_msg = Message(
         chat_id=chat_id,
-        sender="ai",
-        content=ai_response
+        user_id=request.user_id,
+        character_id=request.character_id,
+        sender="user",
+        content=request.message
     )
-    ai_msg_dict = ai_msg.model_dump()
-    ai_msg_dict['timestamp'] = ai_msg_dict['timestamp'].isoformat()
-    await db.messages.insert_one(ai_msg_dict)
     
-    return {"response": ai_response, "message_id": ai_msg.id}
+    async def event_stream():
+        yield sse_event("meta", {"chat_id": chat_id, "typing_delay_ms": typing_delay_ms()})
+        
+        hyphen_filter = HyphenStreamFilter()
+        parts = []
+        try:
+            async for chunk in llm_gateway.stream(system_prompt, request.message, session_id=chat_id):
+                text = hyphen_filter.feed(chunk)
+                if text:
+                    parts.append(text)
+                    yield sse_event("token", {"text": text})
+            tail = hyphen_filter.flush()
+            if tail:
+                parts.append(tail)
+                yield sse_event("token", {"text": tail})
+        except Exception as e:
+            logging.error(f"Chat stream error: {e}")
+            yield sse_event("error", {"detail": "Failed to generate response"})
+            return
+        
+        ai_response = "".join(parts)
+        ai_msg = await save_chat_exchange(request, chat_id, memory, user_msg, ai_response)
+        yield sse_event("done", {"message_id": ai_msg.id, "response": ai_response})
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @api_router.post("/chat/greeting")
 async def get_character_greeting(request: GreetingRequest):
     """Get initial flirty greeting from character"""
-    chat_id = f"{request.user_id}_{request.character_id}"
+    chat_id = make_chat_id(request.user_id, request.character_id)
     
     # Check if there's already a greeting
     existing = await db.messages.find_one({"chat_id": chat_id, "sender": "ai"})
@@ -1138,116 +3442,99 @@ async def get_character_greeting(request: GreetingRequest):
         return {"greeting": None, "already_greeted": True}
     
     # Get character details
-    character = await db.characters.find_one({"id": request.character_id}, {"_id": 0})
-    if not character:
-        character = await db.custom_characters.find_one({"id": request.character_id}, {"_id": 0})
+    character = await character_repository.get(request.character_id)
     if not character:
         raise HTTPException(status_code=404, detail="Character not found")
     
-    # Generate flirty greeting
-    greeting_prompt = f"""You are {character['name']}, age {character['age']}. {character['personality']}
-Your traits: {', '.join(character['traits'])}.
-
-Generate a fun, flirty greeting to someone who just started chatting with you. 
-- Be playful and warm
-- Add cute emojis like 😊 💕 🥰 😘 💖 ✨ 💋 😍 🌸 💗 😉 🙈 💓
-- Show excitement to meet them
-- NEVER use hyphens
-- Keep it 1-2 sentences max
-- Make them feel special and welcomed"""
-    
-    chat = LlmChat(
-        api_key=EMERGENT_LLM_KEY,
-        session_id=f"greeting_{chat_id}",
-        system_message=greeting_prompt
-    )
-    chat.with_model("gemini", "gemini-3-flash-preview")
-    
-    greeting = await chat.send_message(UserMessage(text="Say hi to me!"))
-    
-    # Remove hyphens
-    greeting = greeting.replace(" - ", " ").replace("- ", "").replace(" -", "")
-    
-    # Add a small delay for realism (1-2 seconds)
-    import random
-    await asyncio.sleep(random.uniform(1.0, 2.0))
+    # Pre-generated when available, otherwise generated live
+    greeting = await pop_pooled_greeting(character)
+    if greeting is None:
+        greeting = await generate_greeting(character, session_id=f"greeting_{chat_id}")
     
     # Save greeting as first message
     ai_msg = Message(
         chat_id=chat_id,
+        user_id=request.user_id,
+        character_id=request.character_id,
         sender="ai",
         content=greeting
     )
     ai_msg_dict = ai_msg.model_dump()
     ai_msg_dict['timestamp'] = ai_msg_dict['timestamp'].isoformat()
     await db.messages.insert_one(ai_msg_dict)
+    await record_chat_messages(chat_id, request.user_id, request.character_id, [ai_msg_dict])
+    
+    await record_chat_turns(chat_id, request.user_id, request.character_id, [
+        {"id": ai_msg.id, "sender": "ai", "content": greeting}
+    ])
     
     return {"greeting": greeting, "message_id": ai_msg.id}
 
 @api_router.get("/chat/history/{character_id}")
 async def get_chat_history(character_id: str, user_id: str):
-    chat_id = f"{user_id}_{character_id}"
+    chat_id = make_chat_id(user_id, character_id)
     messages = await db.messages.find({"chat_id": chat_id}, {"_id": 0}).sort("timestamp", 1).to_list(1000)
     return {"messages": messages}
 
 @api_router.get("/chat/my-chats")
-async def get_user_chats(user_id: str):
+async def get_user_chats(user_id: str, limit: int = 20, cursor: Optional[str] = None):
     """Get all characters the user has chatted with"""
-    # Get unique chat_ids for this user
-    pipeline = [
-        {"$match": {"chat_id": {"$regex": f"^{user_id}_"}}},
-        {"$group": {
-            "_id": "$chat_id",
-            "last_message": {"$last": "$content"},
-            "last_timestamp": {"$last": "$timestamp"},
-            "message_count": {"$sum": 1}
-        }},
-        {"$sort": {"last_timestamp": -1}},
-        {"$limit": 20}
-    ]
-    
-    chat_summaries = await db.messages.aggregate(pipeline).to_list(20)
+    limit = max(1, min(limit, 50))
+    defaults = await character_repository.list_defaults()
+    query = {"user_id": user_id, "character_id": {"$in": [character["id"] for character in defaults]}}
+    chat_summaries = await list_chat_summaries(query, limit, cursor)
     
     # Get character details for each chat
     result = []
     for chat in chat_summaries:
-        character_id = chat["_id"].replace(f"{user_id}_", "")
-        character = await db.characters.find_one({"id": character_id}, {"_id": 0})
+        character_id = chat["character_id"]
+        character = await character_repository.get_default(character_id)
         if character:
             result.append({
                 "character_id": character_id,
                 "character_name": character["name"],
                 "character_avatar": character["avatar_url"],
-                "last_message": chat["last_message"][:50] + "..." if len(chat["last_message"]) > 50 else chat["last_message"],
+                "last_message": truncate_preview(chat["last_message"], 50),
                 "last_timestamp": chat["last_timestamp"],
                 "message_count": chat["message_count"]
             })
     
-    return {"chats": result}
+    next_cursor = None
+    if len(chat_summaries) == limit:
+        last = chat_summaries[-1]
+        next_cursor = encode_cursor([last["last_timestamp"], last["id"]])
+    return {"chats": result, "next_cursor": next_cursor}
 
 @api_router.delete("/chat/clear-all")
 async def clear_all_chats(user_id: str):
     """Clear all chat history for a user"""
-    result = await db.messages.delete_many({"chat_id": {"$regex": f"^{user_id}_"}})
+    result = await db.messages.delete_many({"user_id": user_id})
+    await db.chat_memories.delete_many({"user_id": user_id})
+    await db.chats.delete_many({"user_id": user_id})
     return {"message": f"Deleted {result.deleted_count} messages", "deleted_count": result.deleted_count}
 
 @api_router.delete("/users/{user_id}/delete-account")
 async def delete_user_account(user_id: str):
     """Delete user account and all associated data"""
     # Delete all user's messages
-    await db.messages.delete_many({"chat_id": {"$regex": f"^{user_id}_"}})
+    await db.messages.delete_many({"user_id": user_id})
+    await db.chat_memories.delete_many({"user_id": user_id})
+    await db.chats.delete_many({"user_id": user_id})
     
     # Delete user's favorites
     await db.favorites.delete_many({"user_id": user_id})
     
     # Delete user's custom characters
     await db.custom_characters.delete_many({"user_id": user_id})
+    character_repository.invalidate_custom()
     
     # Delete user's generated images
     await db.generated_images.delete_many({"user_id": user_id})
     
     # Delete user sessions
     await db.user_sessions.delete_many({"user_id": user_id})
+    session_cache.invalidate_user(user_id)
+    await db.analytics_totals.delete_one({"_id": f"user:{user_id}"})
     
     # Delete user account
     await db.users.delete_one({"$or": [{"id": user_id}, {"user_id": user_id}]})
@@ -1257,56 +3544,45 @@ async def delete_user_account(user_id: str):
 # Voice Routes
 @api_router.post("/voice/generate")
 async def generate_voice(request: VoiceGenerateRequest):
-    tts = OpenAITextToSpeech(api_key=EMERGENT_LLM_KEY)
-    
     try:
-        audio_bytes = await tts.generate_speech(
-            text=request.text,
-            model="tts-1",
-            voice=request.voice
-        )
+        audio_bytes = await llm_gateway.speech(request.text, request.voice)
         
         audio_base64 = base64.b64encode(audio_bytes).decode('utf-8')
         
         return {"audio": audio_base64, "format": "mp3"}
+    except LLMUnavailable:
+        raise
     except Exception as e:
         logging.error(f"Voice generation error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 # Image Routes
-@api_router.post("/image/generate")
-async def generate_image(request: ImageGenerateRequest):
+@api_router.post("/image/generate", status_code=202)
+async def generate_image(request: Request, data: ImageGenerateRequest):
+    """Queue an in-chat image; poll /images/jobs/{job_id} for the result"""
     # Check both regular characters and custom characters
-    character = await db.characters.find_one({"id": request.character_id}, {"_id": 0})
-    if not character:
-        character = await db.custom_characters.find_one({"id": request.character_id}, {"_id": 0})
+    character = await character_repository.get(data.character_id)
     if not character:
         raise HTTPException(status_code=404, detail="Character not found")
     
-    enhanced_prompt = f"{request.prompt}. Character style: {character['category']}, {character['personality']}"
-    
-    chat = LlmChat(
-        api_key=EMERGENT_LLM_KEY,
-        session_id=f"image_{uuid.uuid4()}",
-        system_message="You are an AI image generator."
+    enhanced_prompt = f"{data.prompt}. Character style: {character['category']}, {character['personality']}"
+    job = await submit_image_job(request, data.user_id, {
+        "kind": "character",
+        "prompt": enhanced_prompt,
+        "character_id": data.character_id
+    })
+    return image_job_accepted(job)
+
+@api_router.get("/images/jobs/{job_id}")
+async def get_image_job(job_id: str):
+    """Status of an image job; `result` carries the image URL once it is done"""
+    job = await db.jobs.find_one(
+        {"id": job_id, "type": IMAGE_JOB_TYPE},
+        IMAGE_JOB_PROJECTION
     )
-    chat.with_model("gemini", "gemini-3-pro-image-preview").with_params(modalities=["image", "text"])
-    
-    msg = UserMessage(text=enhanced_prompt)
-    
-    try:
-        text, images = await chat.send_message_multimodal_response(msg)
-        
-        if images and len(images) > 0:
-            return {
-                "image": images[0]['data'],
-                "mime_type": images[0]['mime_type']
-            }
-        else:
-            raise HTTPException(status_code=500, detail="No image generated")
-    except Exception as e:
-        logging.error(f"Image generation error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    if not job:
+        raise HTTPException(status_code=404, detail="Image job not found")
+    return image_job_response(job)
 
 # ============ PUSH NOTIFICATIONS ROUTES ============
 
@@ -1318,17 +3594,8 @@ async def get_vapid_public_key():
     return {"publicKey": VAPID_PUBLIC_KEY or "demo-key"}
 
 @api_router.post("/push/subscribe")
-async def subscribe_to_push(request: Request, subscription: PushSubscription):
+async def subscribe_to_push(subscription: PushSubscription, payload: dict = Depends(get_user_from_token)):
     """Subscribe user to push notifications"""
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    token = auth_header.split(" ")[1]
-    payload = verify_token(token)
-    if not payload:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    
     user_id = payload.get('user_id')
     
     # Store or update subscription
@@ -1353,17 +3620,8 @@ async def subscribe_to_push(request: Request, subscription: PushSubscription):
     return {"message": "Subscribed to notifications"}
 
 @api_router.post("/push/unsubscribe")
-async def unsubscribe_from_push(request: Request):
+async def unsubscribe_from_push(payload: dict = Depends(get_user_from_token)):
     """Unsubscribe user from push notifications"""
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    token = auth_header.split(" ")[1]
-    payload = verify_token(token)
-    if not payload:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    
     user_id = payload.get('user_id')
     
     await db.push_subscriptions.update_one(
@@ -1410,14 +3668,10 @@ async def update_notification_preferences(user_id: str, prefs: NotificationPrefe
 @api_router.post("/push/update-activity")
 async def update_user_activity(request: Request):
     """Update user's last activity timestamp"""
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        return {"message": "ok"}  # Silent fail for non-auth requests
-    
-    token = auth_header.split(" ")[1]
-    payload = verify_token(token)
+    token = bearer_token(request)
+    payload = verify_token(token) if token else None
     if not payload:
-        return {"message": "ok"}
+        return {"message": "ok"}  # Silent fail for non-auth requests
     
     user_id = payload.get('user_id')
     
@@ -1438,16 +3692,8 @@ async def generate_notification_for_user(user_id: str, notification_type: str =
         return {"message": "Notifications disabled", "send": False}
     
     # Check quiet hours
-    current_hour = datetime.now(timezone.utc).hour
-    quiet_start = prefs.get("quiet_hours_start", 22) if prefs else 22
-    quiet_end = prefs.get("quiet_hours_end", 8) if prefs else 8
-    
-    if quiet_start > quiet_end:  # Overnight quiet hours (e.g., 22:00 - 08:00)
-        if current_hour >= quiet_start or current_hour < quiet_end:
-            return {"message": "Quiet hours", "send": False}
-    else:
-        if quiet_start <= current_hour < quiet_end:
-            return {"message": "Quiet hours", "send": False}
+    if in_quiet_hours(prefs, datetime.now(timezone.utc).hour):
+        return {"message": "Quiet hours", "send": False}
     
     # Check daily notification count
     today = datetime.now(timezone.utc).date().isoformat()
@@ -1457,10 +3703,7 @@ async def generate_notification_for_user(user_id: str, notification_type: str =
     })
     
     # Get max based on frequency
-    frequency = prefs.get("frequency", "medium") if prefs else "medium"
-    max_daily = {"low": 2, "medium": 5, "high": 8}.get(frequency, 5)
-    
-    if daily_count >= max_daily:
+    if daily_count >= max_daily_notifications(prefs):
         return {"message": "Daily limit reached", "send": False}
     
     # Pick a character to send notification
@@ -1470,17 +3713,11 @@ async def generate_notification_for_user(user_id: str, notification_type: str =
     character_source = "random"
     
     # Try to get a character user has chatted with
-    recent_chats = await db.messages.aggregate([
-        {"$match": {"chat_id": {"$regex": f"^{user_id}_"}}},
-        {"$group": {"_id": {"$arrayElemAt": [{"$split": ["$chat_id", "_"]}, 1]}}},
-        {"$sample": {"size": 1}}
-    ]).to_list(1)
-    
-    if recent_chats:
-        char_id = recent_chats[0]["_id"]
-        character = await db.characters.find_one({"id": char_id}, {"_id": 0})
-        if not character:
-            character = await db.custom_characters.find_one({"id": char_id}, {"_id": 0})
+    chatted_ids = await db.messages.distinct("character_id", {"user_id": user_id})
+    
+    if chatted_ids:
+        char_id = random.choice(chatted_ids)
+        character = await character_repository.get(char_id)
         if character:
             character_source = "chatted"
     
@@ -1488,16 +3725,13 @@ async def generate_notification_for_user(user_id: str, notification_type: str =
     if not character:
         favorite = await db.favorites.find_one({"user_id": user_id})
         if favorite:
-            character = await db.characters.find_one({"id": favorite["character_id"]}, {"_id": 0})
+            character = await character_repository.get_default(favorite["character_id"])
             if character:
                 character_source = "favorite"
     
     # If still no character, pick random
     if not character:
-        characters = await db.characters.aggregate([{"$sample": {"size": 1}}]).to_list(1)
-        if characters:
-            character = characters[0]
-            character.pop("_id", None)
+        character = await character_repository.random_default()
     
     if not character:
         return {"message": "No character found", "send": False}
@@ -1551,12 +3785,9 @@ async def check_user_inactivity():
     }, {"_id": 0, "id": 1, "user_id": 1}).to_list(100)
     
     # Filter to only users with active push subscriptions
-    result = []
-    for user in inactive_users:
-        uid = user.get("id") or user.get("user_id")
-        sub = await db.push_subscriptions.find_one({"user_id": uid, "is_active": True})
-        if sub:
-            result.append(uid)
+    user_ids = [user.get("id") or user.get("user_id") for user in inactive_users]
+    subscribed = set(await db.push_subscriptions.distinct("user_id", {"user_id": {"$in": user_ids}, "is_active": True}))
+    result = [uid for uid in user_ids if uid in subscribed]
     
     return {"inactive_users": result}
 
@@ -1607,13 +3838,11 @@ async def get_favorites(user_id: str):
     """Get all favorite characters for a user"""
     favorites = await db.favorites.find({"user_id": user_id}, {"_id": 0}).to_list(100)
     
-    # Get character details for each favorite
+    # Get character details for each favorite (regular and custom characters)
+    characters = await character_repository.get_many([fav["character_id"] for fav in favorites])
     result = []
     for fav in favorites:
-        # Check both regular characters and custom characters
-        character = await db.characters.find_one({"id": fav["character_id"]}, {"_id": 0})
-        if not character:
-            character = await db.custom_characters.find_one({"id": fav["character_id"]}, {"_id": 0})
+        character = characters.get(fav["character_id"])
         
         if character:
             result.append({
@@ -1636,53 +3865,51 @@ async def check_favorite(user_id: str, character_id: str):
 # ============ CUSTOM CHARACTER ROUTES ============
 
 @api_router.post("/characters/create")
-async def create_custom_character(request: CreateCharacterRequest):
-    """Create a custom AI character"""
-    
-    # Generate avatar using AI if prompt provided, otherwise use placeholder
-    avatar_url = "https://images.unsplash.com/photo-1494790108377-be9c29b29330?w=400"
-    
-    if request.avatar_prompt:
-        try:
-            chat = LlmChat(
-                api_key=EMERGENT_LLM_KEY,
-                session_id=f"avatar_{uuid.uuid4()}",
-                system_message="You are an AI image generator specializing in character avatars."
-            )
-            chat.with_model("gemini", "gemini-3-pro-image-preview").with_params(modalities=["image", "text"])
-            
-            msg = UserMessage(text=f"Generate a portrait avatar image: {request.avatar_prompt}. Style: professional, high quality, centered face portrait.")
-            text, images = await chat.send_message_multimodal_response(msg)
-            
-            if images and len(images) > 0:
-                # Store as base64 data URL
-                avatar_url = f"data:{images[0]['mime_type']};base64,{images[0]['data']}"
-        except Exception as e:
-            logging.error(f"Avatar generation error: {e}")
-            # Use placeholder if generation fails
+async def create_custom_character(request: Request, data: CreateCharacterRequest):
+    """Create a custom AI character; an AI avatar is generated in the background"""
+    # A retried submission with the same Idempotency-Key maps to the same character
+    idempotency_key = request.headers.get("idempotency-key")
+    if idempotency_key:
+        character_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"character:{data.user_id}:{idempotency_key}"))
+    else:
+        character_id = str(uuid.uuid4())
     
-    character_id = str(uuid.uuid4())
+    # Placeholder until the avatar job finishes (or for good when there is no prompt)
     custom_character = {
         "id": character_id,
-        "user_id": request.user_id,
-        "name": request.name,
-        "age": request.age,
-        "personality": request.personality,
-        "traits": request.traits,
+        "user_id": data.user_id,
+        "name": data.name,
+        "age": data.age,
+        "personality": data.personality,
+        "traits": data.traits,
         "category": "Custom",
-        "avatar_url": avatar_url,
-        "description": request.description,
-        "occupation": request.occupation,
+        "avatar_url": "https://images.unsplash.com/photo-1494790108377-be9c29b29330?w=400",
+        "avatar_blob": None,
+        "description": data.description,
+        "occupation": data.occupation,
         "is_custom": True,
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
-    await db.custom_characters.insert_one(custom_character)
+    try:
+        await db.custom_characters.insert_one(custom_character)
+    except DuplicateKeyError:
+        custom_character = await db.custom_characters.find_one({"id": character_id}, {"_id": 0})
+    character_repository.invalidate_custom(character_id)
     
     # Remove _id before returning
     custom_character.pop("_id", None)
     
-    return {"character": custom_character, "message": "Character created successfully"}
+    response = {"character": custom_character, "message": "Character created successfully"}
+    if data.avatar_prompt:
+        job = await submit_image_job(request, data.user_id, {
+            "kind": "avatar",
+            "prompt": f"Generate a portrait avatar image: {data.avatar_prompt}. Style: professional, high quality, centered face portrait.",
+            "user_prompt": data.avatar_prompt,
+            "character_id": character_id
+        })
+        response["avatar_job_id"] = job["id"]
+    return response
 
 @api_router.get("/characters/my/{user_id}")
 async def get_my_characters(user_id: str):
@@ -1701,6 +3928,9 @@ async def delete_custom_character(character_id: str, user_id: str):
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Character not found or not authorized")
     
+    character_repository.invalidate_custom(character_id)
+    await forget_generated_replies(character_id)
+    
     # Also remove from favorites
     await db.favorites.delete_many({"character_id": character_id})
     
@@ -1709,16 +3939,16 @@ async def delete_custom_character(character_id: str, user_id: str):
 @api_router.get("/characters/custom/{character_id}")
 async def get_custom_character(character_id: str):
     """Get a single custom character by ID"""
-    character = await db.custom_characters.find_one({"id": character_id}, {"_id": 0})
+    character = await character_repository.get_custom(character_id)
     if not character:
         raise HTTPException(status_code=404, detail="Character not found")
     return character
 
 # ============ STANDALONE IMAGE GENERATION ROUTES ============
 
-@api_router.post("/images/generate")
-async def generate_standalone_image(request: StandaloneImageRequest):
-    """Generate a standalone AI image"""
+@api_router.post("/images/generate", status_code=202)
+async def generate_standalone_image(request: Request, data: StandaloneImageRequest):
+    """Queue a standalone AI image; poll /images/jobs/{job_id} for the result"""
     
     style_prompts = {
         "realistic": "photorealistic, high quality, detailed",
@@ -1727,57 +3957,29 @@ async def generate_standalone_image(request: StandaloneImageRequest):
         "fantasy": "fantasy art, magical, ethereal lighting"
     }
     
-    style_modifier = style_prompts.get(request.style, style_prompts["realistic"])
-    enhanced_prompt = f"{request.prompt}. Style: {style_modifier}"
-    
-    chat = LlmChat(
-        api_key=EMERGENT_LLM_KEY,
-        session_id=f"standalone_image_{uuid.uuid4()}",
-        system_message="You are an AI image generator."
-    )
-    chat.with_model("gemini", "gemini-3-pro-image-preview").with_params(modalities=["image", "text"])
-    
-    msg = UserMessage(text=enhanced_prompt)
-    
-    try:
-        text, images = await chat.send_message_multimodal_response(msg)
-        
-        if images and len(images) > 0:
-            image_data = images[0]['data']
-            mime_type = images[0]['mime_type']
-            
-            # Save to database
-            image_record = {
-                "id": str(uuid.uuid4()),
-                "user_id": request.user_id,
-                "prompt": request.prompt,
-                "image_data": image_data,
-                "mime_type": mime_type,
-                "style": request.style,
-                "created_at": datetime.now(timezone.utc).isoformat()
-            }
-            await db.generated_images.insert_one(image_record)
-            
-            return {
-                "id": image_record["id"],
-                "image": image_data,
-                "mime_type": mime_type,
-                "prompt": request.prompt
-            }
-        else:
-            raise HTTPException(status_code=500, detail="No image generated")
-    except Exception as e:
-        logging.error(f"Standalone image generation error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    style_modifier = style_prompts.get(data.style, style_prompts["realistic"])
+    job = await submit_image_job(request, data.user_id, {
+        "kind": "standalone",
+        "prompt": f"{data.prompt}. Style: {style_modifier}",
+        "user_prompt": data.prompt,
+        "style": data.style
+    })
+    return image_job_accepted(job)
 
 @api_router.get("/images/my/{user_id}")
 async def get_my_images(user_id: str):
     """Get all images generated by a user"""
+    # image_data is only present on rows the blob migration has not reached yet
     images = await db.generated_images.find(
         {"user_id": user_id}, 
         {"_id": 0}
     ).sort("created_at", -1).to_list(50)
     
+    # Grid tiles use thumbnail_url; the full image_url is only fetched when opened
+    for image in images:
+        image["variant_urls"] = variant_urls(image.pop("variants", None))
+        image.setdefault("thumbnail_url", image.get("image_url"))
+    
     return {"images": images}
 
 @api_router.delete("/images/{image_id}")
@@ -1793,6 +3995,65 @@ async def delete_image(image_id: str, user_id: str):
     
     return {"message": "Image deleted successfully"}
 
+# ============ BLOB ROUTES ============
+
+def parse_range_header(range_header: str, size: int):
+    """Parse a single 'bytes=start-end' range; returns (start, end) or None if unsatisfiable"""
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+    if not match or (not match.group(1) and not match.group(2)):
+        return None
+    if match.group(1):
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else size - 1
+    else:
+        # Suffix range: the last N bytes
+        start = max(size - int(match.group(2)), 0)
+        end = size - 1
+    end = min(end, size - 1)
+    if start > end or start >= size:
+        return None
+    return start, end
+
+@api_router.get("/blobs/{digest}")
+async def get_blob(request: Request, digest: str):
+    """Stream a stored blob with ETag and Range support"""
+    if not BLOB_HASH_PATTERN.match(digest):
+        raise HTTPException(status_code=404, detail="Blob not found")
+    
+    meta = await db.blobs.find_one({"hash": digest}, {"_id": 0})
+    if not meta:
+        raise HTTPException(status_code=404, detail="Blob not found")
+    
+    etag = f'"{digest}"'
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        # Content-addressed, so the bytes behind a URL never change
+        "Cache-Control": "public, max-age=31536000, immutable"
+    }
+    if etag in request.headers.get("If-None-Match", ""):
+        return Response(status_code=304, headers=headers)
+    
+    size = meta["size"]
+    start, end = 0, size - 1
+    status_code = 200
+    range_header = request.headers.get("Range")
+    if range_header and size > 0:
+        byte_range = parse_range_header(range_header, size)
+        if byte_range is None:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    
+    headers["Content-Length"] = str(end - start + 1 if size > 0 else 0)
+    return StreamingResponse(
+        blob_store.iter_range(digest, start, end),
+        status_code=status_code,
+        media_type=meta.get("mime_type", "application/octet-stream"),
+        headers=headers
+    )
+
 # ============ ADMIN ROUTES ============
 
 @api_router.post("/admin/login")
@@ -1802,55 +4063,38 @@ async def admin_login(credentials: AdminLogin):
     if not admin:
         raise HTTPException(status_code=401, detail="Invalid admin credentials")
     
-    if not verify_password(credentials.password, admin['password_hash']):
+    if not await verify_password(credentials.password, admin['password_hash']):
         raise HTTPException(status_code=401, detail="Invalid admin credentials")
     
+    if password_needs_rehash(admin['password_hash']):
+        spawn_background(rehash_password(db.admins, admin['id'], credentials.password))
+    
     # Update last login
     await db.admins.update_one(
         {"id": admin['id']},
         {"$set": {"last_login": datetime.now(timezone.utc).isoformat()}}
     )
+    invalidate_admin(admin['id'])
     
     token = create_admin_token(admin['id'])
     admin.pop('password_hash', None)
     return {"token": token, "admin": admin}
 
 @api_router.get("/admin/verify")
-async def verify_admin(request: Request):
+async def verify_admin(admin: dict = Depends(get_admin_from_token)):
     """Verify admin token"""
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="No token provided")
-    
-    token = auth_header.split(" ")[1]
-    payload = verify_admin_token(token)
-    if not payload:
-        raise HTTPException(status_code=401, detail="Invalid admin token")
-    
-    admin = await db.admins.find_one({"id": payload['admin_id']}, {"_id": 0, "password_hash": 0})
-    if not admin:
-        raise HTTPException(status_code=401, detail="Admin not found")
-    
     return {"admin": admin}
 
 @api_router.put("/admin/update-credentials")
-async def update_admin_credentials(request: Request, update_data: AdminUpdateCredentials):
+async def update_admin_credentials(update_data: AdminUpdateCredentials, current: dict = Depends(get_admin_from_token)):
     """Update admin credentials"""
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="No token provided")
-    
-    token = auth_header.split(" ")[1]
-    payload = verify_admin_token(token)
-    if not payload:
-        raise HTTPException(status_code=401, detail="Invalid admin token")
-    
-    admin = await db.admins.find_one({"id": payload['admin_id']})
+    # Need the password hash, so bypass the cached record
+    admin = await db.admins.find_one({"id": current['id']})
     if not admin:
         raise HTTPException(status_code=401, detail="Admin not found")
     
     # Verify current password
-    if not verify_password(update_data.current_password, admin['password_hash']):
+    if not await verify_password(update_data.current_password, admin['password_hash']):
         raise HTTPException(status_code=401, detail="Current password is incorrect")
     
     # Prepare updates
@@ -1860,51 +4104,42 @@ async def update_admin_credentials(request: Request, update_data: AdminUpdateCre
     if update_data.new_username:
         updates["username"] = update_data.new_username
     if update_data.new_password:
-        updates["password_hash"] = hash_password(update_data.new_password)
+        updates["password_hash"] = await hash_password(update_data.new_password)
     
     if updates:
         await db.admins.update_one({"id": admin['id']}, {"$set": updates})
+        invalidate_admin(admin['id'])
     
     return {"message": "Credentials updated successfully"}
 
+@api_router.get("/admin/cache-stats")
+async def get_cache_stats(admin: dict = Depends(get_admin_from_token)):
+    """In-process cache counters for this worker"""
+    return {
+        "worker": WORKER_ID,
+        "sessions": session_cache.stats(),
+        "responses": response_cache.stats(),
+        "decoded_tokens": {"size": len(decoded_tokens), "rejected": len(rejected_tokens)},
+        "admins": {"size": len(admin_cache)},
+        "llm": llm_gateway.stats(),
+        "openers": opener_cache.stats()
+    }
+
 @api_router.get("/admin/analytics")
-async def get_admin_analytics(request: Request):
+async def get_admin_analytics(admin: dict = Depends(get_admin_from_token)):
     """Get platform analytics"""
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="No token provided")
-    
-    token = auth_header.split(" ")[1]
-    if not verify_admin_token(token):
-        raise HTTPException(status_code=401, detail="Invalid admin token")
-    
-    # Get counts
-    total_users = await db.users.count_documents({})
-    total_characters = await db.characters.count_documents({})
-    total_custom_characters = await db.custom_characters.count_documents({})
-    total_messages = await db.messages.count_documents({})
-    total_images = await db.generated_images.count_documents({})
-    total_favorites = await db.favorites.count_documents({})
-    
-    # Get recent users (last 7 days)
-    week_ago = datetime.now(timezone.utc) - timedelta(days=7)
-    recent_users = await db.users.count_documents({
-        "created_at": {"$gte": week_ago.isoformat()}
-    })
+    # Totals are cheap metadata counts; trends come from the rollups
+    total_users = await db.users.estimated_document_count()
+    total_characters = await db.characters.estimated_document_count()
+    total_custom_characters = await db.custom_characters.estimated_document_count()
+    total_messages = await db.messages.estimated_document_count()
+    total_images = await db.generated_images.estimated_document_count()
+    total_favorites = await db.favorites.estimated_document_count()
     
     # Get users by day for last 7 days
-    users_by_day = []
-    for i in range(7):
-        day = datetime.now(timezone.utc) - timedelta(days=i)
-        day_start = day.replace(hour=0, minute=0, second=0, microsecond=0)
-        day_end = day_start + timedelta(days=1)
-        count = await db.users.count_documents({
-            "created_at": {"$gte": day_start.isoformat(), "$lt": day_end.isoformat()}
-        })
-        users_by_day.append({
-            "date": day_start.strftime("%Y-%m-%d"),
-            "count": count
-        })
+    days = recent_day_buckets(7)
+    signups = await read_rollup_series("signups", "day", days)
+    users_by_day = [{"date": day, "count": count} for day, count in zip(days, signups)]
     
     return {
         "total_users": total_users,
@@ -1913,49 +4148,48 @@ async def get_admin_analytics(request: Request):
         "total_messages": total_messages,
         "total_images": total_images,
         "total_favorites": total_favorites,
-        "recent_users": recent_users,
-        "users_by_day": list(reversed(users_by_day))
+        "recent_users": sum(signups),
+        "users_by_day": users_by_day
     }
 
 @api_router.get("/admin/users")
-async def get_all_users(request: Request, skip: int = 0, limit: int = 50):
-    """Get all users (paginated)"""
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="No token provided")
-    
-    token = auth_header.split(" ")[1]
-    if not verify_admin_token(token):
-        raise HTTPException(status_code=401, detail="Invalid admin token")
-    
-    users = await db.users.find({}, {"_id": 0, "password_hash": 0}).skip(skip).limit(limit).to_list(limit)
-    total = await db.users.count_documents({})
+async def get_all_users(limit: int = 50, cursor: Optional[str] = None, admin: dict = Depends(get_admin_from_token)):
+    """Get all users, newest first (cursor paginated)"""
+    users, next_cursor = await keyset_page(
+        db.users, {}, ["created_at", "id"], limit, cursor, {"_id": 0, "password_hash": 0}
+    )
+    total = await db.users.estimated_document_count()
     
-    # Get additional stats for each user
-    for user in users:
-        user['chat_count'] = await db.messages.count_documents({"chat_id": {"$regex": f"^{user['id']}_"}})
-        user['favorites_count'] = await db.favorites.count_documents({"user_id": user['id']})
-        user['custom_chars_count'] = await db.custom_characters.count_documents({"user_id": user['id']})
+    # Get additional stats for the whole page, one grouped query per collection
+    user_ids = [user.get('id') or user.get('user_id') for user in users]
+    if await chat_index_built():
+        message_counts = await count_by(db.chats, "user_id", user_ids, sum_field="message_count")
+    else:
+        # db.chats is still being filled by migration 0005
+        message_counts = await count_by(db.messages, "user_id", user_ids)
+    favorite_counts = await count_by(db.favorites, "user_id", user_ids)
+    custom_counts = await count_by(db.custom_characters, "user_id", user_ids)
+    for user, user_id in zip(users, user_ids):
+        user['chat_count'] = message_counts.get(user_id, 0)
+        user['favorites_count'] = favorite_counts.get(user_id, 0)
+        user['custom_chars_count'] = custom_counts.get(user_id, 0)
     
-    return {"users": users, "total": total, "skip": skip, "limit": limit}
+    return {"users": users, "total": total, "limit": max(1, min(limit, MAX_PAGE_SIZE)), "next_cursor": next_cursor}
 
 @api_router.delete("/admin/users/{user_id}")
-async def admin_delete_user(request: Request, user_id: str):
+async def admin_delete_user(user_id: str, admin: dict = Depends(get_admin_from_token)):
     """Delete a user and all their data"""
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="No token provided")
-    
-    token = auth_header.split(" ")[1]
-    if not verify_admin_token(token):
-        raise HTTPException(status_code=401, detail="Invalid admin token")
-    
     # Delete all user data
-    await db.messages.delete_many({"chat_id": {"$regex": f"^{user_id}_"}})
+    await db.messages.delete_many({"user_id": user_id})
+    await db.chat_memories.delete_many({"user_id": user_id})
+    await db.chats.delete_many({"user_id": user_id})
     await db.favorites.delete_many({"user_id": user_id})
     await db.custom_characters.delete_many({"user_id": user_id})
+    character_repository.invalidate_custom()
     await db.generated_images.delete_many({"user_id": user_id})
     await db.user_sessions.delete_many({"user_id": user_id})
+    session_cache.invalidate_user(user_id)
+    await db.analytics_totals.delete_one({"_id": f"user:{user_id}"})
     result = await db.users.delete_one({"id": user_id})
     
     if result.deleted_count == 0:
@@ -1964,16 +4198,8 @@ async def admin_delete_user(request: Request, user_id: str):
     return {"message": "User and all data deleted successfully"}
 
 @api_router.get("/admin/characters")
-async def get_all_characters_admin(request: Request):
+async def get_all_characters_admin(admin: dict = Depends(get_admin_from_token)):
     """Get all characters including custom ones"""
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="No token provided")
-    
-    token = auth_header.split(" ")[1]
-    if not verify_admin_token(token):
-        raise HTTPException(status_code=401, detail="Invalid admin token")
-    
     default_chars = await db.characters.find({}, {"_id": 0}).to_list(100)
     custom_chars = await db.custom_characters.find({}, {"_id": 0}).to_list(100)
     
@@ -1985,20 +4211,16 @@ async def get_all_characters_admin(request: Request):
     }
 
 @api_router.delete("/admin/characters/{character_id}")
-async def admin_delete_character(request: Request, character_id: str, is_custom: bool = False):
+async def admin_delete_character(character_id: str, is_custom: bool = False, admin: dict = Depends(get_admin_from_token)):
     """Delete a character"""
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="No token provided")
-    
-    token = auth_header.split(" ")[1]
-    if not verify_admin_token(token):
-        raise HTTPException(status_code=401, detail="Invalid admin token")
-    
     if is_custom:
         result = await db.custom_characters.delete_one({"id": character_id})
+        character_repository.invalidate_custom(character_id)
     else:
         result = await db.characters.delete_one({"id": character_id})
+        character_repository.invalidate_defaults()
+        await response_cache.invalidate("characters")
+    await forget_generated_replies(character_id)
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Character not found")
@@ -2100,118 +4322,66 @@ async def log_admin_activity(admin_id: str, admin_email: str, action: str, targe
     }
     await db.admin_activity_logs.insert_one(log_entry)
 
-# --- Helper to get admin from token ---
-async def get_admin_from_token(request: Request):
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="No token provided")
-    
-    token = auth_header.split(" ")[1]
-    payload = verify_admin_token(token)
-    if not payload:
-        raise HTTPException(status_code=401, detail="Invalid admin token")
-    
-    admin = await db.admins.find_one({"id": payload['admin_id']}, {"_id": 0, "password_hash": 0})
-    if not admin:
-        raise HTTPException(status_code=401, detail="Admin not found")
-    
-    # Convert datetime objects to strings
-    result = {}
-    for key, value in admin.items():
-        if isinstance(value, datetime):
-            result[key] = value.isoformat()
-        else:
-            result[key] = value
-    
-    return result
-
 # ============ 1. CONTENT MODERATION ============
 
 @api_router.get("/admin/chats")
-async def admin_get_all_chats(request: Request, skip: int = 0, limit: int = 50):
+async def admin_get_all_chats(limit: int = 50, cursor: Optional[str] = None, admin: dict = Depends(get_admin_from_token)):
     """Get all chat conversations for moderation"""
-    admin = await get_admin_from_token(request)
-    
-    pipeline = [
-        {"$group": {
-            "_id": "$chat_id",
-            "message_count": {"$sum": 1},
-            "last_message": {"$last": "$content"},
-            "last_timestamp": {"$last": "$timestamp"}
-        }},
-        {"$sort": {"last_timestamp": -1}},
-        {"$skip": skip},
-        {"$limit": limit}
-    ]
-    
-    chats = await db.messages.aggregate(pipeline).to_list(limit)
-    total = len(await db.messages.aggregate([{"$group": {"_id": "$chat_id"}}]).to_list(10000))
-    
-    # Get user and character info for each chat
-    result = []
-    for chat in chats:
-        parts = chat["_id"].split("_")
-        if len(parts) >= 2:
-            user_id = parts[0]
-            character_id = "_".join(parts[1:])
-            
-            user = await db.users.find_one({"$or": [{"id": user_id}, {"user_id": user_id}]}, {"_id": 0, "username": 1, "email": 1})
-            character = await db.characters.find_one({"id": character_id}, {"_id": 0, "name": 1})
-            if not character:
-                character = await db.custom_characters.find_one({"id": character_id}, {"_id": 0, "name": 1})
-            
-            result.append({
-                "chat_id": chat["_id"],
-                "user_id": user_id,
-                "user_name": user.get("username") if user else "Unknown",
-                "user_email": user.get("email") if user else "Unknown",
-                "character_id": character_id,
-                "character_name": character.get("name") if character else "Unknown",
-                "message_count": chat["message_count"],
-                "last_message": chat["last_message"][:100] + "..." if len(chat["last_message"]) > 100 else chat["last_message"],
-                "last_timestamp": chat["last_timestamp"]
-            })
-    
-    return {"chats": result, "total": total}
+    limit = max(1, min(limit, 100))
+    
+    chats = await list_chat_summaries({}, limit, cursor)
+    total = await count_chats()
+    
+    result = [{
+        "chat_id": chat["id"],
+        "user_id": chat["user_id"],
+        "user_name": chat.get("user_name", "Unknown"),
+        "user_email": chat.get("user_email", "Unknown"),
+        "character_id": chat["character_id"],
+        "character_name": chat.get("character_name", "Unknown"),
+        "message_count": chat["message_count"],
+        "last_message": truncate_preview(chat["last_message"], 100),
+        "last_timestamp": chat["last_timestamp"]
+    } for chat in chats]
+    
+    next_cursor = encode_cursor([chats[-1]["last_timestamp"], chats[-1]["id"]]) if len(chats) == limit else None
+    return {"chats": result, "total": total, "next_cursor": next_cursor}
 
 @api_router.get("/admin/chats/{chat_id}/messages")
-async def admin_get_chat_messages(request: Request, chat_id: str, limit: int = 100):
+async def admin_get_chat_messages(chat_id: str, limit: int = 100, admin: dict = Depends(get_admin_from_token)):
     """Get all messages in a specific chat"""
-    admin = await get_admin_from_token(request)
-    
     messages = await db.messages.find({"chat_id": chat_id}, {"_id": 0}).sort("timestamp", 1).limit(limit).to_list(limit)
     return {"messages": messages, "chat_id": chat_id}
 
 @api_router.delete("/admin/chats/{chat_id}")
-async def admin_delete_chat(request: Request, chat_id: str):
+async def admin_delete_chat(chat_id: str, admin: dict = Depends(get_admin_from_token)):
     """Delete an entire chat conversation"""
-    admin = await get_admin_from_token(request)
-    
     result = await db.messages.delete_many({"chat_id": chat_id})
+    await db.chat_memories.delete_one({"chat_id": chat_id})
+    await db.chats.delete_one({"id": chat_id})
     
     await log_admin_activity(admin['id'], admin['email'], "delete_chat", "chat", chat_id, f"Deleted {result.deleted_count} messages")
     
     return {"message": f"Deleted {result.deleted_count} messages", "deleted_count": result.deleted_count}
 
 @api_router.delete("/admin/messages/{message_id}")
-async def admin_delete_message(request: Request, message_id: str):
+async def admin_delete_message(message_id: str, admin: dict = Depends(get_admin_from_token)):
     """Delete a specific message"""
-    admin = await get_admin_from_token(request)
-    
-    result = await db.messages.delete_one({"id": message_id})
+    message = await db.messages.find_one_and_delete({"id": message_id}, {"_id": 0, "chat_id": 1})
     
-    if result.deleted_count == 0:
+    if not message:
         raise HTTPException(status_code=404, detail="Message not found")
     
+    await db.chat_memories.update_one({"chat_id": message["chat_id"]}, {"$pull": {"turns": {"id": message_id}}})
+    await refresh_chat_summary(message["chat_id"])
+    
     await log_admin_activity(admin['id'], admin['email'], "delete_message", "chat", message_id)
     
     return {"message": "Message deleted"}
 
 @api_router.post("/admin/chats/flag")
-async def admin_flag_chat(request: Request, chat_id: str, reason: str, message_id: str = None):
+async def admin_flag_chat(chat_id: str, reason: str, message_id: str = None, admin: dict = Depends(get_admin_from_token)):
     """Flag a chat or message for review"""
-    admin = await get_admin_from_token(request)
-    
     flag = {
         "id": str(uuid.uuid4()),
         "chat_id": chat_id,
@@ -2229,20 +4399,16 @@ async def admin_flag_chat(request: Request, chat_id: str, reason: str, message_i
     return {"message": "Chat flagged", "flag_id": flag['id']}
 
 @api_router.get("/admin/chats/flags")
-async def admin_get_flagged_chats(request: Request, status: str = None):
+async def admin_get_flagged_chats(status: str = None, admin: dict = Depends(get_admin_from_token)):
     """Get all flagged chats"""
-    admin = await get_admin_from_token(request)
-    
     query = {} if not status else {"status": status}
     flags = await db.chat_flags.find(query, {"_id": 0}).sort("created_at", -1).to_list(100)
     
     return {"flags": flags}
 
 @api_router.put("/admin/chats/flags/{flag_id}")
-async def admin_update_flag_status(request: Request, flag_id: str, status: str):
+async def admin_update_flag_status(flag_id: str, status: str, admin: dict = Depends(get_admin_from_token)):
     """Update flag status"""
-    admin = await get_admin_from_token(request)
-    
     result = await db.chat_flags.update_one({"id": flag_id}, {"$set": {"status": status}})
     
     if result.matched_count == 0:
@@ -2255,8 +4421,11 @@ async def admin_update_flag_status(request: Request, flag_id: str, status: str):
 # ============ 2. SITE ANNOUNCEMENTS ============
 
 @api_router.get("/announcements/active")
-async def get_active_announcements():
+async def get_active_announcements(request: Request):
     """Get active announcements (public endpoint)"""
+    return await response_cache.serve(request, "announcements", 60, load_active_announcements)
+
+async def load_active_announcements():
     now = datetime.now(timezone.utc).isoformat()
     
     query = {
@@ -2273,18 +4442,14 @@ async def get_active_announcements():
     return {"announcements": announcements}
 
 @api_router.get("/admin/announcements")
-async def admin_get_all_announcements(request: Request):
+async def admin_get_all_announcements(admin: dict = Depends(get_admin_from_token)):
     """Get all announcements"""
-    admin = await get_admin_from_token(request)
-    
     announcements = await db.announcements.find({}, {"_id": 0}).sort("created_at", -1).to_list(100)
     return {"announcements": announcements}
 
 @api_router.post("/admin/announcements")
-async def admin_create_announcement(request: Request, data: AnnouncementCreate):
+async def admin_create_announcement(data: AnnouncementCreate, admin: dict = Depends(get_admin_from_token)):
     """Create a new announcement"""
-    admin = await get_admin_from_token(request)
-    
     announcement = {
         "id": str(uuid.uuid4()),
         "title": data.title,
@@ -2298,16 +4463,15 @@ async def admin_create_announcement(request: Request, data: AnnouncementCreate):
     }
     
     await db.announcements.insert_one(announcement)
+    await response_cache.invalidate("announcements")
     announcement.pop("_id", None)  # Remove MongoDB's _id
     await log_admin_activity(admin['id'], admin['email'], "create_announcement", "announcement", announcement['id'], data.title)
     
     return {"announcement": announcement, "message": "Announcement created"}
 
 @api_router.put("/admin/announcements/{announcement_id}")
-async def admin_update_announcement(request: Request, announcement_id: str, data: AnnouncementCreate):
+async def admin_update_announcement(announcement_id: str, data: AnnouncementCreate, admin: dict = Depends(get_admin_from_token)):
     """Update an announcement"""
-    admin = await get_admin_from_token(request)
-    
     updates = {
         "title": data.title,
         "message": data.message,
@@ -2318,6 +4482,7 @@ async def admin_update_announcement(request: Request, announcement_id: str, data
     }
     
     result = await db.announcements.update_one({"id": announcement_id}, {"$set": updates})
+    await response_cache.invalidate("announcements")
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Announcement not found")
@@ -2327,11 +4492,10 @@ async def admin_update_announcement(request: Request, announcement_id: str, data
     return {"message": "Announcement updated"}
 
 @api_router.delete("/admin/announcements/{announcement_id}")
-async def admin_delete_announcement(request: Request, announcement_id: str):
+async def admin_delete_announcement(announcement_id: str, admin: dict = Depends(get_admin_from_token)):
     """Delete an announcement"""
-    admin = await get_admin_from_token(request)
-    
     result = await db.announcements.delete_one({"id": announcement_id})
+    await response_cache.invalidate("announcements")
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Announcement not found")
@@ -2343,78 +4507,54 @@ async def admin_delete_announcement(request: Request, announcement_id: str):
 # ============ 3. CHAT ANALYTICS ============
 
 @api_router.get("/admin/analytics/chats")
-async def admin_chat_analytics(request: Request):
+async def admin_chat_analytics(admin: dict = Depends(get_admin_from_token)):
     """Get detailed chat analytics"""
-    admin = await get_admin_from_token(request)
-    
     # Most active users (by message count)
-    active_users_pipeline = [
-        {"$addFields": {"user_id": {"$arrayElemAt": [{"$split": ["$chat_id", "_"]}, 0]}}},
-        {"$group": {"_id": "$user_id", "message_count": {"$sum": 1}}},
-        {"$sort": {"message_count": -1}},
-        {"$limit": 10}
-    ]
-    active_users = await db.messages.aggregate(active_users_pipeline).to_list(10)
+    active_users = await db.analytics_totals.find(
+        {"kind": "user"}, {"_id": 0, "key": 1, "messages": 1}
+    ).sort("messages", -1).limit(10).to_list(10)
+    active_users = [{"_id": row["key"], "message_count": row["messages"]} for row in active_users]
     
     # Enrich with user details
+    user_docs = await users_by_id([user["_id"] for user in active_users])
     for user in active_users:
-        user_doc = await db.users.find_one({"$or": [{"id": user["_id"]}, {"user_id": user["_id"]}]}, {"_id": 0, "username": 1, "email": 1})
+        user_doc = user_docs.get(user["_id"])
         user["username"] = user_doc.get("username") if user_doc else "Unknown"
         user["email"] = user_doc.get("email") if user_doc else "Unknown"
     
     # Most popular characters
-    popular_chars_pipeline = [
-        {"$addFields": {"parts": {"$split": ["$chat_id", "_"]}}},
-        {"$addFields": {"character_id": {"$reduce": {
-            "input": {"$slice": ["$parts", 1, {"$subtract": [{"$size": "$parts"}, 1]}]},
-            "initialValue": "",
-            "in": {"$cond": [{"$eq": ["$$value", ""]}, "$$this", {"$concat": ["$$value", "_", "$$this"]}]}
-        }}}},
-        {"$group": {"_id": "$character_id", "chat_count": {"$sum": 1}}},
-        {"$sort": {"chat_count": -1}},
-        {"$limit": 10}
-    ]
-    popular_chars = await db.messages.aggregate(popular_chars_pipeline).to_list(10)
+    popular_chars = await db.analytics_totals.find(
+        {"kind": "character"}, {"_id": 0, "key": 1, "messages": 1}
+    ).sort("messages", -1).limit(10).to_list(10)
+    popular_chars = [{"_id": row["key"], "chat_count": row["messages"]} for row in popular_chars]
     
     # Enrich with character details
+    char_docs = await character_repository.get_many([char["_id"] for char in popular_chars])
     for char in popular_chars:
-        char_doc = await db.characters.find_one({"id": char["_id"]}, {"_id": 0, "name": 1, "avatar_url": 1})
-        if not char_doc:
-            char_doc = await db.custom_characters.find_one({"id": char["_id"]}, {"_id": 0, "name": 1, "avatar_url": 1})
+        char_doc = char_docs.get(char["_id"])
         char["name"] = char_doc.get("name") if char_doc else "Unknown"
         char["avatar_url"] = char_doc.get("avatar_url") if char_doc else None
     
     # Messages by day (last 14 days)
-    messages_by_day = []
-    for i in range(14):
-        day = datetime.now(timezone.utc) - timedelta(days=i)
-        day_start = day.replace(hour=0, minute=0, second=0, microsecond=0)
-        day_end = day_start + timedelta(days=1)
-        count = await db.messages.count_documents({
-            "timestamp": {"$gte": day_start.isoformat(), "$lt": day_end.isoformat()}
-        })
-        messages_by_day.append({"date": day_start.strftime("%Y-%m-%d"), "count": count})
+    days = recent_day_buckets(14)
+    day_counts = await read_rollup_series("messages", "day", days)
+    messages_by_day = [{"date": day, "count": count} for day, count in zip(days, day_counts)]
     
     # Messages by hour (last 24 hours)
-    messages_by_hour = []
-    for i in range(24):
-        hour_start = datetime.now(timezone.utc) - timedelta(hours=i+1)
-        hour_end = hour_start + timedelta(hours=1)
-        count = await db.messages.count_documents({
-            "timestamp": {"$gte": hour_start.isoformat(), "$lt": hour_end.isoformat()}
-        })
-        messages_by_hour.append({"hour": hour_start.strftime("%H:00"), "count": count})
+    hours = recent_hour_buckets(24)
+    hour_counts = await read_rollup_series("messages", "hour", [hour.strftime("%Y-%m-%dT%H") for hour in hours])
+    messages_by_hour = [{"hour": hour.strftime("%H:00"), "count": count} for hour, count in zip(hours, hour_counts)]
     
     # Average messages per user
-    total_messages = await db.messages.count_documents({})
-    total_users = await db.users.count_documents({})
+    total_messages = await db.messages.estimated_document_count()
+    total_users = await db.users.estimated_document_count()
     avg_messages = round(total_messages / max(total_users, 1), 2)
     
     return {
         "most_active_users": active_users,
         "most_popular_characters": popular_chars,
-        "messages_by_day": list(reversed(messages_by_day)),
-        "messages_by_hour": list(reversed(messages_by_hour)),
+        "messages_by_day": messages_by_day,
+        "messages_by_hour": messages_by_hour,
         "average_messages_per_user": avg_messages,
         "total_messages": total_messages
     }
@@ -2422,10 +4562,8 @@ async def admin_chat_analytics(request: Request):
 # ============ 4. CHARACTER EDITOR ============
 
 @api_router.put("/admin/characters/{character_id}")
-async def admin_update_character(request: Request, character_id: str, data: CharacterUpdate, is_custom: bool = False):
+async def admin_update_character(character_id: str, data: CharacterUpdate, is_custom: bool = False, admin: dict = Depends(get_admin_from_token)):
     """Update a character's details"""
-    admin = await get_admin_from_token(request)
-    
     updates = {k: v for k, v in data.model_dump().items() if v is not None}
     
     if not updates:
@@ -2433,10 +4571,21 @@ async def admin_update_character(request: Request, character_id: str, data: Char
     
     collection = db.custom_characters if is_custom else db.characters
     result = await collection.update_one({"id": character_id}, {"$set": updates})
+    if is_custom:
+        character_repository.invalidate_custom(character_id)
+    else:
+        character_repository.invalidate_defaults()
+        await response_cache.invalidate("characters")
+    await forget_generated_replies(character_id)
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Character not found")
     
+    chat_updates = {"character_name": updates.get("name"), "character_avatar": updates.get("avatar_url")}
+    chat_updates = {k: v for k, v in chat_updates.items() if v is not None}
+    if chat_updates:
+        await db.chats.update_many({"character_id": character_id}, {"$set": chat_updates})
+    
     await log_admin_activity(admin['id'], admin['email'], "update_character", "character", character_id, str(updates))
     
     updated = await collection.find_one({"id": character_id}, {"_id": 0})
@@ -2461,10 +4610,8 @@ async def mark_notification_read(notification_id: str):
     return {"message": "Notification marked as read"}
 
 @api_router.post("/admin/notifications")
-async def admin_send_notification(request: Request, data: NotificationCreate):
+async def admin_send_notification(data: NotificationCreate, admin: dict = Depends(get_admin_from_token)):
     """Send a notification to a user or broadcast to all"""
-    admin = await get_admin_from_token(request)
-    
     notification = {
         "id": str(uuid.uuid4()),
         "user_id": data.user_id,  # None for broadcast
@@ -2484,20 +4631,16 @@ async def admin_send_notification(request: Request, data: NotificationCreate):
     return {"notification": notification, "message": "Notification sent"}
 
 @api_router.get("/admin/notifications")
-async def admin_get_all_notifications(request: Request, limit: int = 100):
+async def admin_get_all_notifications(limit: int = 100, admin: dict = Depends(get_admin_from_token)):
     """Get all sent notifications"""
-    admin = await get_admin_from_token(request)
-    
     notifications = await db.notifications.find({}, {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
     return {"notifications": notifications}
 
 # ============ 6. REVENUE DASHBOARD (MOCK) ============
 
 @api_router.get("/admin/analytics/revenue")
-async def admin_revenue_analytics(request: Request):
+async def admin_revenue_analytics(admin: dict = Depends(get_admin_from_token)):
     """Get revenue analytics (currently mocked - will be real when Stripe is integrated)"""
-    admin = await get_admin_from_token(request)
-    
     # Count users by subscription type (mock data based on user count)
     total_users = await db.users.count_documents({})
     
@@ -2539,10 +4682,8 @@ async def admin_revenue_analytics(request: Request):
 # ============ 7. ADMIN ROLES & MANAGEMENT ============
 
 @api_router.get("/admin/admins")
-async def admin_get_all_admins(request: Request):
+async def admin_get_all_admins(admin: dict = Depends(get_admin_from_token)):
     """Get all admin accounts"""
-    admin = await get_admin_from_token(request)
-    
     if not admin.get("is_super_admin"):
         raise HTTPException(status_code=403, detail="Super admin access required")
     
@@ -2550,10 +4691,8 @@ async def admin_get_all_admins(request: Request):
     return {"admins": admins}
 
 @api_router.post("/admin/admins")
-async def admin_create_admin(request: Request, data: AdminCreate):
+async def admin_create_admin(data: AdminCreate, admin: dict = Depends(get_admin_from_token)):
     """Create a new admin account"""
-    admin = await get_admin_from_token(request)
-    
     if not admin.get("is_super_admin"):
         raise HTTPException(status_code=403, detail="Super admin access required")
     
@@ -2566,7 +4705,7 @@ async def admin_create_admin(request: Request, data: AdminCreate):
         "id": str(uuid.uuid4()),
         "email": data.email,
         "username": data.username,
-        "password_hash": hash_password(data.password),
+        "password_hash": await hash_password(data.password),
         "role": data.role,
         "is_super_admin": data.role == "super_admin",
         "created_at": datetime.now(timezone.utc).isoformat(),
@@ -2581,10 +4720,8 @@ async def admin_create_admin(request: Request, data: AdminCreate):
     return {"admin": new_admin, "message": "Admin created"}
 
 @api_router.delete("/admin/admins/{admin_id}")
-async def admin_delete_admin(request: Request, admin_id: str):
+async def admin_delete_admin(admin_id: str, admin: dict = Depends(get_admin_from_token)):
     """Delete an admin account"""
-    admin = await get_admin_from_token(request)
-    
     if not admin.get("is_super_admin"):
         raise HTTPException(status_code=403, detail="Super admin access required")
     
@@ -2592,6 +4729,7 @@ async def admin_delete_admin(request: Request, admin_id: str):
         raise HTTPException(status_code=400, detail="Cannot delete your own account")
     
     result = await db.admins.delete_one({"id": admin_id})
+    invalidate_admin(admin_id)
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Admin not found")
@@ -2601,15 +4739,14 @@ async def admin_delete_admin(request: Request, admin_id: str):
     return {"message": "Admin deleted"}
 
 @api_router.put("/admin/admins/{admin_id}/role")
-async def admin_update_admin_role(request: Request, admin_id: str, role: str):
+async def admin_update_admin_role(admin_id: str, role: str, admin: dict = Depends(get_admin_from_token)):
     """Update an admin's role"""
-    admin = await get_admin_from_token(request)
-    
     if not admin.get("is_super_admin"):
         raise HTTPException(status_code=403, detail="Super admin access required")
     
     is_super = role == "super_admin"
     result = await db.admins.update_one({"id": admin_id}, {"$set": {"role": role, "is_super_admin": is_super}})
+    invalidate_admin(admin_id)
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Admin not found")
@@ -2621,26 +4758,26 @@ async def admin_update_admin_role(request: Request, admin_id: str, role: str):
 # ============ 8. ACTIVITY LOGS ============
 
 @api_router.get("/admin/activity-logs")
-async def admin_get_activity_logs(request: Request, skip: int = 0, limit: int = 100, action: str = None, admin_id: str = None):
+async def admin_get_activity_logs(limit: int = 100, cursor: Optional[str] = None, action: str = None, admin_id: str = None, admin: dict = Depends(get_admin_from_token)):
     """Get admin activity logs"""
-    admin = await get_admin_from_token(request)
-    
     query = {}
     if action:
         query["action"] = action
     if admin_id:
         query["admin_id"] = admin_id
     
-    logs = await db.admin_activity_logs.find(query, {"_id": 0}).sort("timestamp", -1).skip(skip).limit(limit).to_list(limit)
-    total = await db.admin_activity_logs.count_documents(query)
+    logs, next_cursor = await keyset_page(db.admin_activity_logs, query, ["timestamp", "id"], limit, cursor)
+    if query:
+        # Filtered totals need a count; only pay for it on the first page
+        total = await db.admin_activity_logs.count_documents(query) if not cursor else None
+    else:
+        total = await db.admin_activity_logs.estimated_document_count()
     
-    return {"logs": logs, "total": total}
+    return {"logs": logs, "total": total, "next_cursor": next_cursor}
 
 @api_router.get("/admin/activity-logs/summary")
-async def admin_get_activity_summary(request: Request):
+async def admin_get_activity_summary(admin: dict = Depends(get_admin_from_token)):
     """Get activity logs summary"""
-    admin = await get_admin_from_token(request)
-    
     # Actions by type
     actions_pipeline = [
         {"$group": {"_id": "$action", "count": {"$sum": 1}}},
@@ -2714,46 +4851,120 @@ class BlogPostUpdate(BaseModel):
     status: Optional[str] = None
 
 # Public blog routes (for SEO - no auth required)
+# Blog views are counted in memory and flushed in one bulk_write, so a popular post
+# is not a hot document taking a write per page view
+VIEW_FLUSH_SECONDS = 15
+VIEW_FLUSH_JITTER = 5
+
+class ViewCounter:
+    def __init__(self):
+        self.pending = {}  # slug -> views since last flush
+    
+    def hit(self, slug: str):
+        self.pending[slug] = self.pending.get(slug, 0) + 1
+    
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        try:
+            await db.blog_posts.bulk_write(
+                [UpdateOne({"slug": slug}, {"$inc": {"views": count}}) for slug, count in batch.items()],
+                ordered=False
+            )
+        except Exception as e:
+            logging.error(f"Blog view flush failed, retrying next cycle: {e}")
+            for slug, count in batch.items():
+                self.pending[slug] = self.pending.get(slug, 0) + count
+    
+    async def run(self):
+        # Jitter keeps several workers from flushing in lockstep
+        while True:
+            await asyncio.sleep(VIEW_FLUSH_SECONDS + random.uniform(0, VIEW_FLUSH_JITTER))
+            await self.flush()
+
+blog_view_counter = ViewCounter()
+
+BLOG_MAX_PAGE = 100
+
 @api_router.get("/blog/posts")
 async def get_blog_posts(
+    request: Request,
     page: int = 1,
     limit: int = 10,
     category: Optional[str] = None,
-    tag: Optional[str] = None
+    tag: Optional[str] = None,
+    cursor: Optional[str] = None
 ):
-    """Get published blog posts with pagination (public endpoint)"""
+    """Get published blog posts with pagination (public endpoint).
+    
+    Pass `cursor` (from next_cursor) to page by keyset. Numbered `page` links are
+    kept for crawlable /blog?page=N URLs; pages past BLOG_MAX_PAGE return 404 and
+    `pages` never exceeds it, so deeper posts are reached through next_cursor.
+    """
+    return await response_cache.serve(
+        request, "blog", 120, lambda: load_blog_posts(page, limit, category, tag, cursor),
+        params=("page", "limit", "category", "tag", "cursor")
+    )
+
+async def load_blog_posts(page: int, limit: int, category: Optional[str], tag: Optional[str], cursor: Optional[str]):
+    limit = max(1, min(limit, 50))
     query = {"status": "published"}
     if category:
         query["category"] = category
     if tag:
         query["tags"] = tag
     
-    skip = (page - 1) * limit
-    posts = await db.blog_posts.find(query, {"_id": 0, "content": 0}).sort("published_at", -1).skip(skip).limit(limit).to_list(limit)
-    total = await db.blog_posts.count_documents(query)
+    projection = {"_id": 0, "content": 0}
+    if cursor:
+        posts, next_cursor = await keyset_page(db.blog_posts, query, ["published_at", "id"], limit, cursor, projection)
+    else:
+        if page > BLOG_MAX_PAGE:
+            raise HTTPException(status_code=404, detail=f"Numbered pages stop at {BLOG_MAX_PAGE}; use next_cursor")
+        page = max(1, page)
+        posts = await db.blog_posts.find(query, projection).sort(
+            [("published_at", -1), ("id", -1)]
+        ).skip((page - 1) * limit).limit(limit).to_list(limit)
+        next_cursor = encode_cursor([posts[-1]["published_at"], posts[-1]["id"]]) if len(posts) == limit else None
+    
+    # This body is response-cached, so filtered totals are exact as of the last build.
+    # Unfiltered, the collection metadata count minus the (few) unpublished posts avoids a full count.
+    if category or tag:
+        total = await db.blog_posts.count_documents(query)
+    else:
+        unpublished = await db.blog_posts.count_documents({"status": {"$ne": "published"}})
+        total = max(0, await db.blog_posts.estimated_document_count() - unpublished)
     
     return {
         "posts": posts,
         "total": total,
         "page": page,
-        "pages": (total + limit - 1) // limit
+        "pages": min((total + limit - 1) // limit, BLOG_MAX_PAGE),
+        "next_cursor": next_cursor
     }
 
 @api_router.get("/blog/posts/{slug}")
-async def get_blog_post_by_slug(slug: str):
+async def get_blog_post_by_slug(request: Request, slug: str):
     """Get a single blog post by slug (public endpoint)"""
-    post = await db.blog_posts.find_one({"slug": slug, "status": "published"}, {"_id": 0})
-    if not post:
-        raise HTTPException(status_code=404, detail="Blog post not found")
+    async def build():
+        post = await db.blog_posts.find_one({"slug": slug, "status": "published"}, {"_id": 0})
+        if not post:
+            raise HTTPException(status_code=404, detail="Blog post not found")
+        return post
     
-    # Increment view count
-    await db.blog_posts.update_one({"slug": slug}, {"$inc": {"views": 1}})
+    response = await response_cache.serve(request, "blog", 120, build)
     
-    return post
+    # Increment view count (buffered; the cached body's count lags by up to the TTL)
+    blog_view_counter.hit(slug)
+    
+    return response
 
 @api_router.get("/blog/categories")
-async def get_blog_categories():
+async def get_blog_categories(request: Request):
     """Get all blog categories with post counts"""
+    return await response_cache.serve(request, "blog", 300, load_blog_categories)
+
+async def load_blog_categories():
     pipeline = [
         {"$match": {"status": "published"}},
         {"$group": {"_id": "$category", "count": {"$sum": 1}}},
@@ -2763,8 +4974,11 @@ async def get_blog_categories():
     return {"categories": [{"name": c["_id"], "count": c["count"]} for c in categories]}
 
 @api_router.get("/blog/tags")
-async def get_blog_tags():
+async def get_blog_tags(request: Request):
     """Get all blog tags"""
+    return await response_cache.serve(request, "blog", 300, load_blog_tags)
+
+async def load_blog_tags():
     pipeline = [
         {"$match": {"status": "published"}},
         {"$unwind": "$tags"},
@@ -2776,8 +4990,11 @@ async def get_blog_tags():
     return {"tags": [{"name": t["_id"], "count": t["count"]} for t in tags]}
 
 @api_router.get("/blog/related/{slug}")
-async def get_related_posts(slug: str, limit: int = 3):
+async def get_related_posts(request: Request, slug: str, limit: int = 3):
     """Get related blog posts based on category and tags"""
+    return await response_cache.serve(request, "blog", 300, lambda: load_related_posts(slug, max(1, min(limit, 12))), params=("limit",))
+
+async def load_related_posts(slug: str, limit: int):
     current_post = await db.blog_posts.find_one({"slug": slug}, {"_id": 0})
     if not current_post:
         raise HTTPException(status_code=404, detail="Blog post not found")
@@ -2797,38 +5014,20 @@ async def get_related_posts(slug: str, limit: int = 3):
 
 # Admin blog routes (protected)
 @api_router.get("/admin/blog/posts")
-async def admin_get_all_blog_posts(request: Request, page: int = 1, limit: int = 20):
+async def admin_get_all_blog_posts(limit: int = 20, cursor: Optional[str] = None, admin: dict = Depends(get_admin_from_token)):
     """Get all blog posts including drafts (admin only)"""
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="No token provided")
-    
-    token = auth_header.split(" ")[1]
-    if not verify_admin_token(token):
-        raise HTTPException(status_code=401, detail="Invalid admin token")
-    
-    skip = (page - 1) * limit
-    posts = await db.blog_posts.find({}, {"_id": 0}).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
-    total = await db.blog_posts.count_documents({})
+    posts, next_cursor = await keyset_page(db.blog_posts, {}, ["created_at", "id"], limit, cursor)
+    total = await db.blog_posts.estimated_document_count()
     
     return {
         "posts": posts,
         "total": total,
-        "page": page,
-        "pages": (total + limit - 1) // limit
+        "next_cursor": next_cursor
     }
 
 @api_router.get("/admin/blog/posts/{post_id}")
-async def admin_get_blog_post(request: Request, post_id: str):
+async def admin_get_blog_post(post_id: str, admin: dict = Depends(get_admin_from_token)):
     """Get a single blog post by ID (admin only)"""
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="No token provided")
-    
-    token = auth_header.split(" ")[1]
-    if not verify_admin_token(token):
-        raise HTTPException(status_code=401, detail="Invalid admin token")
-    
     post = await db.blog_posts.find_one({"id": post_id}, {"_id": 0})
     if not post:
         raise HTTPException(status_code=404, detail="Blog post not found")
@@ -2836,16 +5035,8 @@ async def admin_get_blog_post(request: Request, post_id: str):
     return post
 
 @api_router.post("/admin/blog/posts")
-async def create_blog_post(request: Request, post_data: BlogPostCreate):
+async def create_blog_post(post_data: BlogPostCreate, admin: dict = Depends(get_admin_from_token)):
     """Create a new blog post (admin only)"""
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="No token provided")
-    
-    token = auth_header.split(" ")[1]
-    if not verify_admin_token(token):
-        raise HTTPException(status_code=401, detail="Invalid admin token")
-    
     # Check for duplicate slug
     existing = await db.blog_posts.find_one({"slug": post_data.slug})
     if existing:
@@ -2872,21 +5063,14 @@ async def create_blog_post(request: Request, post_data: BlogPostCreate):
     }
     
     await db.blog_posts.insert_one(post)
+    await response_cache.invalidate("blog", "sitemap")
     post.pop("_id", None)
     
     return {"post": post, "message": "Blog post created successfully"}
 
 @api_router.put("/admin/blog/posts/{post_id}")
-async def update_blog_post(request: Request, post_id: str, update_data: BlogPostUpdate):
+async def update_blog_post(post_id: str, update_data: BlogPostUpdate, admin: dict = Depends(get_admin_from_token)):
     """Update a blog post (admin only)"""
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="No token provided")
-    
-    token = auth_header.split(" ")[1]
-    if not verify_admin_token(token):
-        raise HTTPException(status_code=401, detail="Invalid admin token")
-    
     existing = await db.blog_posts.find_one({"id": post_id})
     if not existing:
         raise HTTPException(status_code=404, detail="Blog post not found")
@@ -2905,22 +5089,16 @@ async def update_blog_post(request: Request, post_id: str, update_data: BlogPost
         updates["published_at"] = datetime.now(timezone.utc).isoformat()
     
     await db.blog_posts.update_one({"id": post_id}, {"$set": updates})
+    await response_cache.invalidate("blog", "sitemap")
     
     updated = await db.blog_posts.find_one({"id": post_id}, {"_id": 0})
     return {"post": updated, "message": "Blog post updated successfully"}
 
 @api_router.delete("/admin/blog/posts/{post_id}")
-async def delete_blog_post(request: Request, post_id: str):
+async def delete_blog_post(post_id: str, admin: dict = Depends(get_admin_from_token)):
     """Delete a blog post (admin only)"""
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="No token provided")
-    
-    token = auth_header.split(" ")[1]
-    if not verify_admin_token(token):
-        raise HTTPException(status_code=401, detail="Invalid admin token")
-    
     result = await db.blog_posts.delete_one({"id": post_id})
+    await response_cache.invalidate("blog", "sitemap")
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Blog post not found")
     
@@ -2931,22 +5109,16 @@ async def delete_blog_post(request: Request, post_id: str):
 # ==========================================
 
 @api_router.get("/payments/plans")
-async def get_subscription_plans():
+async def get_subscription_plans(request: Request):
     """Get all available subscription plans"""
-    return {"plans": SUBSCRIPTION_PLANS}
+    async def build():
+        return {"plans": SUBSCRIPTION_PLANS}
+    return await response_cache.serve(request, "plans", 3600, build)
 
 @api_router.post("/payments/checkout")
-async def create_checkout_session(request: Request, checkout_request: PaymentCheckoutRequest):
+async def create_checkout_session(request: Request, checkout_request: PaymentCheckoutRequest, payload: dict = Depends(get_user_from_token)):
     """Create a payment checkout session for Stripe or PayPal"""
     # Verify user token
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Authentication required")
-    
-    token = auth_header.split(" ")[1]
-    payload = verify_token(token)
-    if not payload:
-        raise HTTPException(status_code=401, detail="Invalid token")
     
     user_id = payload.get("user_id")
     
@@ -3130,6 +5302,7 @@ async def update_user_subscription(user_id: str, plan_id: str):
         {"$or": [{"id": user_id}, {"user_id": user_id}]},
         {"$set": {"subscription": subscription_data}}
     )
+    session_cache.invalidate_user(user_id)
     
     logging.info(f"User {user_id} subscription updated to {plan_id}")
 
@@ -3174,17 +5347,8 @@ async def stripe_webhook(request: Request):
         return {"status": "error", "message": str(e)}
 
 @api_router.get("/payments/user-subscription")
-async def get_user_subscription(request: Request):
+async def get_user_subscription(payload: dict = Depends(get_user_from_token)):
     """Get current user's subscription status"""
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Authentication required")
-    
-    token = auth_header.split(" ")[1]
-    payload = verify_token(token)
-    if not payload:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    
     user_id = payload.get("user_id")
     
     user = await db.users.find_one(
@@ -3218,17 +5382,8 @@ async def get_user_subscription(request: Request):
     }
 
 @api_router.get("/payments/history")
-async def get_payment_history(request: Request):
+async def get_payment_history(payload: dict = Depends(get_user_from_token)):
     """Get user's payment history"""
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Authentication required")
-    
-    token = auth_header.split(" ")[1]
-    payload = verify_token(token)
-    if not payload:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    
     user_id = payload.get("user_id")
     
     transactions = await db.payment_transactions.find(
@@ -3270,34 +5425,109 @@ async def confirm_paypal_payment(request: Request):
     
     return {"status": "success", "message": "Payment confirmed (demo mode)"}
 
-# Sitemap endpoint for SEO
+# ============ SITEMAP ============
+# Streamed straight from Mongo cursors so memory stays flat however many posts
+# exist. Only pages a logged-out crawler can render are listed (the landing page
+# and the blog); character and chat pages sit behind login. Past
+# SITEMAP_SHARD_SIZE URLs (the protocol limit) the root becomes a sitemap index
+# pointing at per-kind shards.
+
+SITEMAP_SHARD_SIZE = 50000
+SITEMAP_TTL = 3600
+SITEMAP_CHUNK_URLS = 500
+
+SITEMAP_SOURCES = {
+    "blog": {
+        "collection": "blog_posts",
+        "query": {"status": "published"},
+        "projection": {"_id": 0, "slug": 1, "updated_at": 1},
+        "sort": [("published_at", -1), ("id", -1)],
+        "path": lambda doc: f"/blog/{doc['slug']}",
+        "lastmod": "updated_at",
+        "priority": "0.8",
+    },
+}
+
+def site_url() -> str:
+    return os.environ.get('SITE_URL', 'https://example.com').rstrip('/')
+
+def sitemap_url(loc: str, priority: str, lastmod: Optional[str] = None) -> str:
+    lastmod_tag = f"<lastmod>{xml_escape(lastmod[:10])}</lastmod>" if lastmod else ""
+    return f"  <url><loc>{xml_escape(loc)}</loc>{lastmod_tag}<priority>{priority}</priority></url>\n"
+
+async def sitemap_counts() -> Dict[str, int]:
+    counts = await asyncio.gather(*(
+        db[source["collection"]].count_documents(source["query"]) for source in SITEMAP_SOURCES.values()
+    ))
+    return dict(zip(SITEMAP_SOURCES, counts))
+
+async def stream_sitemap_urls(kind: str, skip: int = 0, limit: int = 0):
+    """Yield rendered <url> chunks for one source, SITEMAP_CHUNK_URLS at a time."""
+    source = SITEMAP_SOURCES[kind]
+    base_url = site_url()
+    cursor = db[source["collection"]].find(source["query"], source["projection"]).sort(source["sort"]).skip(skip)
+    if limit:
+        cursor = cursor.limit(limit)
+    lines = []
+    async for doc in cursor.batch_size(SITEMAP_CHUNK_URLS):
+        lines.append(sitemap_url(base_url + source["path"](doc), source["priority"], doc.get(source["lastmod"])))
+        if len(lines) >= SITEMAP_CHUNK_URLS:
+            yield "".join(lines).encode()
+            lines = []
+    if lines:
+        yield "".join(lines).encode()
+
+URLSET_OPEN = b'<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+URLSET_CLOSE = b'</urlset>'
+
 @api_router.get("/sitemap.xml")
-async def get_sitemap():
-    """Generate sitemap XML for SEO"""
-    from fastapi.responses import Response as XMLResponse
-    
-    posts = await db.blog_posts.find({"status": "published"}, {"_id": 0, "slug": 1, "updated_at": 1}).to_list(1000)
-    
-    base_url = os.environ.get('SITE_URL', 'https://example.com')
-    
-    xml_content = '<?xml version="1.0" encoding="UTF-8"?>\n'
-    xml_content += '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
-    
-    # Add homepage
-    xml_content += f'  <url><loc>{base_url}/</loc><priority>1.0</priority></url>\n'
-    xml_content += f'  <url><loc>{base_url}/blog</loc><priority>0.9</priority></url>\n'
-    
-    # Add blog posts
-    for post in posts:
-        xml_content += f'  <url>\n'
-        xml_content += f'    <loc>{base_url}/blog/{post["slug"]}</loc>\n'
-        xml_content += f'    <lastmod>{post.get("updated_at", "")[:10]}</lastmod>\n'
-        xml_content += f'    <priority>0.8</priority>\n'
-        xml_content += f'  </url>\n'
-    
-    xml_content += '</urlset>'
+async def get_sitemap(request: Request):
+    """Sitemap for SEO: a single urlset, or a sitemap index once it outgrows one file"""
+    return await response_cache.serve_stream(request, "sitemap", SITEMAP_TTL, render_sitemap, media_type="application/xml")
+
+async def render_sitemap():
+    counts = await sitemap_counts()
+    if sum(counts.values()) + 2 <= SITEMAP_SHARD_SIZE:
+        base_url = site_url()
+        yield URLSET_OPEN
+        yield (sitemap_url(f"{base_url}/", "1.0") + sitemap_url(f"{base_url}/blog", "0.9")).encode()
+        for kind in SITEMAP_SOURCES:
+            async for chunk in stream_sitemap_urls(kind):
+                yield chunk
+        yield URLSET_CLOSE
+        return
+    
+    # Shard 0 of "blog" also carries the two static pages, so it gets that much less room
+    api_url = API_PUBLIC_URL or site_url()
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n']
+    for kind, count in counts.items():
+        total = count + 2 if kind == "blog" else count
+        for page in range(max(1, math.ceil(total / SITEMAP_SHARD_SIZE))):
+            lines.append(f"  <sitemap><loc>{xml_escape(f'{api_url}/api/sitemaps/{kind}/{page}.xml')}</loc></sitemap>\n")
+    lines.append('</sitemapindex>')
+    yield "".join(lines).encode()
+
+@api_router.get("/sitemaps/{kind}/{page}.xml")
+async def get_sitemap_shard(kind: str, page: int, request: Request):
+    """One shard of the sitemap index"""
+    if kind not in SITEMAP_SOURCES or page < 0:
+        raise HTTPException(status_code=404, detail="Sitemap not found")
+    
+    async def render_shard():
+        yield URLSET_OPEN
+        skip, limit = page * SITEMAP_SHARD_SIZE, SITEMAP_SHARD_SIZE
+        if kind == "blog":
+            if page == 0:
+                base_url = site_url()
+                yield (sitemap_url(f"{base_url}/", "1.0") + sitemap_url(f"{base_url}/blog", "0.9")).encode()
+                limit -= 2
+            else:
+                skip -= 2
+        async for chunk in stream_sitemap_urls(kind, skip, limit):
+            yield chunk
+        yield URLSET_CLOSE
     
-    return XMLResponse(content=xml_content, media_type="application/xml")
+    return await response_cache.serve_stream(request, "sitemap", SITEMAP_TTL, render_shard, media_type="application/xml")
 
 app.include_router(api_router)
 
@@ -3317,4 +5547,43 @@ logger = logging.getLogger(__name__)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    await blog_view_counter.flush()
+    client.close()
+    if web_push_client is not None:
+        await web_push_client.close()
+    await llm_gateway.close()
+    if image_variant_executor is not None:
+        image_variant_executor.shutdown(wait=False, cancel_futures=True)
+    password_executor.shutdown(wait=False, cancel_futures=True)
+
+# ============ MAINTENANCE CLI ============
+# Usage: python server.py migrate
+#        python server.py indexes [--dry-run]
+#        python server.py rollups [--rebuild] [--metric messages ...]
+
+def main():
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="HekoChat backend maintenance commands")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    subcommands.add_parser("migrate", help="Run pending data migrations (resumable)")
+    indexes_parser = subcommands.add_parser("indexes", help="Create missing indexes and report drift")
+    indexes_parser.add_argument("--dry-run", action="store_true", help="Only report, do not create anything")
+    rollups_parser = subcommands.add_parser("rollups", help="Catch up analytics rollups, or rebuild them from scratch")
+    rollups_parser.add_argument("--rebuild", action="store_true", help="Drop existing rollups and recompute")
+    rollups_parser.add_argument("--metric", action="append", choices=list(ROLLUP_SOURCES), help="Limit to a metric (repeatable)")
+    args = parser.parse_args()
+    
+    if args.command == "migrate":
+        asyncio.run(run_migrations())
+    elif args.command == "indexes":
+        report = asyncio.run(ensure_indexes(dry_run=args.dry_run))
+        print(json.dumps(report, indent=2, default=str))
+        if args.dry_run and (report["missing"] or report["mismatched"]):
+            raise SystemExit(1)
+    elif args.command == "rollups":
+        action = rebuild_rollups if args.rebuild else catch_up_rollups
+        print(json.dumps(asyncio.run(action(args.metric)), indent=2))
+
+if __name__ == "__main__":
+    main()
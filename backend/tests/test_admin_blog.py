@@ -9,6 +9,7 @@ import pytest
 import requests
 import os
 import uuid
+from xml.etree import ElementTree
 
 BASE_URL = os.environ.get('REACT_APP_BACKEND_URL')
 if BASE_URL:
@@ -138,6 +139,30 @@ class TestAdminAnalytics:
         response = requests.get(f"{BASE_URL}/api/admin/analytics")
         assert response.status_code == 401
         print(f"✓ Analytics correctly requires authentication")
+    
+    def test_cache_stats(self, admin_token):
+        """Test unknown session tokens are rejected and counted by the session cache"""
+        bogus = f"bogus_{uuid.uuid4().hex}"
+        for _ in range(2):
+            response = requests.get(
+                f"{BASE_URL}/api/auth/me",
+                headers={"Authorization": f"Bearer {bogus}"}
+            )
+            assert response.status_code == 401
+        
+        response = requests.get(
+            f"{BASE_URL}/api/admin/cache-stats",
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 200, f"Cache stats failed: {response.text}"
+        sessions = response.json()["sessions"]
+        for field in ["size", "hits", "negative_hits", "misses", "hit_rate"]:
+            assert field in sessions, f"Missing session cache field: {field}"
+        print(f"✓ Session cache stats: {sessions}")
+        
+        openers = response.json()["openers"]
+        for field in ["enabled", "hits", "misses", "bypassed", "hit_rate"]:
+            assert field in openers, f"Missing opener cache field: {field}"
 
 
 class TestAdminUsers:
@@ -159,17 +184,35 @@ class TestAdminUsers:
         print(f"✓ Retrieved {len(data['users'])} users (total: {data['total']})")
     
     def test_users_pagination(self, admin_token):
-        """Test user list pagination"""
+        """Test user list cursor pagination"""
         response = requests.get(
-            f"{BASE_URL}/api/admin/users?skip=0&limit=5",
+            f"{BASE_URL}/api/admin/users?limit=5",
             headers={"Authorization": f"Bearer {admin_token}"}
         )
         
         assert response.status_code == 200
         data = response.json()
-        assert "skip" in data
-        assert "limit" in data
-        print(f"✓ Pagination working - skip: {data['skip']}, limit: {data['limit']}")
+        assert "next_cursor" in data
+        assert data["limit"] == 5
+        
+        if data["next_cursor"]:
+            next_page = requests.get(
+                f"{BASE_URL}/api/admin/users?limit=5&cursor={data['next_cursor']}",
+                headers={"Authorization": f"Bearer {admin_token}"}
+            )
+            assert next_page.status_code == 200
+            first_ids = {user["id"] for user in data["users"]}
+            assert not first_ids & {user["id"] for user in next_page.json()["users"]}
+        print(f"✓ Pagination working - limit: {data['limit']}, next_cursor: {bool(data['next_cursor'])}")
+    
+    def test_users_page_size_bounded(self, admin_token):
+        """Test oversized pages are clamped"""
+        response = requests.get(
+            f"{BASE_URL}/api/admin/users?limit=100000",
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 200
+        assert len(response.json()["users"]) <= 100
 
 
 class TestAdminCharacters:
@@ -231,6 +274,18 @@ class TestPublicBlogEndpoints:
         assert isinstance(data["categories"], list)
         print(f"✓ Retrieved {len(data['categories'])} categories")
     
+    def test_blog_categories_etag(self):
+        """Test cached public responses carry an ETag and honor If-None-Match"""
+        response = requests.get(f"{BASE_URL}/api/blog/categories")
+        assert response.status_code == 200
+        etag = response.headers.get("ETag")
+        assert etag, "Missing ETag header"
+        assert "max-age" in response.headers.get("Cache-Control", "")
+        
+        cached = requests.get(f"{BASE_URL}/api/blog/categories", headers={"If-None-Match": etag})
+        assert cached.status_code == 304
+        print(f"✓ Conditional request returned 304 for ETag {etag}")
+    
     def test_get_blog_tags(self):
         """Test fetching blog tags"""
         response = requests.get(f"{BASE_URL}/api/blog/tags")
@@ -241,6 +296,18 @@ class TestPublicBlogEndpoints:
         assert "tags" in data
         assert isinstance(data["tags"], list)
         print(f"✓ Retrieved {len(data['tags'])} tags")
+    
+    def test_sitemap(self):
+        """Test the sitemap is well-formed XML and unknown shards 404"""
+        response = requests.get(f"{BASE_URL}/api/sitemap.xml")
+        assert response.status_code == 200
+        assert response.headers.get("content-type", "").startswith("application/xml")
+        root = ElementTree.fromstring(response.content)
+        assert root.tag.endswith("urlset") or root.tag.endswith("sitemapindex")
+        
+        missing = requests.get(f"{BASE_URL}/api/sitemaps/unknown/0.xml")
+        assert missing.status_code == 404
+        print(f"✓ Sitemap root is <{root.tag.split('}')[-1]}> with {len(root)} entries")
 
 
 class TestAdminBlogCRUD:
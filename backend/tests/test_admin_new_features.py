@@ -149,6 +149,27 @@ class TestModerationTab:
         else:
             pytest.skip("No chats available to test message retrieval")
     
+    def test_chats_cursor_pagination(self, auth_headers):
+        """Test paging through chats with next_cursor does not repeat rows"""
+        first = requests.get(f"{BASE_URL}/api/admin/chats?limit=2", headers=auth_headers)
+        assert first.status_code == 200
+        data = first.json()
+        assert "next_cursor" in data
+        if not data["next_cursor"]:
+            pytest.skip("Not enough chats to test a second page")
+        
+        second = requests.get(f"{BASE_URL}/api/admin/chats?limit=2&cursor={data['next_cursor']}", headers=auth_headers)
+        assert second.status_code == 200
+        first_ids = {chat["chat_id"] for chat in data["chats"]}
+        second_ids = {chat["chat_id"] for chat in second.json()["chats"]}
+        assert not first_ids & second_ids
+        print(f"Cursor pagination: page 1 {len(first_ids)} chats, page 2 {len(second_ids)} chats")
+    
+    def test_chats_invalid_cursor(self, auth_headers):
+        """Test a malformed cursor is rejected"""
+        response = requests.get(f"{BASE_URL}/api/admin/chats?cursor=not-a-cursor", headers=auth_headers)
+        assert response.status_code == 400
+    
     def test_moderation_requires_auth(self):
         """Test that moderation requires authentication"""
         response = requests.get(f"{BASE_URL}/api/admin/chats")
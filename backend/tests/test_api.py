@@ -5,6 +5,7 @@ Tests: Auth (signup, login, Google session), Characters, Chat, Voice
 import pytest
 import requests
 import os
+import json
 import uuid
 
 BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
@@ -284,6 +285,44 @@ class TestChatAPI:
         
         assert response.status_code == 404
         print("Chat with invalid character returns 404")
+    
+    def test_stream_chat_message(self, test_user, test_character):
+        """POST /api/chat/stream streams tokens as SSE and persists the exchange"""
+        user_id = test_user['user']['id']
+        character_id = test_character['id']
+        
+        response = requests.post(f"{BASE_URL}/api/chat/stream", json={
+            "character_id": character_id,
+            "user_id": user_id,
+            "message": "Tell me about your day"
+        }, stream=True)
+        
+        assert response.status_code == 200, f"Chat stream failed: {response.text}"
+        assert response.headers['content-type'].startswith('text/event-stream')
+        
+        events = []
+        event_name = None
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event: "):
+                event_name = line[len("event: "):]
+            elif line.startswith("data: "):
+                events.append((event_name, json.loads(line[len("data: "):])))
+        
+        names = [name for name, _ in events]
+        assert names[0] == 'meta'
+        assert 'typing_delay_ms' in events[0][1]
+        assert 'token' in names
+        assert names[-1] == 'done'
+        
+        streamed = "".join(data['text'] for name, data in events if name == 'token')
+        done = events[-1][1]
+        assert done['response'] == streamed
+        assert ' - ' not in streamed
+        
+        history = requests.get(f"{BASE_URL}/api/chat/history/{character_id}?user_id={user_id}").json()
+        ids = [m['id'] for m in history['messages']]
+        assert done['message_id'] in ids
+        print(f"Streamed {names.count('token')} token events")
 
 
 class TestVoiceAPI:
@@ -0,0 +1,167 @@
+"""
+Tests for LLM provider routing against a local stub provider
+- Fallback to the next model in the chain when one fails
+- Circuit opens after repeated failures and half-opens after the cooldown
+- Hedged request to the secondary model when the primary is slow
+- Route timeout surfaces as LLMUnavailable
+- Waiting on the caller's own concurrency cap neither hedges nor counts as a failure
+"""
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from llm_router import LLMRouter, LLMUnavailable
+
+
+class StubProvider:
+    """Answers per model after a delay, or raises when the model is marked as failing"""
+
+    def __init__(self, delays=None, failing=()):
+        self.delays = delays or {}
+        self.failing = set(failing)
+        self.calls = []
+
+    async def __call__(self, model):
+        self.calls.append(model)
+        await asyncio.sleep(self.delays.get(model, 0))
+        if model in self.failing:
+            raise RuntimeError(f"{model} is down")
+        return f"reply from {model}"
+
+
+def make_router(hedge_after=None, timeout=2.0, cooldown=30.0):
+    routes = {"chat": {"chain": ["primary", "secondary"], "timeout": timeout, "hedge_after": hedge_after}}
+    return LLMRouter(routes, failure_threshold=2, cooldown=cooldown)
+
+
+class TestFallback:
+    """Test fallback chains"""
+
+    def test_primary_answers(self):
+        """Test a healthy primary is used without touching the fallback"""
+        provider = StubProvider()
+        result = asyncio.run(make_router().run("chat", provider))
+        assert result == "reply from primary"
+        assert provider.calls == ["primary"]
+        print("✓ Healthy primary answered")
+
+    def test_falls_back_on_error(self):
+        """Test a failing primary falls back to the secondary"""
+        provider = StubProvider(failing={"primary"})
+        result = asyncio.run(make_router().run("chat", provider))
+        assert result == "reply from secondary"
+        assert provider.calls == ["primary", "secondary"]
+        print("✓ Fell back to secondary")
+
+    def test_all_models_fail(self):
+        """Test a route with every model down raises LLMUnavailable"""
+        provider = StubProvider(failing={"primary", "secondary"})
+        with pytest.raises(LLMUnavailable) as exc_info:
+            asyncio.run(make_router().run("chat", provider))
+        assert len(exc_info.value.errors) == 2
+        print(f"✓ Route unavailable: {exc_info.value}")
+
+
+class TestCircuitBreaker:
+    """Test per-model circuit breaking"""
+
+    def test_circuit_opens_and_skips_model(self):
+        """Test an open circuit skips the model entirely"""
+        router = make_router()
+        provider = StubProvider(failing={"primary"})
+
+        async def scenario():
+            for _ in range(2):
+                await router.run("chat", provider)
+            provider.calls.clear()
+            return await router.run("chat", provider)
+
+        assert asyncio.run(scenario()) == "reply from secondary"
+        assert provider.calls == ["secondary"]
+        assert router.model_health("primary").state == "open"
+        print("✓ Open circuit skipped the primary")
+
+    def test_half_open_probe_closes_circuit(self):
+        """Test a successful probe after the cooldown closes the circuit"""
+        router = make_router(cooldown=0.05)
+        provider = StubProvider(failing={"primary"})
+
+        async def scenario():
+            for _ in range(2):
+                await router.run("chat", provider)
+            provider.failing.clear()
+            await asyncio.sleep(0.06)
+            return await router.run("chat", provider)
+
+        assert asyncio.run(scenario()) == "reply from primary"
+        assert router.model_health("primary").state == "closed"
+        print("✓ Probe closed the circuit")
+
+
+class TestHedging:
+    """Test hedged requests and route timeouts"""
+
+    def test_hedge_returns_faster_model(self):
+        """Test a slow primary is hedged and the secondary's answer wins"""
+        router = make_router(hedge_after=0.05)
+        provider = StubProvider(delays={"primary": 1.0, "secondary": 0.01})
+        result = asyncio.run(router.run("chat", provider))
+        assert result == "reply from secondary"
+        assert router.hedges == 1
+        # The losing attempt was cancelled, not counted as a failure
+        assert router.model_health("primary").failures == 0
+        print("✓ Hedged request won")
+
+    def test_no_hedge_when_primary_is_fast(self):
+        """Test no hedge is sent when the primary answers before the threshold"""
+        router = make_router(hedge_after=0.5)
+        provider = StubProvider(delays={"primary": 0.01})
+        assert asyncio.run(router.run("chat", provider)) == "reply from primary"
+        assert router.hedges == 0
+        assert provider.calls == ["primary"]
+        print("✓ No hedge for a fast primary")
+
+    def test_route_timeout(self):
+        """Test the route deadline raises LLMUnavailable and counts against slow models"""
+        router = make_router(timeout=0.05)
+        provider = StubProvider(delays={"primary": 1.0})
+        with pytest.raises(LLMUnavailable):
+            asyncio.run(router.run("chat", provider))
+        assert router.model_health("primary").failures == 1
+        print("✓ Route timed out")
+
+
+class TestAdmission:
+    """Test that local concurrency limits are kept out of the route clock"""
+
+    def test_queue_wait_does_not_hedge_or_time_out(self):
+        """Test time queued for a slot is not counted toward the hedge delay or deadline"""
+        router = make_router(hedge_after=0.2, timeout=0.4)
+        provider = StubProvider(delays={"primary": 0.1})
+        slots = {"primary": asyncio.Semaphore(1), "secondary": asyncio.Semaphore(1)}
+
+        async def scenario():
+            # Queued past the hedge delay, and queue plus call runs past the route timeout
+            await slots["primary"].acquire()
+            asyncio.get_running_loop().call_later(0.35, slots["primary"].release)
+            return await router.run("chat", provider, admit=slots.get)
+
+        assert asyncio.run(scenario()) == "reply from primary"
+        assert router.hedges == 0
+        assert provider.calls == ["primary"]
+        print("✓ Queue wait was not charged to the route")
+
+    def test_no_slot_is_not_a_model_failure(self):
+        """Test an attempt that never got a local slot raises without tripping the breaker"""
+        router = make_router(timeout=0.05)
+        provider = StubProvider()
+        slots = {"primary": asyncio.Semaphore(0), "secondary": asyncio.Semaphore(0)}
+        with pytest.raises(LLMUnavailable):
+            asyncio.run(router.run("chat", provider, admit=slots.get))
+        assert provider.calls == []
+        assert router.model_health("primary").failures == 0
+        print("✓ Missing slot did not count against the model")
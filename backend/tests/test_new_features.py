@@ -272,6 +272,30 @@ class TestImagesAPI:
         assert response.status_code != 404, "Image generation endpoint should exist"
         print(f"✓ Image generation endpoint exists (status: {response.status_code})")
     
+    def test_image_job_idempotent_submit(self, api_client, auth_token):
+        """POST /api/images/generate - Same Idempotency-Key returns the same job, which can be polled"""
+        token, user_id = auth_token
+        headers = {"Idempotency-Key": uuid.uuid4().hex}
+        body = {"user_id": user_id, "prompt": "TEST sunset over the sea", "style": "realistic"}
+        
+        first = api_client.post(f"{BASE_URL}/api/images/generate", json=body, headers=headers)
+        second = api_client.post(f"{BASE_URL}/api/images/generate", json=body, headers=headers)
+        assert first.status_code == 202, f"Expected 202, got {first.status_code}: {first.text}"
+        assert second.status_code == 202
+        job_id = first.json()["job_id"]
+        assert second.json()["job_id"] == job_id
+        
+        status = api_client.get(f"{BASE_URL}/api/images/jobs/{job_id}")
+        assert status.status_code == 200
+        assert status.json()["status"] in ["pending", "running", "done", "failed"]
+        print(f"✓ Image job {job_id} deduplicated (status: {status.json()['status']})")
+    
+    def test_image_job_not_found(self, api_client):
+        """GET /api/images/jobs/{job_id} - Unknown job returns 404"""
+        response = api_client.get(f"{BASE_URL}/api/images/jobs/{uuid.uuid4()}")
+        assert response.status_code == 404
+        print("✓ Unknown image job returns 404")
+    
     def test_delete_image_not_found(self, api_client, auth_token):
         """DELETE /api/images/{image_id} - Non-existent image returns 404"""
         token, user_id = auth_token
@@ -280,6 +304,44 @@ class TestImagesAPI:
         
         assert response.status_code == 404
         print("✓ Non-existent image deletion returns 404")
+    
+    def test_blob_not_found(self, api_client):
+        """GET /api/blobs/{hash} - Unknown or malformed hashes return 404"""
+        response = api_client.get(f"{BASE_URL}/api/blobs/{'0' * 64}")
+        assert response.status_code == 404
+        
+        response = api_client.get(f"{BASE_URL}/api/blobs/not-a-hash")
+        assert response.status_code == 404
+        print("✓ Unknown blobs return 404")
+    
+    def test_my_images_reference_blobs(self, api_client, auth_token):
+        """GET /api/images/my/{user_id} - Images point at the blob endpoint instead of embedding base64"""
+        token, user_id = auth_token
+        
+        images = api_client.get(f"{BASE_URL}/api/images/my/{user_id}").json()["images"]
+        migrated = [img for img in images if img.get("image_blob")]
+        if not migrated:
+            pytest.skip("No blob-backed images for this user")
+        
+        image = migrated[0]
+        assert "image_data" not in image
+        assert image["thumbnail_url"]
+        assert isinstance(image["variant_urls"], dict)
+        digest = image["image_blob"]
+        
+        full = api_client.get(f"{BASE_URL}/api/blobs/{digest}")
+        assert full.status_code == 200
+        assert full.headers["ETag"] == f'"{digest}"'
+        assert full.headers["Content-Type"].startswith("image/")
+        
+        partial = api_client.get(f"{BASE_URL}/api/blobs/{digest}", headers={"Range": "bytes=0-99"})
+        assert partial.status_code == 206
+        assert partial.content == full.content[:100]
+        assert partial.headers["Content-Range"] == f"bytes 0-99/{len(full.content)}"
+        
+        cached = api_client.get(f"{BASE_URL}/api/blobs/{digest}", headers={"If-None-Match": f'"{digest}"'})
+        assert cached.status_code == 304
+        print(f"✓ Blob {digest[:12]} served with ETag and Range support")
 
 
 class TestFavoriteToggleOnChat:
@@ -142,6 +142,8 @@ echo "Useful commands:"
 echo "  pm2 status              - Check backend status"
 echo "  pm2 logs                - View logs"
 echo "  pm2 restart all         - Restart backend"
+echo "  cd backend && venv/bin/python server.py indexes --dry-run - Check MongoDB index drift"
+echo "  cd backend && venv/bin/python server.py rollups --rebuild - Recompute admin analytics rollups"
 echo "  systemctl restart nginx - Restart nginx"
 echo ""
 echo "Don't forget to:"
@@ -0,0 +1,50 @@
+const API = `${process.env.REACT_APP_BACKEND_URL}/api`;
+
+// The server could not stream this turn (disabled or unreachable) before anything was sent
+export class StreamUnavailable extends Error {}
+
+const parseEvent = (block) => {
+  let event = "message";
+  let data = "";
+  for (const line of block.split("\n")) {
+    if (line.startsWith("event:")) event = line.slice(6).trim();
+    else if (line.startsWith("data:")) data += line.slice(5).trim();
+  }
+  return { event, data: data ? JSON.parse(data) : {} };
+};
+
+// POST a chat turn to /chat/stream and read its Server-Sent Events (meta, token..., done | error).
+// Calls onToken(text) per chunk and resolves with the "done" payload ({ message_id, response }).
+export async function streamChatReply(body, { onToken }) {
+  let response;
+  try {
+    response = await fetch(`${API}/chat/stream`, {
+      method: "POST",
+      headers: { "Content-Type": "application/json", Accept: "text/event-stream" },
+      body: JSON.stringify(body)
+    });
+  } catch (error) {
+    throw new StreamUnavailable(error.message);
+  }
+  if (!response.ok || !response.body) {
+    throw new StreamUnavailable(`Chat stream returned ${response.status}`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  for (;;) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    let boundary;
+    while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+      const { event, data } = parseEvent(buffer.slice(0, boundary));
+      buffer = buffer.slice(boundary + 2);
+      if (event === "token") onToken(data.text);
+      else if (event === "done") return data;
+      else if (event === "error") throw new Error(data.detail || "Failed to generate response");
+    }
+  }
+  throw new Error("Chat stream ended before the reply was complete");
+}
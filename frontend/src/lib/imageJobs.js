@@ -0,0 +1,35 @@
+import axios from "axios";
+
+const API = `${process.env.REACT_APP_BACKEND_URL}/api`;
+
+const POLL_INTERVAL_MS = 2000;
+// Covers queueing plus one generation attempt; scheduled retries extend it from their run_at
+const POLL_TIMEOUT_MS = 3 * 60 * 1000;
+
+// The job itself failed for good (as opposed to a network error or a poll timeout)
+export class ImageJobFailed extends Error {}
+
+export const newIdempotencyKey = () => crypto.randomUUID();
+
+// One key per user action: retrying the same request reuses the pending key, and so
+// resumes the same job; any other request gets a fresh key
+export const idempotencyKeyFor = (pending, request) =>
+  pending && JSON.stringify(pending.request) === JSON.stringify(request) ? pending.key : newIdempotencyKey();
+
+// Blob URLs are relative to the API when API_PUBLIC_URL is not set
+export const imageUrl = (url) => (url.startsWith("/") ? `${process.env.REACT_APP_BACKEND_URL}${url}` : url);
+
+export async function waitForImageJob(jobId) {
+  let deadline = Date.now() + POLL_TIMEOUT_MS;
+  while (Date.now() < deadline) {
+    const { data } = await axios.get(`${API}/images/jobs/${jobId}`);
+    if (data.status === "done") return data.result;
+    if (data.status === "failed") throw new ImageJobFailed(data.error || "Image generation failed");
+    if (data.status === "pending" && data.attempts > 0 && data.run_at) {
+      // A failed attempt was rescheduled; give the retry the same budget as the first try
+      deadline = Math.max(deadline, Date.parse(data.run_at) + POLL_TIMEOUT_MS);
+    }
+    await new Promise((resolve) => setTimeout(resolve, POLL_INTERVAL_MS));
+  }
+  throw new Error("Image generation timed out");
+}
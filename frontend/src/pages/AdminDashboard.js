@@ -33,6 +33,7 @@ export default function AdminDashboard({ admin, adminToken, onAdminLogout }) {
   const [loading, setLoading] = useState(true);
   const [searchQuery, setSearchQuery] = useState("");
   const [userPage, setUserPage] = useState(0);
+  const [userCursors, setUserCursors] = useState([null]);
   const [totalUsers, setTotalUsers] = useState(0);
   
   // Modal states
@@ -101,9 +102,18 @@ export default function AdminDashboard({ admin, adminToken, onAdminLogout }) {
           setChatAnalytics(chatAnalyticsRes.data);
           break;
         case "users":
-          const usersRes = await axios.get(`${API}/admin/users?skip=${userPage * 20}&limit=20`, authHeaders);
+          const userCursor = userCursors[userPage];
+          const usersRes = await axios.get(
+            `${API}/admin/users?limit=20${userCursor ? `&cursor=${encodeURIComponent(userCursor)}` : ""}`,
+            authHeaders
+          );
           setUsers(usersRes.data.users);
           setTotalUsers(usersRes.data.total);
+          setUserCursors(prev => {
+            const cursors = prev.slice(0, userPage + 1);
+            cursors[userPage + 1] = usersRes.data.next_cursor;
+            return cursors;
+          });
           break;
         case "characters":
           const charsRes = await axios.get(`${API}/admin/characters`, authHeaders);
@@ -570,7 +580,7 @@ export default function AdminDashboard({ admin, adminToken, onAdminLogout }) {
                       <ChevronLeft className="w-4 h-4 mr-1" /> Prev
                     </Button>
                     <span className="text-text-secondary text-sm">Page {userPage + 1}</span>
-                    <Button onClick={() => setUserPage(p => p + 1)} disabled={(userPage + 1) * 20 >= totalUsers} variant="ghost" size="sm">
+                    <Button onClick={() => setUserPage(p => p + 1)} disabled={!userCursors[userPage + 1]} variant="ghost" size="sm">
                       Next <ChevronRight className="w-4 h-4 ml-1" />
                     </Button>
                   </div>
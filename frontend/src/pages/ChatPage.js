@@ -7,6 +7,8 @@ import { Input } from "@/components/ui/input";
 import axios from "axios";
 import { toast } from "sonner";
 import { useSettings } from "@/context/SettingsContext";
+import { ImageJobFailed, idempotencyKeyFor, imageUrl, waitForImageJob } from "@/lib/imageJobs";
+import { StreamUnavailable, streamChatReply } from "@/lib/chatStream";
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
@@ -19,8 +21,12 @@ export default function ChatPage({ user, onLogout }) {
   const [messages, setMessages] = useState([]);
   const [inputMessage, setInputMessage] = useState("");
   const [loading, setLoading] = useState(false);
+  // True once the first streamed token arrives, which replaces the typing indicator
+  const [streaming, setStreaming] = useState(false);
   const [loadingVoice, setLoadingVoice] = useState(false);
   const [loadingImage, setLoadingImage] = useState(false);
+  // { request, key } of the image request that has not finished yet, so asking again resumes its job
+  const [pendingImage, setPendingImage] = useState(null);
   const [isFavorited, setIsFavorited] = useState(false);
   const messagesEndRef = useRef(null);
 
@@ -138,33 +144,69 @@ export default function ChatPage({ user, onLogout }) {
     setInputMessage("");
     setLoading(true);
 
-    try {
-      const response = await axios.post(`${API}/chat/send`, {
-        character_id: characterId,
-        user_id: user.id,
-        message: inputMessage
-      });
+    const body = {
+      character_id: characterId,
+      user_id: user.id,
+      message: inputMessage
+    };
+    const streamId = `stream-${Date.now()}`;
 
-      const aiMsg = {
-        id: response.data.message_id,
-        sender: "ai",
-        content: response.data.response,
-        timestamp: new Date().toISOString()
-      };
+    try {
+      let reply;
+      try {
+        // Tokens are shown as they arrive; the placeholder takes the stored id once the reply is saved
+        reply = await streamChatReply(body, {
+          onToken: (text) => {
+            setStreaming(true);
+            setMessages(prev => (
+              prev.some(msg => msg.id === streamId)
+                ? prev.map(msg => (msg.id === streamId ? { ...msg, content: msg.content + text } : msg))
+                : [...prev, { id: streamId, sender: "ai", content: text, timestamp: new Date().toISOString() }]
+            ));
+          }
+        });
+        const aiMsg = {
+          id: reply.message_id,
+          sender: "ai",
+          content: reply.response,
+          timestamp: new Date().toISOString()
+        };
+        setMessages(prev => (
+          prev.some(msg => msg.id === streamId)
+            ? prev.map(msg => (msg.id === streamId ? aiMsg : msg))
+            : [...prev, aiMsg]
+        ));
+      } catch (error) {
+        if (!(error instanceof StreamUnavailable)) throw error;
 
-      setMessages(prev => [...prev, aiMsg]);
+        // Streaming is off on this server: one-shot reply with the server's pacing hint
+        const response = await axios.post(`${API}/chat/send`, body);
+        const typingDelay = response.data.typing_delay_ms || 0;
+        if (typingDelay > 0) {
+          await new Promise(resolve => setTimeout(resolve, typingDelay));
+        }
+        reply = response.data;
+        setMessages(prev => [...prev, {
+          id: reply.message_id,
+          sender: "ai",
+          content: reply.response,
+          timestamp: new Date().toISOString()
+        }]);
+      }
       
       // Play sound when message received
       playSound('message');
       
       // Auto-play voice if enabled
       if (settings.voiceAutoplay) {
-        handleGenerateVoice(response.data.response);
+        handleGenerateVoice(reply.response);
       }
     } catch (error) {
+      setMessages(prev => prev.filter(msg => msg.id !== streamId));
       toast.error("Failed to send message");
     } finally {
       setLoading(false);
+      setStreaming(false);
     }
   };
 
@@ -191,24 +233,29 @@ export default function ChatPage({ user, onLogout }) {
     const prompt = window.prompt("Describe the image you want to generate:");
     if (!prompt) return;
 
+    const request = { prompt: prompt, character_id: characterId, user_id: user.id };
+    const key = idempotencyKeyFor(pendingImage, request);
+    setPendingImage({ request, key });
+
     setLoadingImage(true);
     try {
-      const response = await axios.post(`${API}/image/generate`, {
-        prompt: prompt,
-        character_id: characterId
-      });
+      const response = await axios.post(`${API}/image/generate`, request, { headers: { "Idempotency-Key": key } });
+      const result = await waitForImageJob(response.data.job_id);
+      setPendingImage(null);
 
       const imageMsg = {
         id: Date.now().toString(),
         sender: "ai",
         content: "Here's the image you requested!",
-        image: response.data.image,
+        image_url: result.image_url,
         timestamp: new Date().toISOString()
       };
 
       setMessages(prev => [...prev, imageMsg]);
       toast.success("Image generated!");
     } catch (error) {
+      // A job that failed for good would be returned again for the same key
+      if (error instanceof ImageJobFailed) setPendingImage(null);
       toast.error("Failed to generate image");
     } finally {
       setLoadingImage(false);
@@ -287,9 +334,9 @@ export default function ChatPage({ user, onLogout }) {
                   }`}
                 >
                   <p className="text-base">{msg.content}</p>
-                  {msg.image && (
+                  {(msg.image_url || msg.image) && (
                     <img
-                      src={`data:image/png;base64,${msg.image}`}
+                      src={msg.image_url ? imageUrl(msg.image_url) : `data:image/png;base64,${msg.image}`}
                       alt="Generated"
                       className="mt-3 rounded-xl max-w-full"
                     />
@@ -311,7 +358,7 @@ export default function ChatPage({ user, onLogout }) {
             </motion.div>
           ))}
           
-          {loading && settings.showTypingIndicator && (
+          {loading && !streaming && settings.showTypingIndicator && (
             <div className="flex justify-start">
               <div className="glass-heavy p-4 rounded-2xl rounded-tl-sm">
                 <div className="flex gap-2">
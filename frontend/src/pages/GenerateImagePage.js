@@ -6,6 +6,7 @@ import { Button } from "@/components/ui/button";
 import { Input } from "@/components/ui/input";
 import axios from "axios";
 import { toast } from "sonner";
+import { ImageJobFailed, idempotencyKeyFor, waitForImageJob } from "@/lib/imageJobs";
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
@@ -25,6 +26,8 @@ export default function GenerateImagePage({ user }) {
   const [generatedImage, setGeneratedImage] = useState(null);
   const [myImages, setMyImages] = useState([]);
   const [loadingImages, setLoadingImages] = useState(true);
+  // { request, key } of the generation that has not finished yet, so "try again" resumes its job
+  const [pendingGeneration, setPendingGeneration] = useState(null);
 
   useEffect(() => {
     fetchMyImages();
@@ -50,32 +53,30 @@ export default function GenerateImagePage({ user }) {
     setGenerating(true);
     setGeneratedImage(null);
 
+    const request = { user_id: user.id, prompt: prompt.trim(), style };
+    const key = idempotencyKeyFor(pendingGeneration, request);
+    setPendingGeneration({ request, key });
+
     try {
-      const response = await axios.post(`${API}/images/generate`, {
-        user_id: user.id,
-        prompt: prompt.trim(),
-        style
-      });
+      const response = await axios.post(`${API}/images/generate`, request, { headers: { "Idempotency-Key": key } });
+      const result = await waitForImageJob(response.data.job_id);
+      setPendingGeneration(null);
 
-      setGeneratedImage({
-        id: response.data.id,
-        image: response.data.image,
-        mime_type: response.data.mime_type,
-        prompt: response.data.prompt
-      });
+      const image = {
+        id: result.image_id,
+        image_url: result.image_url,
+        mime_type: result.mime_type,
+        prompt: prompt.trim()
+      };
+      setGeneratedImage(image);
 
       // Add to my images list
-      setMyImages(prev => [{
-        id: response.data.id,
-        image_data: response.data.image,
-        mime_type: response.data.mime_type,
-        prompt: response.data.prompt,
-        style,
-        created_at: new Date().toISOString()
-      }, ...prev]);
+      setMyImages(prev => [{ ...image, style, created_at: new Date().toISOString() }, ...prev]);
 
       toast.success("Image generated successfully!");
     } catch (error) {
+      // A job that failed for good would be returned again for the same key
+      if (error instanceof ImageJobFailed) setPendingGeneration(null);
       toast.error("Failed to generate image. Please try again.");
       console.error(error);
     } finally {
@@ -83,9 +84,22 @@ export default function GenerateImagePage({ user }) {
     }
   };
 
-  const handleDownload = (imageData, mimeType, filename) => {
+  // Stored images are served from the blob endpoint; rows not yet migrated still embed base64
+  const blobSrc = (url) => (url.startsWith('/') ? `${BACKEND_URL}${url}` : url);
+
+  const imageSrc = (img) => {
+    if (img.image_url) {
+      return blobSrc(img.image_url);
+    }
+    return `data:${img.mime_type};base64,${img.image_data}`;
+  };
+
+  // Grid tiles load the small thumbnail; the full image is only fetched on download
+  const thumbnailSrc = (img) => (img.thumbnail_url ? blobSrc(img.thumbnail_url) : imageSrc(img));
+
+  const handleDownload = (img, filename) => {
     const link = document.createElement('a');
-    link.href = `data:${mimeType};base64,${imageData}`;
+    link.href = imageSrc(img);
     link.download = filename || 'ai-generated-image.png';
     link.click();
   };
@@ -205,13 +219,13 @@ export default function GenerateImagePage({ user }) {
               >
                 <div className="relative rounded-xl overflow-hidden">
                   <img
-                    src={`data:${generatedImage.mime_type};base64,${generatedImage.image}`}
+                    src={imageSrc(generatedImage)}
                     alt={generatedImage.prompt}
                     className="w-full h-auto"
                   />
                   <div className="absolute bottom-4 right-4 flex gap-2">
                     <Button
-                      onClick={() => handleDownload(generatedImage.image, generatedImage.mime_type, `ai-image-${Date.now()}.png`)}
+                      onClick={() => handleDownload(generatedImage, `ai-image-${Date.now()}.png`)}
                       className="glass-heavy hover:bg-white/20"
                     >
                       <Download className="w-4 h-4 mr-2" />
@@ -248,14 +262,15 @@ export default function GenerateImagePage({ user }) {
                     className="relative group rounded-xl overflow-hidden"
                   >
                     <img
-                      src={`data:${img.mime_type};base64,${img.image_data}`}
+                      src={thumbnailSrc(img)}
+                      loading="lazy"
                       alt={img.prompt}
                       className="w-full aspect-square object-cover"
                     />
                     <div className="absolute inset-0 bg-black/60 opacity-0 group-hover:opacity-100 transition-opacity flex items-center justify-center gap-2">
                       <Button
                         size="sm"
-                        onClick={() => handleDownload(img.image_data, img.mime_type, `ai-image-${img.id}.png`)}
+                        onClick={() => handleDownload(img, `ai-image-${img.id}.png`)}
                         className="glass-heavy hover:bg-white/20"
                       >
                         <Download className="w-4 h-4" />